@@ -1,25 +1,41 @@
+import atexit
 import time
 import json
+import hashlib
 import ujson
 import re
 import os
 import shutil
+import threading
 from uuid import uuid4
 from APRLogger import technical_log, administrative_log
-from prompting.engine import PromptingEngine
-from jinja2 import Environment, FileSystemLoader, select_autoescape
-from playwright.sync_api import sync_playwright
-from setup_env import API_DICT, DEBUG
+from prompting.engine import shared_engine
+from prompting.retrieval import build_passage_index, remove_passage_index, relevant_passages
+from prompting.thoughts import normalize_section
+from prompting.preextract import preextract, FIELDS as PREEXTRACT_FIELDS, PREEXTRACT_THRESHOLD
+import metrics
+import prefetch
+import tracing
+from saje import JobCancelled
+from transcription import is_transcription, ingest_transcription, remove_timings
+from normalization import normalize, store_normalization, load_normalization, remove_normalization, estimate_tokens
+from setup_env import DEBUG
 from pathlib import Path
 from datetime import datetime
 
-
-env = Environment(
-    loader=FileSystemLoader("templates"),
-    autoescape=select_autoescape(['html', 'xml'])
-)
+# Jinja and Playwright are imported on first use: the Sanic workers import this module through the
+# blueprints, but only the SAJE worker renders reports. See warm_up for preparing the worker up front.
 
 META_PATH = "data/meta_data.json"
+BLOCKS_DIR = "data/blocks"
+# proto4 only asks for thoughts once the draft has this many characters
+THOUGHT_MIN_DRAFT = 20
+# What warm_up prepares before the SAJE worker takes its first job, empty to start cold
+WARM_UP_STEPS = [step.strip() for step in os.getenv("SAJE_WARM_UP", "templates,clients,browser").split(",")
+                 if step.strip()]
+
+_env = None
+_browser = None  # (thread ID, playwright, browser) of the Chromium kept open by warm_up
 
 
 def store_information(file_path, information):
@@ -27,7 +43,7 @@ def store_information(file_path, information):
     all_metadata = {}
     if os.path.exists(META_PATH):
         try:
-            with open(META_PATH, "r", encoding="utf-8") as f:
+            with metrics.timer("apr_metadata_io_seconds", operation="read"), open(META_PATH, "r", encoding="utf-8") as f:
                 content = f.read().strip()
                 if content:
                     all_metadata = json.loads(content)
@@ -53,20 +69,20 @@ def store_information(file_path, information):
 
     all_metadata[file_id] = metadata
 
-    with open(META_PATH, "w", encoding="utf-8") as f:
+    with metrics.timer("apr_metadata_io_seconds", operation="write"), open(META_PATH, "w", encoding="utf-8") as f:
         json.dump(all_metadata, f, indent=2)
     
     return file_id
 
 
-def create_pdf_report(file_id):
+def create_pdf_report(file_id, cancel_event=None):
     """Builds HTML from information in metadata and converts it to a PDF."""
     all_metadata = {}
     if not os.path.exists(META_PATH):
         print(f"Metadata file not found: {META_PATH}")
         return None
 
-    with open(META_PATH, "r") as f:
+    with metrics.timer("apr_metadata_io_seconds", operation="read"), open(META_PATH, "r") as f:
         content = f.read().strip()
         if content:
             all_metadata = json.loads(content)
@@ -79,7 +95,7 @@ def create_pdf_report(file_id):
     parsed_html = buildHtml(information)
     
     original_file_name = file_id.removesuffix('.pdf')
-    pdf_path = html_to_pdf(parsed_html, original_file_name)
+    pdf_path = html_to_pdf(parsed_html, original_file_name, cancel_event=cancel_event)
 
     # Update metadata with PDF creation stats
     stats = os.stat(pdf_path)
@@ -87,23 +103,44 @@ def create_pdf_report(file_id):
     information["size_bytes"] = stats.st_size
     
     all_metadata[file_id] = information
-    with open(META_PATH, "w") as f:
+    with metrics.timer("apr_metadata_io_seconds", operation="write"), open(META_PATH, "w") as f:
         json.dump(all_metadata, f, indent=2)
 
     return pdf_path
 
 
-def GenerateReport(file):
+def GenerateReport(file, progress=None, cancel_event=None, saje_client=None):
     """
     Extracts information from a file, stores it in a metadata file,
-    and removes the original file.
+    and removes the original file. Speech-to-text JSON uploads are first
+    converted to a transcript. The LLM gets a normalized copy of the
+    transcript (see normalization.py); the metadata keeps the original.
+    When run by SAJE, the editors' Blocks and thoughts are prefetched in low-priority follow-up jobs.
     Returns the ID for the newly created entry.
     """
     try:
-        information = extractInformation(file)
+        if is_transcription(file):
+            _ingest_transcription(file)
+        with open(file, 'r') as f:
+            normalization = normalize(f.read())
+        information = extractInformation(file, cancel_event=cancel_event, progress=progress,
+                                         normalization=normalization)
+        if information is None:
+            raise JobCancelled(getattr(cancel_event, "reason", None) or "cancelled")
         file_id = store_information(file, information)
+        store_normalization(file_id, normalization)
+        _index_transcript(file_id, file)
         remove_file(file)
+        if saje_client:
+            speculate(saje_client, file_id)
         return file_id
+    except JobCancelled as e:
+        # A cancelled upload is discarded, a timed out one stays available for a retry
+        if e.reason == "timeout":
+            move_file(file)
+        else:
+            remove_file(file)
+        raise
     except Exception as e:
         if DEBUG:
             print(f"[GenerateReport] Exception occurred:\n{e}")
@@ -111,6 +148,29 @@ def GenerateReport(file):
         return None
 
 
+def _ingest_transcription(file):
+    """Replaces a speech-to-text JSON upload by its transcript, keeping the word timings next to the report."""
+    # Same ID as store_information will give the report
+    file_id = os.path.basename(file) + ".pdf"
+    start = time.perf_counter()
+    counts = ingest_transcription(file, file, file_id)
+    technical_log(
+        "stt-ingestion",
+        dataID=file_id,
+        performance_metric={**counts, "duration_ms": round((time.perf_counter() - start) * 1000, 2)},
+    )
+
+
+def _index_transcript(file_id, file):
+    """Builds the passage index used for thought prompts. Missing indexes are rebuilt on demand."""
+    try:
+        with open(file, 'r') as f:
+            build_passage_index(file_id, f.read())
+    except Exception as e:
+        if DEBUG:
+            print(f"[GenerateReport] Could not index transcript of {file_id}: {e}")
+
+
 def move_file(file, dest_dir="./tmp/error"):
     """Moves passed file to the /tmp/error folder."""
     try:
@@ -135,7 +195,7 @@ def update_metadata(updated_entry: dict, meta_path="./data/meta_data.json"):
     file_id = updated_entry["ID"]
 
     if os.path.exists(meta_path):
-        with open(meta_path, "r", encoding="utf-8") as f:
+        with metrics.timer("apr_metadata_io_seconds", operation="read"), open(meta_path, "r", encoding="utf-8") as f:
             try:
                 metadata = ujson.load(f)
             except Exception as e:
@@ -149,7 +209,7 @@ def update_metadata(updated_entry: dict, meta_path="./data/meta_data.json"):
     metadata[file_id] = metadata.get(file_id, {})
     metadata[file_id].update(updated_data)
 
-    with open(meta_path, "w", encoding="utf-8") as f:
+    with metrics.timer("apr_metadata_io_seconds", operation="write"), open(meta_path, "w", encoding="utf-8") as f:
         ujson.dump(metadata, f, indent=2)
 
 
@@ -163,7 +223,7 @@ def delete_metadata_entry(file_id: str, meta_path="./data/meta_data.json") -> bo
         return False
 
     try:
-        with open(meta_path, "r", encoding="utf-8") as f:
+        with metrics.timer("apr_metadata_io_seconds", operation="read"), open(meta_path, "r", encoding="utf-8") as f:
             metadata = json.load(f)
     except Exception as e:
         print(f"[delete_metadata_entry] Error reading metadata: {e}")
@@ -172,8 +232,13 @@ def delete_metadata_entry(file_id: str, meta_path="./data/meta_data.json") -> bo
     del metadata[file_id]
 
     try:
-        with open(meta_path, "w", encoding="utf-8") as f:
+        with metrics.timer("apr_metadata_io_seconds", operation="write"), open(meta_path, "w", encoding="utf-8") as f:
             json.dump(metadata, f, indent=2)
+        remove_file(_blocks_path(file_id))
+        remove_passage_index(file_id)
+        remove_timings(file_id)
+        remove_normalization(file_id)
+        prefetch.cache.discard(file_id)
         print(f"[delete_metadata_entry] Deleted ID: {file_id}")
         return True
     except Exception as e:
@@ -193,26 +258,139 @@ def remove_file(file):
             print(f"Error removing file {file}: {e}")
 
 
-def html_to_pdf(html_string, file):
-    """Converts an HTML string to a PDF file."""
+def html_to_pdf(html_string, file, cancel_event=None):
+    """
+    Converts an HTML string to a PDF file.
+    A passed cancel_event is checked between the browser steps and its deadline bounds the page timeouts.
+    """
     file_name = os.path.basename(file)
     output_pdf_path = os.path.join('./data/verwerkt', f"{file_name}.pdf")
-    with sync_playwright() as p:
-        browser = p.chromium.launch()
-        page = browser.new_page()
+    _raise_if_cancelled(cancel_event)
+    browser = _persistent_browser()
+    with metrics.timer("apr_pdf_render_seconds"), tracing.span("pdf.render", warm=browser is not None):
+        if browser is not None:
+            _render_pdf(browser, html_string, output_pdf_path, cancel_event)
+        else:
+            from playwright.sync_api import sync_playwright
+
+            with sync_playwright() as p:
+                browser = p.chromium.launch()
+                try:
+                    _render_pdf(browser, html_string, output_pdf_path, cancel_event)
+                finally:
+                    browser.close()
+    return output_pdf_path
+
+
+def _render_pdf(browser, html_string, output_pdf_path, cancel_event=None):
+    # Every page gets its own browser context, so reports rendered in a kept-open browser don't share state
+    page = browser.new_page()
+    try:
+        remaining = getattr(cancel_event, "remaining", lambda: None)()
+        if remaining is not None:
+            page.set_default_timeout(max(remaining, 1.0) * 1000)
         page.set_content(html_string)
+        _raise_if_cancelled(cancel_event)
         page.pdf(path=output_pdf_path, format='A4', print_background=True)
+    finally:
+        page.close()
+
+
+def _launch_browser():
+    """Starts the Chromium that html_to_pdf reuses on this thread, see warm_up."""
+    global _browser
+    from playwright.sync_api import sync_playwright
+
+    _close_browser()
+    playwright = sync_playwright().start()
+    try:
+        _browser = (threading.get_ident(), playwright, playwright.chromium.launch())
+    except Exception:
+        playwright.stop()
+        raise
+    return _browser[2]
+
+
+def _persistent_browser():
+    """
+    The kept-open Chromium, or None when there is none. Playwright's sync API is bound to the thread
+    that started it, so other threads render with a browser of their own.
+    """
+    if _browser is None or _browser[0] != threading.get_ident():
+        return None
+    if _browser[2].is_connected():
+        return _browser[2]
+    print("[APR] Kept-open browser disconnected, relaunching")
+    try:
+        return _launch_browser()
+    except Exception as e:
+        print(f"[APR] Relaunching the browser failed, rendering with a new one: {e}")
+        return None
+
+
+@atexit.register
+def _close_browser():
+    global _browser
+    if _browser is None:
+        return
+    _, playwright, browser = _browser
+    _browser = None
+    try:
         browser.close()
-    return output_pdf_path
+        playwright.stop()
+    except Exception as e:
+        print(f"[APR] Closing the browser failed: {e}")
+
+
+def warm_up():
+    """
+    Prepares the SAJE worker for its first job (see SAJE_WARM_UP): loads the prompt and report templates,
+    imports the provider SDKs with their clients and starts the Chromium that html_to_pdf keeps reusing.
+    A step that fails is logged and skipped; the job that needs it then starts cold.
+
+    :return: Duration in seconds per completed step.
+    """
+    steps = {
+        "templates": lambda: (shared_engine(), _template_env().get_template("pvtemplate.html")),
+        "clients": lambda: shared_engine().warm_up(),
+        "browser": _launch_browser,
+    }
+    durations = {}
+    for name in WARM_UP_STEPS:
+        if name not in steps:
+            print(f"[APR] Unknown warm-up step '{name}', expected one of {', '.join(steps)}")
+            continue
+        start = time.perf_counter()
+        try:
+            steps[name]()
+        except Exception as e:
+            print(f"[APR] Warm-up step '{name}' failed: {e}")
+            continue
+        durations[name] = round(time.perf_counter() - start, 4)
+    return durations
+
+
+def _raise_if_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise JobCancelled(getattr(cancel_event, "reason", None) or "cancelled")
 
 
-def extractInformation(file, cancel_event=None):
-    """Extracts structured information from a raw text file, with optional cancellation."""
-    engine = PromptingEngine(API_DICT, "src/prompting/templates.json")
+def extractInformation(file, cancel_event=None, progress=None, normalization=None):
+    """
+    Extracts structured information from a raw text file, with optional cancellation.
+    When a SAJE `progress` reporter is passed, an update is emitted per completed field
+    and (throttled) per streamed chunk of the proces-verbaal.
+    Preamble fields that the rule-based extraction (prompting/preextract.py) reads with enough
+    confidence are taken from there without asking the LLM. With a `normalization` of the file,
+    its normalized text is sent instead of the file as is.
+    """
+    engine = shared_engine()
     sessieID = str(uuid4())
     
     with open(file, 'r') as f:
-        verhoor = f.read()
+        original = f.read()
+    verhoor = normalization.text if normalization is not None else original
+    transcript_calls = 0
 
     prompts = {
         "datum": "Wat is de datum van het verhoor? Geef alleen de datum in de vorm van [dag]-[maand]-[jaar]",
@@ -227,17 +405,41 @@ def extractInformation(file, cancel_event=None):
     }
 
     information = {}
+    total_steps = len(prompts) + 1  # Every field plus the proces-verbaal
+    preextracted = preextract(verhoor)
+    outcomes = {}
 
     for key, prompt_text in prompts.items():
         if cancel_event and cancel_event.is_set():
             print(f"[extractInformation] Cancelled during '{key}' extraction.")
             return None  # or: return information to keep partial results
 
-        start_time = datetime.now()
+        rule = preextracted.get(key)
+        if rule is not None and rule["confidence"] >= PREEXTRACT_THRESHOLD:
+            administrative_log(
+                "rule-extraction",
+                sessieID=sessieID,
+                input=prompt_text,
+                results=rule["value"],
+                model=f"rule:{rule['rule']}",
+                confidence=rule["confidence"],
+            )
+            information[key] = rule["value"]
+            outcomes[key] = "skipped"
+            metrics.inc("apr_preextract_fields_total", field=key, outcome="skipped")
+            if progress:
+                progress(key, done=len(information), total=total_steps)
+            continue
+        if key in PREEXTRACT_FIELDS:
+            outcomes[key] = "below_threshold" if rule is not None else "no_match"
+            metrics.inc("apr_preextract_fields_total", field=key, outcome=outcomes[key])
 
+        start_time = datetime.now()
 
-        prompt = f"{prompt_text}\n\n\nVerhoor:\n{verhoor}"
-        res = engine.generate_response("verhoor-vragen-gpt-4o", prompt=prompt)
+        # The transcript goes before the question, so the calls share a prefix the provider can cache
+        transcript_calls += 1
+        res = engine.generate_response("verhoor-veld-gpt-4o", cancel_event=cancel_event, verhoor=verhoor,
+                                       prompt=prompt_text)
 
         end_time = datetime.now()
         time_to_complete = (end_time - start_time).total_seconds()
@@ -251,6 +453,18 @@ def extractInformation(file, cancel_event=None):
             time_to_complete=time_to_complete,
         )
         information[key] = res
+        if progress:
+            progress(key, done=len(information), total=total_steps)
+
+    technical_log(
+        "pre-extraction",
+        sessieID=sessieID,
+        performance_metric={
+            "fields": {key: {**preextracted.get(key, {}), "outcome": outcome} for key, outcome in outcomes.items()},
+            "llm_calls_skipped": sum(outcome == "skipped" for outcome in outcomes.values()),
+            "threshold": PREEXTRACT_THRESHOLD,
+        },
+    )
 
     # Final summary generation
     if cancel_event and cancel_event.is_set():
@@ -258,7 +472,16 @@ def extractInformation(file, cancel_event=None):
         return None  # or: return information
 
     start_time = datetime.now()
-    information["proces_verbaal"] = engine.generate_response("verhoor-samenvatting-gpt-4o", prompt=verhoor)
+    chunks = []
+    transcript_calls += 1
+    for chunk in engine.stream_response("verhoor-samenvatting-gpt-4o", cancel_event=cancel_event, prompt=verhoor):
+        chunks.append(chunk)
+        if progress:
+            progress("proces_verbaal", done=len(prompts), total=total_steps,
+                     force=False, chunks=len(chunks))
+    information["proces_verbaal"] = "".join(chunks)
+    if progress:
+        progress("proces_verbaal", done=total_steps, total=total_steps, chunks=len(chunks))
     end_time = datetime.now()
     time_to_complete = (end_time - start_time).total_seconds()
     administrative_log(
@@ -270,15 +493,335 @@ def extractInformation(file, cancel_event=None):
         engine=str(engine),
         time_to_complete=time_to_complete,
     )
+    if normalization is not None:
+        _log_normalization(sessieID, original, normalization, transcript_calls)
 
     return information
 
 
+def _log_normalization(sessieID, original, normalization, transcript_calls):
+    """Reports the prompt tokens the normalized transcript saved over the calls that sent it."""
+    saved = normalization.tokens_saved(original) * transcript_calls
+    metrics.inc("apr_prompt_tokens_saved_total", saved)
+    technical_log(
+        "transcript-normalization",
+        sessieID=sessieID,
+        performance_metric={
+            **normalization.counts,
+            "chars": {"original": len(original), "normalized": len(normalization.text)},
+            "tokens_estimated": {"original": estimate_tokens(original), "normalized": estimate_tokens(normalization.text)},
+            "transcript_calls": transcript_calls,
+            "tokens_saved": saved,
+        },
+    )
+
+
+def _blocks_path(file_id):
+    return os.path.join(BLOCKS_DIR, f"{os.path.basename(file_id)}.json")
+
+
+def _input_hash(original_input):
+    return hashlib.sha256(original_input.encode("utf-8")).hexdigest()
+
+
+def load_cached_blocks(file_id, original_input=None):
+    """
+    Returns the stored Blocks of a report, or None when there are none or when they were
+    extracted from a different original_input than the report currently has.
+    """
+    if original_input is None:
+        try:
+            with metrics.timer("apr_metadata_io_seconds", operation="read"), open(META_PATH, "r", encoding="utf-8") as f:
+                original_input = ujson.load(f).get(file_id, {}).get("original_input")
+        except (FileNotFoundError, ValueError):
+            return None
+    if not original_input:
+        return None
+
+    try:
+        with open(_blocks_path(file_id), "r", encoding="utf-8") as f:
+            cached = ujson.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if cached.get("input_hash") != _input_hash(original_input):
+        return None
+    return cached.get("data")
+
+
+def open_blocks(file_id):
+    """
+    The stored Blocks of a report for its proto3 editor, None when they still have to be extracted.
+    Counts the opening as a prefetch hit when they were prefetched and not opened before, and as a miss
+    when they aren't there (see prefetch.SpeculationCache.claim).
+    """
+    try:
+        original_input = _load_original_input(file_id)
+    except LookupError:
+        return None
+    cached = load_cached_blocks(file_id, original_input)
+    if cached is not None:
+        prefetch.cache.claim("blocks", file_id, _input_hash(original_input))
+    elif prefetch.enabled("blocks"):
+        prefetch.record("blocks", "miss")
+    return cached
+
+
+def store_blocks(file_id, original_input, data):
+    """Stores the Blocks of a report next to the hash of the input they were extracted from."""
+    os.makedirs(BLOCKS_DIR, exist_ok=True)
+    path = _blocks_path(file_id)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        ujson.dump({"input_hash": _input_hash(original_input), "data": data}, f)
+    os.replace(tmp_path, path)
+
+
+def extractBlocks(file_id, cancel_event=None):
+    """
+    Extracts the proto3 Blocks (mentioned names and question/verbatim answer pairs) of a report.
+    Results are cached per report and reused until its original_input changes.
+    """
+    with metrics.timer("apr_metadata_io_seconds", operation="read"), open(META_PATH, "r", encoding="utf-8") as f:
+        item_metadata = ujson.load(f).get(file_id)
+    if not item_metadata:
+        raise ValueError(f"No metadata found for {file_id}")
+
+    original_input = item_metadata.get("original_input")
+    if not original_input:
+        raise ValueError(f"No original_input found for {file_id}")
+
+    cached = load_cached_blocks(file_id, original_input)
+    if cached is not None:
+        return cached
+    # The normalized transcript is shorter; its verbatim answers are mapped back to the original below
+    normalization = load_normalization(file_id, original_input)
+    transcript = normalization.text if normalization is not None else original_input
+
+    json_prompt = '''
+    Analyze the interrogation transcript above.
+    Your task is to extract two types of information:
+    1.  A list of all proper names of individuals mentioned.
+    2.  Pairs of questions asked and the verbatim answers given in response.
+
+    Return the output as a single valid JSON object.
+    The JSON object should have:
+    - A key "extracted names" with a value that is a list of strings (the names).
+    - For each question-answer pair you find, the question should be a key, and its value should be a list containing a single string: the verbatim answer.
+
+    Example of final JSON structure:
+    {
+      "extracted names": ["John Doe", "Officer Smith"],
+      "What is your full name?": ["My name is John Doe."],
+      "Where were you on the night of October 31st?": ["I was at a friend's party."]
+    }
+
+    Your response should be ONLY the JSON object. Do not include any other text or explanations.
+    '''
+
+    engine = shared_engine()
+    start_time = datetime.now()
+    try:
+        # Same template and transcript as the field questions of extractInformation, whose cached prefix it reuses
+        response_str = engine.generate_response("verhoor-veld-gpt-4o", cancel_event=cancel_event, verhoor=transcript,
+                                                prompt=json_prompt)
+        # Clean the response to get only the JSON
+        response_str = response_str.strip()
+        if response_str.startswith("```json"):
+            response_str = response_str[7:]
+        if response_str.endswith("```"):
+            response_str = response_str[:-3]
+        response_str = response_str.strip()
+
+        response_data = ujson.loads(response_str)
+        if normalization is not None:
+            _restore_verbatim(response_data, normalization, original_input)
+    except JobCancelled:
+        raise
+    except Exception as e:
+        # Shown in the editor, but not cached so the next request tries again
+        print(f"Failed to get or parse structured data from LLM: {e}")
+        return {
+            "extracted names": [],
+            "responses to shown item 1": [],
+            "gestelde vragen": [f"Error: Could not process text. Details: {e}"]
+        }
+
+    administrative_log(
+        "GPT-communication",
+        dataID=file_id,
+        input="Blocks",
+        results=response_data,
+        model="GPT4o",
+        engine=str(engine),
+        time_to_complete=(datetime.now() - start_time).total_seconds(),
+    )
+    store_blocks(file_id, original_input, response_data)
+    return response_data
+
+
+def _restore_verbatim(response_data, normalization, original_input):
+    """Replaces the answers quoted from the normalized transcript by the original passages."""
+    for question, answers in response_data.items():
+        if question == "extracted names" or not isinstance(answers, list):
+            continue
+        response_data[question] = [
+            (normalization.original_quote(original_input, answer) or answer) if isinstance(answer, str) else answer
+            for answer in answers
+        ]
+
+
+def _load_original_input(file_id):
+    """Reads the transcript of a report, raising LookupError with a user-facing message when it is missing."""
+    try:
+        with metrics.timer("apr_metadata_io_seconds", operation="read"), open(META_PATH, "r", encoding="utf-8") as f:
+            meta_data = ujson.load(f)
+    except FileNotFoundError:
+        raise LookupError("metadata.json niet gevonden.")
+    except Exception as e:
+        raise LookupError(f"Fout bij laden metadata: {e}")
+
+    item_metadata = meta_data.get(file_id)
+    if not item_metadata or "original_input" not in item_metadata:
+        raise LookupError(f"Geen originele input gevonden voor {file_id} in metadata.")
+    return item_metadata["original_input"]
+
+
+def generateThoughts(file_id, context, cancel_event=None):
+    """
+    Generates the proto4 thought bubbles for the draft proces-verbaal in `context`, from the
+    transcript passages relevant to the paragraph being written.
+
+    :param context: The preamble fields (datum, tijd, locatie, verdachte) and the draft as proces_verbaal.
+    :raises LookupError: When the report has no transcript.
+    """
+    datum = context.get("datum", "N/A")
+    tijd = context.get("tijd", "N/A")
+    locatie = context.get("locatie", "N/A")
+    verdachte = context.get("verdachte", "N/A")
+    proces_verbaal_draft = context.get("proces_verbaal", "")  # User's current draft
+
+    original_input = _load_original_input(file_id)
+    # Only the transcript passages relevant to the paragraph being written
+    passages = relevant_passages(file_id, original_input, normalize_section(proces_verbaal_draft))
+
+    llm_prompt = f"""
+    Je bent een assistent die de gebruiker helpt met het opstellen van een proces-verbaal.
+    Analyseer de volgende relevante passages uit de originele transcriptie van een verhoor en de huidige conceptversie van het proces-verbaal van de gebruiker.
+    Genereer 3 tot 5 beknopte en contextueel relevante gedachten die de gebruiker kunnen helpen bij het schrijven van het proces-verbaal.
+    Elke gedachte moet een korte zin of zinsnede zijn die een inzicht, een vraag, een mogelijke inconsistentie, een relevante observatie, of een alternatief perspectief biedt op basis van de verhoorpassages, in relatie tot wat al in het conceptproces-verbaal staat.
+    De gedachten moeten in het Nederlands zijn en als een JSON-array van strings worden geretourneerd.
+
+    Relevante passages uit de verhoortranscriptie:
+    ---
+    {passages}
+    ---
+
+    Huidig concept Proces-verbaal:
+    ---
+    Datum: {datum}
+    Tijd: {tijd}
+    Locatie: {locatie}
+    Verdachte: {verdachte}
+    Proces-verbaal tekst:
+    {proces_verbaal_draft}
+    ---
+
+    Geef alleen de JSON-array terug. Voorbeeld:
+    ["Overweeg de alibi-details van de verdachte.", "Zijn er inconsistenties in de tijdlijn?", "Welke motieven kunnen aanwezig zijn?", "Vergelijk met soortgelijke zaken.", "Focus op de emotionele toestand van getuigen."]
+    """
+
+    response_str = shared_engine().generate_response("thought-generator", cancel_event=cancel_event, prompt=llm_prompt)
+
+    # Clean the response to get only the JSON
+    response_str = response_str.strip()
+    if response_str.startswith("```json"):
+        response_str = response_str[7:]
+    if response_str.endswith("```"):
+        response_str = response_str[:-3]
+    response_str = response_str.strip()
+
+    thoughts = ujson.loads(response_str)
+    if not isinstance(thoughts, list):
+        raise ValueError("LLM-antwoord is geen lijst met gedachten.")
+    return thoughts
+
+
+def speculate(saje_client, file_id, kinds=None):
+    """
+    Queues the prefetch jobs of a report with low priority, so its editor opens without waiting for
+    the LLM. Returns the kinds that were queued.
+
+    :param kinds: The kinds to prefetch ("blocks" for proto3, "thoughts" for proto4), default all enabled ones.
+    """
+    jobs = {
+        "blocks": (speculateBlocks, "Prefetching Blocks"),
+        "thoughts": (speculateThoughts, "Prefetching thoughts"),
+    }
+    queued = []
+    for kind in kinds or prefetch.PREFETCH_KINDS:
+        if kind not in jobs or not prefetch.enabled(kind):
+            continue
+        function, description = jobs[kind]
+        saje_client.send(f"{file_id}:{kind}", function, description, file_id, low_priority=True)
+        prefetch.record(kind, "queued")
+        queued.append(kind)
+    return queued
+
+
+def speculateBlocks(file_id, cancel_event=None):
+    """
+    Prefetch job of the proto3 Blocks. They are stored with the report as usual (see extractBlocks);
+    the speculation cache records that they were computed ahead, for the hit and wasted counts.
+    """
+    original_input = _load_original_input(file_id)
+    key = _input_hash(original_input)
+    if prefetch.cache.contains("blocks", file_id, key) or load_cached_blocks(file_id, original_input) is not None:
+        return None  # Already there, e.g. from an earlier selection or because the report was opened before
+    extractBlocks(file_id, cancel_event=cancel_event)
+    # Failed extractions aren't stored, and neither are they a prefetched result
+    if load_cached_blocks(file_id, original_input) is not None:
+        prefetch.cache.put("blocks", file_id, key)
+    return None
+
+
+def speculateThoughts(file_id, cancel_event=None):
+    """
+    Prefetch job of the thoughts proto4 asks for when it opens a report: those for its stored draft,
+    which are kept in the speculation cache under the draft section (see normalize_section).
+    """
+    with metrics.timer("apr_metadata_io_seconds", operation="read"), open(META_PATH, "r", encoding="utf-8") as f:
+        item_metadata = ujson.load(f).get(file_id) or {}
+    draft = (item_metadata.get("proces_verbaal") or "").strip()
+    if len(draft) < THOUGHT_MIN_DRAFT:
+        return None
+    section = normalize_section(draft)
+    if prefetch.cache.contains("thoughts", file_id, section):
+        return None
+    # The context the editor sends for an unchanged report
+    context = {field: (item_metadata.get(field) or "").strip() for field in ("datum", "tijd", "locatie", "verdachte")}
+    thoughts = generateThoughts(file_id, {**context, "proces_verbaal": draft}, cancel_event=cancel_event)
+    prefetch.cache.put("thoughts", file_id, section, thoughts)
+    return None
+
+
+def _template_env():
+    global _env
+    if _env is None:
+        from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+        _env = Environment(
+            loader=FileSystemLoader("templates"),
+            autoescape=select_autoescape(['html', 'xml'])
+        )
+    return _env
+
+
 def buildHtml(information):
     """Builds the HTML for the report from extracted information."""
     image_path = "../static/media/PolitieLogoFullTransparant.png"
     
-    template = env.get_template("pvtemplate.html")
+    template = _template_env().get_template("pvtemplate.html")
     
     context = {
         "DATUM": information.get("datum"),
@@ -1,30 +1,123 @@
+import atexit
+import gzip
+import hashlib
 import json
 import logging
 import os
+import queue
+import re
+import time
 import uuid
 from datetime import datetime, timezone
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from logarchive import ARCHIVE_DIRNAME, PAYLOADS_DIRNAME, archive_rotated
+
+# "async" (default) hands records to a listener thread that formats and writes them,
+# "sync" formats and writes them on the calling thread.
+LOG_MODE = os.getenv("APR_LOG_MODE", "async")
+# Records waiting for the listener thread; what happens beyond this is the logger's overflow policy.
+LOG_QUEUE_SIZE = 10_000
+# Maximum number of records written per flush of the log file.
+LOG_BATCH_SIZE = 256
+# Logged values larger than this (serialized) are kept in the payload store and referenced by hash.
+PAYLOAD_THRESHOLD_BYTES = int(os.getenv("APR_LOG_PAYLOAD_BYTES", "1024"))
+# Fields holding the input of the logged action, whose hash and size go into the standard fields.
+INPUT_FIELDS = ("input", "raw_input", "updated_data")
+# Fields with the logged text (prompts, transcripts, LLM output) that may be moved to the payload store.
+# Structured fields such as performance_metric and span stay in the record, so they can be queried.
+PAYLOAD_FIELDS = (*INPUT_FIELDS, "prompt", "output", "results", "params")
+# Whether rotated log files are compacted into the archive (see logarchive.py) instead of only being dropped.
+ARCHIVE_LOGS = os.getenv("APR_LOG_ARCHIVE", "1") != "0"
+
+# ---- Payload store ----------------------------------------------------------
+
+
+class PayloadStore:
+    """
+    Content-addressed store for large logged values. Each distinct value is written once, gzipped,
+    as `<directory>/<hash[:2]>/<hash>.json.gz`; log records reference it as
+    {"input_content_hash": <sha256>, "dataSize_bytes": <size>} instead of repeating it.
+    Unreferenced payloads are removed by `python src/logarchive.py prune`, not while logging.
+    """
+
+    def __init__(self, directory, threshold=PAYLOAD_THRESHOLD_BYTES):
+        self.directory = directory
+        self.threshold = threshold
+
+    def path(self, content_hash):
+        return os.path.join(self.directory, content_hash[:2], f"{content_hash}.json.gz")
+
+    def put(self, data):
+        """Stores serialized data unless it is already present. Returns its sha256 hex digest."""
+        content_hash = hashlib.sha256(data).hexdigest()
+        path = self.path(content_hash)
+        try:
+            os.utime(path)  # Referenced again: a prune leaves recently used payloads alone
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with gzip.open(tmp_path, "wb", compresslevel=6) as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return content_hash
+
+    def get(self, content_hash):
+        """Returns a stored value, or raises KeyError for unknown (or malformed) hashes."""
+        if not re.fullmatch(r"[0-9a-f]{64}", content_hash or ""):
+            raise KeyError(content_hash)
+        try:
+            with gzip.open(self.path(content_hash), "rb") as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            raise KeyError(content_hash)
+
+    def offload(self, log_object):
+        """Replaces the large values of the PAYLOAD_FIELDS of a log record by references, in place."""
+        for key in PAYLOAD_FIELDS:
+            value = log_object.get(key)
+            if not isinstance(value, (str, dict, list)):
+                continue
+            # Cheap lower bound before serializing: a str of n chars is at least n bytes
+            if isinstance(value, str) and len(value) < self.threshold // 4:
+                continue
+            data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+            if len(data) < self.threshold:
+                continue
+
+            reference = {"input_content_hash": self.put(data), "dataSize_bytes": len(data)}
+            log_object[key] = reference
+            if key in INPUT_FIELDS and "input_content_hash" not in log_object:
+                log_object.update(reference)
 
 # ---- Minimal JSON formatter -------------------------------------------------
 
 
 class JsonFormatter(logging.Formatter):
-    def __init__(self, fields=None):
+    def __init__(self, fields=None, payload_store=None):
         super().__init__()
         self.fields = fields or []
+        self.payload_store = payload_store
 
     def format(self, record):
         log_object = {
-            "datetime_utc": datetime.now(timezone.utc).isoformat(),
+            # Time of the log call, which may be a while before formatting in async mode
+            "datetime_utc": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
             "level": record.levelname,
             "logger": record.name,
         }
 
         if isinstance(record.msg, dict):
-            log_object.update(record.msg)
+            log_object["activiteitID"] = str(uuid.uuid4())
+            log_object.update(_clean(record.msg))
         else:
             log_object["message"] = record.getMessage()
 
+        if self.payload_store is not None:
+            try:
+                self.payload_store.offload(log_object)
+            except (OSError, TypeError, ValueError):
+                pass  # Unserializable values are handled by the fallback below
+
         # Filter to specified fields and remove any keys with None values.
         if self.fields:
             payload = {
@@ -65,6 +158,151 @@ DEFAULT_LOG_FIELDS = [
     "out_of_scope_usage_signal", "message"
 ]
 
+# ---- Asynchronous logging ---------------------------------------------------
+
+
+class BatchingRotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler that leaves flushing to its listener while a batch is being written.
+    At a rollover the rotated files are compacted into the archive: what other processes wrote to them
+    since the last rollover, including the oldest file before it is deleted, and then the newly rotated
+    file.
+    """
+
+    batching = False
+    archive_directory = None
+
+    def flush(self):
+        if not self.batching:
+            super().flush()
+
+    def doRollover(self):
+        self._archive()
+        super().doRollover()
+        self._archive()
+
+    def _archive(self):
+        if self.archive_directory is None or self.backupCount <= 0:
+            return
+        try:
+            archive_rotated(self.baseFilename, self.archive_directory, self.backupCount)
+        except OSError as e:
+            print(f"[APRLogger] Could not archive the rotated files of {self.baseFilename}: {e}")
+
+
+class RecordQueueHandler(QueueHandler):
+    """
+    Puts records on the listener's queue as they are: no formatting on the calling thread.
+
+    :param overflow: What to do when the queue is full: "drop" the record (counted and reported
+                     by the listener), or write it on the calling thread through "sync".
+    """
+
+    def __init__(self, log_queue, overflow="drop", fallback=None):
+        super().__init__(log_queue)
+        self.overflow = overflow
+        self.fallback = fallback
+        self.dropped = 0
+
+    def prepare(self, record):
+        if isinstance(record.msg, dict):
+            record.msg = _snapshot(record.msg)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.overflow == "sync" and self.fallback is not None:
+                self.fallback.handle(_to_record(record))
+            else:
+                self.dropped += 1
+
+    def submit(self, level, msg):
+        """Fast path for `_log`: enqueues the bare call, its LogRecord is made on the listener thread."""
+        self.enqueue((self.name, level, time.time(), _snapshot(msg)))
+
+
+def _to_record(item):
+    """Turns a call queued by RecordQueueHandler.submit into a LogRecord."""
+    if isinstance(item, logging.LogRecord):
+        return item
+    name, level, created, msg = item
+    record = logging.LogRecord(name, level, "", 0, msg, None, None)
+    record.created = created
+    return record
+
+
+class BatchQueueListener(QueueListener):
+    """
+    Listener thread that drains up to LOG_BATCH_SIZE records at a time and flushes the file once per
+    batch. Records dropped by its queue handler are reported in the log as "log-overflow" events.
+    """
+
+    def __init__(self, log_queue, handler, source, batch_size=LOG_BATCH_SIZE):
+        super().__init__(log_queue, handler)
+        self.handler = handler
+        self.source = source
+        self.batch_size = batch_size
+        self.reported_dropped = 0
+
+    def prepare(self, record):
+        return _to_record(record)
+
+    def _monitor(self):
+        while True:
+            batch = [self.dequeue(True)]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.dequeue(False))
+                except queue.Empty:
+                    break
+            if not self._write(batch):
+                return
+
+    def _write(self, batch):
+        """Writes a batch, returns False when it contained the stop sentinel."""
+        self.handler.batching = True
+        try:
+            for record in batch:
+                if record is self._sentinel:
+                    return False
+                self.handle(record)
+            self._report_overflow()
+        finally:
+            self.handler.batching = False
+            self.handler.flush()
+        return True
+
+    def _report_overflow(self):
+        dropped = self.source.dropped - self.reported_dropped
+        if dropped <= 0:
+            return
+        self.reported_dropped += dropped
+        self.handle(logging.LogRecord(
+            self.source.name or "APRLogger", logging.WARNING, __file__, 0,
+            {"event_type": "technical", "event_source": "log-overflow",
+             "message": f"{dropped} log records dropped, queue full"},
+            None, None,
+        ))
+
+    def enqueue_sentinel(self):
+        # Blocks when the queue is full, so the sentinel is never lost
+        self.queue.put(self._sentinel)
+
+
+_listeners = []
+_queue_handlers = {}  # By logger name
+
+
+def shutdown_logging():
+    """Writes all queued records and stops the listener threads. Registered to run at exit."""
+    while _listeners:
+        _listeners.pop().stop()
+
+
+atexit.register(shutdown_logging)
+
 # ---- Logger setup -----------------------------------------------------------
 
 
@@ -75,7 +313,14 @@ def _get_log_path(prefix, directory="./tmp/logs"):
     return os.path.join(directory, filename)
 
 
-def setup_logger(*, name, log_file, level=logging.INFO, log_fields=None):
+def setup_logger(*, name, log_file, level=logging.INFO, log_fields=None, mode=None, overflow="drop",
+                 payload_store=None, archive=ARCHIVE_LOGS):
+    """
+    :param mode: "async" or "sync", defaults to LOG_MODE.
+    :param overflow: Policy of an async logger with a full queue, see RecordQueueHandler.
+    :param payload_store: PayloadStore for large values, which are logged inline without one.
+    :param archive: Whether rotated files are archived next to the log file, see logarchive.py.
+    """
     logger = logging.getLogger(name)
     logger.setLevel(level)
     logger.propagate = False
@@ -84,31 +329,51 @@ def setup_logger(*, name, log_file, level=logging.INFO, log_fields=None):
         return logger
 
     log_fields = log_fields or DEFAULT_LOG_FIELDS
-    formatter = JsonFormatter(log_fields)
+    formatter = JsonFormatter(log_fields, payload_store)
 
-    handler = RotatingFileHandler(
+    handler = BatchingRotatingFileHandler(
         log_file,
         maxBytes=10 * 1024 * 1024,  # 10MB
         backupCount=5,
         encoding="utf-8"
     )
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    if archive:
+        handler.archive_directory = os.path.join(os.path.dirname(log_file), ARCHIVE_DIRNAME)
+
+    if (mode or LOG_MODE) != "async":
+        logger.addHandler(handler)
+        return logger
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = RecordQueueHandler(log_queue, overflow=overflow, fallback=handler)
+    queue_handler.name = name
+    listener = BatchQueueListener(log_queue, handler, queue_handler)
+    listener.start()
+    _listeners.append(listener)
+    _queue_handlers[name] = queue_handler
+    logger.addHandler(queue_handler)
     return logger
 
 # ---- Logger Instances -------------------------------------------------------
 
+payload_store = PayloadStore(os.path.join(os.path.dirname(_get_log_path(prefix="technical")), PAYLOADS_DIRNAME))
+
 
 technical_logger = setup_logger(
     name="technical_logger",
     log_file=_get_log_path(prefix="technical"),
-    log_fields=DEFAULT_LOG_FIELDS
+    log_fields=DEFAULT_LOG_FIELDS,
+    payload_store=payload_store
 )
 
+# Audit records are never dropped: when the queue is full they are written by the caller
 administrative_logger = setup_logger(
     name="administrative_logger",
     log_file=_get_log_path(prefix="administrative"),
-    log_fields=DEFAULT_LOG_FIELDS
+    log_fields=DEFAULT_LOG_FIELDS,
+    overflow="sync",
+    payload_store=payload_store
 )
 
 # ---- Private helpers --------------------------------------------------------
@@ -133,15 +398,30 @@ def _clean(obj):
     return obj
 
 
+def _snapshot(obj):
+    """
+    Copies the dicts and lists of a logged value, which is formatted later on the listener thread,
+    so the caller may change or reuse them once the log call returned.
+    """
+    if isinstance(obj, dict):
+        return {k: _snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_snapshot(v) for v in obj]
+    return obj
+
+
 def _log(logger, level, event_type, event_source, data):
-    base = {
-        "activiteitID": str(uuid.uuid4()),
-        "event_type": event_type,
-        "event_source": event_source,
-    }
-    merged = {**base, **(data or {})}
-    cleaned = _clean(merged)
-    logger.log(level, cleaned)
+    if not logger.isEnabledFor(level):
+        return
+    # The activiteitID, cleaning and serialization are added by the formatter,
+    # which runs on the listener thread in async mode.
+    merged = {"event_type": event_type, "event_source": event_source, **(data or {})}
+    queue_handler = _queue_handlers.get(logger.name)
+    if queue_handler is not None:
+        queue_handler.submit(level, merged)
+    else:
+        # Made directly, skipping the stack walk of logger.log for caller info we don't log
+        logger.handle(logger.makeRecord(logger.name, level, "", 0, merged, None, None))
 
 # ---- Public API -------------------------------------------------------------
 
@@ -165,6 +445,11 @@ def administrative_log(event_source, **data):
          "administrative", event_source, data)
 
 
+def load_payload(content_hash):
+    """Returns a logged value that was moved to the payload store. Raises KeyError if it is unknown."""
+    return payload_store.get(content_hash)
+
+
 # ---- Example ----------------------------------------------------------------
 if __name__ == "__main__":
     print(f"Writing technical logs to: {_get_log_path(prefix='technical')}")
@@ -2,6 +2,8 @@
 from blueprints.endpoints import epts
 from blueprints.websocket import ws
 from saje import SajeClient, worker
+from APR import warm_up
+import metrics
 
 # Libraries
 import os
@@ -11,22 +13,27 @@ from sanic.request import Request
 from sanic.response import html, redirect, text
 from sanic_ext import Extend
 from multiprocessing import Manager
-from setup_env import APP_ACCES_KEY
+from setup_env import APP_ACCES_KEY, APR_ADMIN_KEY
 
 
 
 # Maak de app aan
 app = Sanic("apr_draft_3")
-app.static('/static', './static')
 app.blueprint(epts)
 app.blueprint(ws)
 Extend(app)
 
 @app.main_process_start
 async def start(app: Sanic):
+    metrics.reset()
     manager = Manager()
     app.shared_ctx.saje_queue = manager.Queue()
+    app.shared_ctx.saje_low_queue = manager.Queue()
+    app.shared_ctx.saje_batches = manager.dict()
     app.shared_ctx.job_status = manager.dict()
+    app.shared_ctx.saje_cancel = manager.dict()
+    app.shared_ctx.saje_inflight = manager.dict()
+    app.shared_ctx.saje_inflight_lock = manager.Lock()
     
 
 @app.main_process_ready
@@ -34,13 +41,30 @@ async def ready(app: Sanic):
     app.manager.manage(
         "SajeWorker", worker, {
             "saje_queue": app.shared_ctx.saje_queue,
-            "job_status_dict": app.shared_ctx.job_status
+            "job_status_dict": app.shared_ctx.job_status,
+            "cancelled_dict": app.shared_ctx.saje_cancel,
+            "inflight_dict": app.shared_ctx.saje_inflight,
+            "inflight_lock": app.shared_ctx.saje_inflight_lock,
+            "low_queue": app.shared_ctx.saje_low_queue,
+            "warm_up": warm_up,
         },
     )
 
+@app.after_server_start
+async def monitor_event_loop(app: Sanic):
+    app.add_task(metrics.monitor_event_loop(), name="event-loop-lag")
+
 @app.before_server_start
 async def setup_saje(app: Sanic):
-    app.ext.dependency(SajeClient(app.shared_ctx.saje_queue))
+    app.ext.dependency(SajeClient(
+        app.shared_ctx.saje_queue,
+        app.shared_ctx.saje_cancel,
+        app.shared_ctx.job_status,
+        app.shared_ctx.saje_inflight,
+        app.shared_ctx.saje_inflight_lock,
+        app.shared_ctx.saje_low_queue,
+        app.shared_ctx.saje_batches,
+    ))
 
 
 
@@ -80,7 +104,9 @@ for src, dst in REDIRECTS.items():
 async def authorize(request: Request):
     if request.method == "POST":
         submitted_key = request.form.get("key")
-        if submitted_key == APP_ACCES_KEY:
+        # The admin key also gives normal access, plus the admin websocket actions
+        is_admin = bool(APR_ADMIN_KEY) and submitted_key == APR_ADMIN_KEY
+        if submitted_key == APP_ACCES_KEY or is_admin:
             resp = redirect("/APR")
             resp.add_cookie(
                  "auth",
@@ -90,6 +116,8 @@ async def authorize(request: Request):
                 secure=False,  # Set to True if you're using HTTPS
                 samesite="Lax"
             )
+            if is_admin:
+                resp.add_cookie("admin", APR_ADMIN_KEY, path="/", httponly=True, secure=False, samesite="Lax")
             return resp
         return text("Invalid key", status=401)
 
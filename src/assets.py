@@ -0,0 +1,173 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+from setup_env import DEBUG
+
+try:
+    import brotli
+except ImportError:  # Optional, without it assets are served gzip-compressed only
+    brotli = None
+
+STATIC_DIR = "static"
+TEMPLATES_DIR = "templates"
+# Compressed variants by content hash, so they are built once and not again by every worker or restart
+CACHE_DIR = "./tmp/assets"
+# Re-read changed pages and assets on request, for working on the front-end without restarting
+DEV_RELOAD = os.getenv("APR_DEV_RELOAD", "1" if DEBUG else "0") == "1"
+
+COMPRESSIBLE = {".html", ".js", ".css", ".svg", ".json", ".txt", ".map"}
+MIN_COMPRESS_BYTES = 512
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+# Asset URLs in the pages carry the asset's version, so a versioned request can be cached for good;
+# unversioned ones (and the pages themselves) are revalidated with their ETag.
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+STATIC_URL = re.compile(r'((?:src|href)=")/static/([^"?#]+)(")')
+
+_static = {}  # path relative to STATIC_DIR -> Asset
+_pages = {}  # template name -> Page
+_lock = threading.RLock()  # Loading a page loads the assets it links
+
+
+class Asset:
+    """
+    A file served from memory with its precompressed variants.
+
+    :param path: The file on disk, whose modification is watched when DEV_RELOAD is on.
+    :param body: The content to serve, defaults to the file's content.
+    """
+
+    def __init__(self, path: str, body: bytes | None = None) -> None:
+        self.path = path
+        self.stat = _stat(path)
+        if body is None:
+            with open(path, "rb") as f:
+                body = f.read()
+        self.version = hashlib.sha256(body).hexdigest()[:16]
+        self.etag = f'"{self.version}"'
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.content_type = f"{content_type}; charset=utf-8" if content_type.startswith("text/") else content_type
+        self.bodies = {"identity": body}
+        if os.path.splitext(path)[1] in COMPRESSIBLE and len(body) >= MIN_COMPRESS_BYTES:
+            for encoding in ENCODINGS:
+                compressed = _compressed(body, self.version, encoding)
+                if len(compressed) < len(body):
+                    self.bodies[encoding] = compressed
+
+    def changed(self) -> bool:
+        return _stat(self.path) != self.stat
+
+    def select(self, accept_encoding: str) -> str:
+        """The best variant the client accepts, "identity" when it accepts no compressed one."""
+        accepted = set()
+        for part in accept_encoding.lower().split(","):
+            coding, _, params = part.partition(";")
+            if not re.fullmatch(r"q=0(\.0*)?", params.replace(" ", "")):  # q=0 means "not acceptable"
+                accepted.add(coding.strip())
+        for encoding in ENCODINGS:
+            if encoding in self.bodies and (encoding in accepted or "*" in accepted):
+                return encoding
+        return "identity"
+
+    def matches(self, if_none_match: str | None) -> bool:
+        """Whether the client's cached copy (If-None-Match) is this version, in any encoding."""
+        if not if_none_match:
+            return False
+        return if_none_match.strip() == "*" or any(
+            tag.strip().removeprefix("W/") == self.etag for tag in if_none_match.split(","))
+
+
+class Page(Asset):
+    """A page template, with its links to static assets rewritten to their current versions."""
+
+    def __init__(self, path: str) -> None:
+        with open(path, "r", encoding="utf-8") as f:
+            source = f.read()
+        self.versions = {}  # asset path -> version linked from this page
+
+        def versioned(match):
+            asset = static_asset(match.group(2))
+            if asset is None:
+                return match.group(0)
+            self.versions[match.group(2)] = asset.version
+            return f"{match.group(1)}/static/{match.group(2)}?v={asset.version}{match.group(3)}"
+
+        super().__init__(path, STATIC_URL.sub(versioned, source).encode("utf-8"))
+
+    def changed(self) -> bool:
+        return super().changed() or any(
+            getattr(static_asset(path), "version", None) != version for path, version in self.versions.items())
+
+
+def load(pages: list[str]) -> None:
+    """Reads all static assets and the given pages into memory, compressing them where that wasn't done before."""
+    for directory, _, files in os.walk(STATIC_DIR):
+        for name in files:
+            static_asset(os.path.relpath(os.path.join(directory, name), STATIC_DIR))
+    for name in pages:
+        page(name)
+    print(f"[Assets] Loaded {len(_pages)} pages and {len(_static)} static assets"
+          f" ({', '.join(ENCODINGS)}{', reloading on change' if DEV_RELOAD else ''})")
+
+
+def static_asset(path: str) -> Asset | None:
+    """The asset at `path` below STATIC_DIR, None when there is no such file."""
+    asset = _static.get(path)
+    if asset is not None and not (DEV_RELOAD and asset.changed()):
+        return asset
+    if asset is None and _static and not DEV_RELOAD:
+        return None  # Everything was loaded at startup
+    return _load(_static, path, STATIC_DIR, Asset)
+
+
+def page(name: str) -> Page | None:
+    """The page template `name` below TEMPLATES_DIR, None when there is no such file."""
+    current = _pages.get(name)
+    if current is not None and not (DEV_RELOAD and current.changed()):
+        return current
+    return _load(_pages, name, TEMPLATES_DIR, Page)
+
+
+def _load(cache: dict, name: str, directory: str, cls):
+    root = os.path.realpath(directory)
+    path = os.path.realpath(os.path.join(root, name))
+    if not path.startswith(root + os.sep) or not os.path.isfile(path):
+        cache.pop(name, None)
+        return None
+    with _lock:
+        try:
+            loaded = cache[name] = cls(path)
+        except OSError as e:
+            print(f"[Assets] Could not read {path}: {e}")
+            return None
+    return loaded
+
+
+def _stat(path: str):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _compressed(body: bytes, version: str, encoding: str) -> bytes:
+    cached = os.path.join(CACHE_DIR, f"{version}.{'br' if encoding == 'br' else 'gz'}")
+    try:
+        with open(cached, "rb") as f:
+            return f.read()
+    except OSError:
+        pass
+    compressed = brotli.compress(body, quality=11) if encoding == "br" else gzip.compress(body, 9, mtime=0)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(f"{cached}.{os.getpid()}.tmp", "wb") as f:
+            f.write(compressed)
+        os.replace(f"{cached}.{os.getpid()}.tmp", cached)
+    except OSError as e:
+        print(f"[Assets] Could not cache {cached}: {e}")
+    return compressed
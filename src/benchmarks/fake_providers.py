@@ -0,0 +1,273 @@
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from uuid import uuid4
+
+# Prompt caching like OpenAI's: prompts from 1024 tokens, cached in blocks of 128 tokens (at ~4 characters a token)
+CACHE_MIN_CHARS = 4096
+CACHE_BLOCK_CHARS = 512
+
+
+class LatencyModel:
+    """
+    Random provider latency in seconds, from a spec like:
+        fixed:0.5             always 0.5 s
+        uniform:0.2,1.5       uniform between 0.2 and 1.5 s
+        lognormal:0.8,0.4     log-normal with a median of 0.8 s and sigma 0.4, the usual shape of LLM latencies
+    """
+
+    def __init__(self, spec: str, rng: random.Random | None = None) -> None:
+        self.spec = spec
+        self.rng = rng or random.Random()
+        kind, _, values = spec.partition(":")
+        try:
+            params = [float(v) for v in values.split(",")] if values else []
+        except ValueError:
+            raise ValueError(f"Invalid latency spec '{spec}'")
+        expected = {"fixed": 1, "uniform": 2, "lognormal": 2}
+        if kind not in expected or len(params) != expected[kind]:
+            raise ValueError(f"Invalid latency spec '{spec}', expected e.g. fixed:0.5, uniform:0.2,1.5 or lognormal:0.8,0.4")
+        self.kind, self.params = kind, params
+
+    def sample(self) -> float:
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return self.rng.uniform(*self.params)
+        median, sigma = self.params
+        return median * self.rng.lognormvariate(0, sigma)
+
+
+def _reply(messages: list, words: int) -> str:
+    """A reply of `words` words taken from the prompt, so the output looks like Dutch text of a realistic length."""
+    prompt = " ".join(str(m.get("content", "")) for m in messages if m.get("role") == "user").split()
+    if not prompt:
+        prompt = ["antwoord"]
+    return " ".join(prompt[i % len(prompt)] for i in range(words))
+
+
+class FakeOpenAI:
+    """
+    In-process, OpenAI-compatible HTTP server for /v1/chat/completions, plain and streamed (SSE).
+    Point the engine at it with OPENAI_BASE_URL=<url>. Latency, reply length and the rate of
+    injected errors (HTTP 500, or 429 for a quarter of them) are configurable; the OpenAI SDK's
+    retries apply to them as they would to real errors. The usage it reports counts the prompt
+    prefixes seen before as cached tokens, like the provider's prompt cache.
+
+    :param latency: LatencyModel spec of the full response, or of the first chunk when streaming.
+    :param chunk_interval: Seconds between streamed chunks.
+    """
+
+    def __init__(self, latency: str = "lognormal:0.8,0.4", error_rate: float = 0.0, reply_words: int = 12,
+                 stream_words: int = 400, words_per_chunk: int = 4, chunk_interval: float = 0.02,
+                 seed: int | None = None) -> None:
+        self.rng = random.Random(seed)
+        self.latency = LatencyModel(latency, self.rng)
+        self.error_rate = error_rate
+        self.reply_words = reply_words
+        self.stream_words = stream_words
+        self.words_per_chunk = words_per_chunk
+        self.chunk_interval = chunk_interval
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "streamed": 0, "errors_injected": 0, "completion_tokens": 0,
+                      "prompt_tokens": 0, "cached_tokens": 0}
+        self.prefixes = set()  # Digests of the cached prompt prefixes
+        self.server = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def start(self) -> "FakeOpenAI":
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                fake._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="fake-openai", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def _count(self, **amounts) -> None:
+        with self.lock:
+            for key, amount in amounts.items():
+                self.stats[key] += amount
+
+    def _prompt_usage(self, messages: list) -> dict:
+        """Prompt tokens of the messages, with the longest prefix seen in an earlier request as cached."""
+        prompt = "".join(f"{m.get('role')}:{m.get('content')}\n" for m in messages)
+        digest = hashlib.sha256()
+        cached_chars = 0
+        with self.lock:
+            for start in range(0, len(prompt) - CACHE_BLOCK_CHARS + 1, CACHE_BLOCK_CHARS):
+                digest.update(prompt[start:start + CACHE_BLOCK_CHARS].encode("utf-8"))
+                end = start + CACHE_BLOCK_CHARS
+                if end < CACHE_MIN_CHARS:
+                    continue
+                prefix = digest.copy().digest()
+                if prefix in self.prefixes:
+                    cached_chars = end
+                else:
+                    self.prefixes.add(prefix)
+        usage = {"prompt_tokens": max(len(prompt) // 4, 1), "cached_tokens": cached_chars // 4}
+        self._count(**usage)
+        return usage
+
+    @staticmethod
+    def _usage(prompt: dict, completion_tokens: int) -> dict:
+        return {
+            "prompt_tokens": prompt["prompt_tokens"],
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt["prompt_tokens"] + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": prompt["cached_tokens"]},
+        }
+
+    def _handle(self, request: BaseHTTPRequestHandler) -> None:
+        if not request.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(request, 404, {"error": {"message": f"Unknown path {request.path}", "type": "invalid_request_error"}})
+            return
+        body = json.loads(request.rfile.read(int(request.headers.get("Content-Length", 0))) or b"{}")
+        stream = bool(body.get("stream"))
+        self._count(requests=1, streamed=int(stream))
+
+        with self.lock:
+            delay = self.latency.sample()
+            failed = self.rng.random() < self.error_rate
+            rate_limited = failed and self.rng.random() < 0.25
+        time.sleep(delay)
+
+        if failed:
+            self._count(errors_injected=1)
+            status, kind = (429, "rate_limit_error") if rate_limited else (500, "server_error")
+            self._send_json(request, status, {"error": {"message": "Injected failure", "type": kind}})
+            return
+
+        completion_id = f"chatcmpl-{uuid4().hex[:24]}"
+        model = body.get("model", "gpt-4o")
+        prompt = self._prompt_usage(body.get("messages", []))
+        if not stream:
+            content = _reply(body.get("messages", []), self.reply_words)
+            self._count(completion_tokens=self.reply_words)
+            self._send_json(request, 200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": self._usage(prompt, self.reply_words),
+            })
+            return
+
+        words = _reply(body.get("messages", []), self.stream_words).split(" ")
+        request.send_response(200)
+        request.send_header("Content-Type", "text/event-stream")
+        request.send_header("Cache-Control", "no-cache")
+        request.send_header("Connection", "close")
+        request.end_headers()
+        try:
+            for i in range(0, len(words), self.words_per_chunk):
+                text = " ".join(words[i:i + self.words_per_chunk]) + " "
+                self._send_event(request, completion_id, model, {"content": text}, None)
+                self._count(completion_tokens=len(words[i:i + self.words_per_chunk]))
+                time.sleep(self.chunk_interval)
+            self._send_event(request, completion_id, model, {}, "stop")
+            if (body.get("stream_options") or {}).get("include_usage"):
+                self._send_event(request, completion_id, model, None, None, usage=self._usage(prompt, len(words)))
+            request.wfile.write(b"data: [DONE]\n\n")
+            request.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client closed the stream early, e.g. a cancelled job
+        request.close_connection = True
+
+    @staticmethod
+    def _send_event(request, completion_id, model, delta, finish_reason, usage=None) -> None:
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            # The usage chunk that include_usage asks for has no choices
+            "choices": [] if usage is not None else [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        if usage is not None:
+            chunk["usage"] = usage
+        request.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        request.wfile.flush()
+
+    @staticmethod
+    def _send_json(request, status: int, payload: dict) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+
+class FakeQoPilot:
+    """
+    Local stand-in for the QoPilot websocket. Like the real service as used by
+    `PromptingEngine._generate_QoPilot`, it answers a {"action": "prompt"} message with two messages:
+    an acknowledgement and, after the sampled latency, the answer.
+    Point the engine at it with QOPILOT_URI=<url>.
+    """
+
+    def __init__(self, latency: str = "lognormal:1.5,0.4", error_rate: float = 0.0, reply_words: int = 60,
+                 seed: int | None = None) -> None:
+        self.rng = random.Random(seed)
+        self.latency = LatencyModel(latency, self.rng)
+        self.error_rate = error_rate
+        self.reply_words = reply_words
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "errors_injected": 0}
+        self.server = None
+
+    @property
+    def url(self) -> str:
+        return f"ws://127.0.0.1:{self.server.socket.getsockname()[1]}/ws/QoPilot"
+
+    def start(self) -> "FakeQoPilot":
+        # Part of Sanic's dependencies, so only imported when the stub is used
+        from websockets.sync.server import serve
+
+        self.server = serve(self._handle, "127.0.0.1", 0)
+        threading.Thread(target=self.server.serve_forever, name="fake-qopilot", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+
+    def _handle(self, connection) -> None:
+        for message in connection:
+            try:
+                request = json.loads(message)
+            except ValueError:
+                connection.send(json.dumps({"action": "error", "message": "Invalid JSON"}))
+                continue
+            with self.lock:
+                self.stats["requests"] += 1
+                delay = self.latency.sample()
+                failed = self.rng.random() < self.error_rate
+            connection.send(json.dumps({"action": "prompt-received"}))
+            time.sleep(delay)
+            if failed:
+                with self.lock:
+                    self.stats["errors_injected"] += 1
+                connection.close()  # The engine sees a dropped connection, as when the service goes down
+                return
+            content = _reply([{"role": "user", "content": request.get("prompt", "")}], self.reply_words)
+            connection.send(json.dumps({"action": "response", "response": content}))
@@ -0,0 +1,175 @@
+"""
+End-to-end throughput benchmark of report generation: GenerateReport -> create_pdf_report over a corpus
+of interrogations, against local fake LLM providers so no API calls are made (or paid for).
+
+Run from the repository root:
+    PYTHONPATH=src python -m benchmarks.reports --repeat 3 --latency lognormal:0.8,0.4 --error-rate 0.02
+    PYTHONPATH=src python -m benchmarks.results tmp/benchmarks/<baseline>.json tmp/benchmarks/<candidate>.json
+
+Reports run one after the other, like in the SAJE worker, in a scratch copy of the working directory,
+so data/meta_data.json and the logs of the application are left alone. Per-stage durations come from
+the trace spans (see tracing.py) the pipeline logs anyway.
+
+With --cassette, responses recorded from the real providers (APR_CASSETTE_MODE=record, see
+prompting/cassette.py) are replayed instead, by default without their latency, to measure APR's own overhead.
+"""
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+from uuid import uuid4
+from benchmarks.fake_providers import FakeOpenAI, FakeQoPilot
+from benchmarks.results import environment, peak_rss_mb, summarize, write_results
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Shared read-only with the scratch directory
+LINKED = ("src", "templates", "static")
+
+
+def prepare_workdir(corpus: list[str]) -> str:
+    workdir = tempfile.mkdtemp(prefix="apr-benchmark-")
+    for name in LINKED:
+        os.symlink(os.path.join(REPO_ROOT, name), os.path.join(workdir, name))
+    for directory in ("data/verwerkt", "tmp", "input"):
+        os.makedirs(os.path.join(workdir, directory), exist_ok=True)
+    for path in corpus:
+        shutil.copy(path, os.path.join(workdir, "input", os.path.basename(path)))
+    return workdir
+
+
+def run(options) -> dict:
+    corpus = sorted(path for pattern in options.corpus for path in glob.glob(os.path.join(REPO_ROOT, pattern)))
+    corpus = [path for path in corpus if os.path.isfile(path)]
+    if not corpus:
+        raise SystemExit(f"[Benchmark] No corpus files match {options.corpus}")
+
+    openai_stub = FakeOpenAI(options.latency, options.error_rate, stream_words=options.stream_words,
+                             chunk_interval=options.chunk_interval, seed=options.seed).start()
+    qopilot_stub = FakeQoPilot(options.qopilot_latency, options.error_rate, seed=options.seed).start() \
+        if options.qopilot_questions else None
+    # Read by setup_env when APR is imported; variables that are set take precedence over .env
+    os.environ.update({"OPENAI_API_KEY": "benchmark", "CINTIQO_API_KEY": "benchmark", "OPENAI_BASE_URL": openai_stub.url})
+    if qopilot_stub is not None:
+        os.environ["QOPILOT_URI"] = qopilot_stub.url
+    if options.cassette:
+        os.environ.update({
+            "APR_CASSETTE_MODE": "replay",
+            "APR_CASSETTE_PATH": os.path.abspath(options.cassette),
+            "APR_CASSETTE_LATENCY_SCALE": str(options.cassette_latency),
+        })
+
+    workdir = prepare_workdir(corpus)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        # Imported in the scratch directory, where the loggers and metrics open their files
+        import APRLogger
+        import tracing
+        from APR import GenerateReport, create_pdf_report, extractBlocks
+        from prompting.engine import PromptingEngine
+        from setup_env import API_DICT
+
+        engine = PromptingEngine(API_DICT, "src/prompting/templates.json")
+        inputs = [os.path.join("input", os.path.basename(path)) for path in corpus] * options.repeat
+        failed = 0
+        print(f"[Benchmark] {len(inputs)} reports from {len(corpus)} files, workdir {workdir}")
+
+        started = time.perf_counter()
+        for n, source in enumerate(inputs, 1):
+            path = os.path.join("tmp", str(uuid4()))
+            shutil.copy(source, path)
+            try:
+                with tracing.span("report", dataID=os.path.basename(path)):
+                    with tracing.span("report.extract"):
+                        file_id = GenerateReport(path)
+                    if file_id is None:
+                        raise RuntimeError("GenerateReport failed")
+                    if options.blocks:
+                        with tracing.span("report.blocks"):
+                            extractBlocks(file_id)
+                    for _ in range(options.qopilot_questions):
+                        engine.generate_response("verhoren-QoPilot-1", prompt=f"Vat het verhoor {file_id} samen.")
+                    if not options.skip_pdf:
+                        with tracing.span("report.pdf"):
+                            create_pdf_report(file_id)
+            except Exception as e:
+                failed += 1
+                print(f"[Benchmark] {n}/{len(inputs)} {os.path.basename(source)} failed: {e}")
+                continue
+            print(f"[Benchmark] {n}/{len(inputs)} {os.path.basename(source)}")
+        wall = time.perf_counter() - started
+
+        APRLogger.shutdown_logging()  # Writes the queued span records
+        durations = {}
+        for record in tracing.read_spans("./tmp/logs"):
+            if record["span"]["status"] == "ok":
+                durations.setdefault(record["span"]["name"], []).append(record["span"]["duration_us"] / 1_000_000)
+    finally:
+        os.chdir(cwd)
+        openai_stub.stop()
+        if qopilot_stub is not None:
+            qopilot_stub.stop()
+        if not options.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    completed = len(inputs) - failed
+    return {
+        **environment(),
+        "config": {
+            "corpus": [os.path.basename(path) for path in corpus],
+            "repeat": options.repeat,
+            "latency": options.latency,
+            "error_rate": options.error_rate,
+            "stream_words": options.stream_words,
+            "chunk_interval": options.chunk_interval,
+            "qopilot_questions": options.qopilot_questions,
+            "blocks": options.blocks,
+            "pdf": not options.skip_pdf,
+            "seed": options.seed,
+            "cassette": options.cassette,
+            "cassette_latency": options.cassette_latency if options.cassette else None,
+        },
+        "reports": completed,
+        "failed": failed,
+        "wall_s": round(wall, 3),
+        "reports_per_minute": round(completed / wall * 60, 2) if wall else None,
+        "stages": {name: summarize(values) for name, values in sorted(durations.items())},
+        "providers": {
+            "openai": dict(openai_stub.stats),
+            **({"qopilot": dict(qopilot_stub.stats)} if qopilot_stub is not None else {}),
+        },
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark report generation against fake LLM providers.")
+    parser.add_argument("--corpus", nargs="+", default=["data/*.txt"], help="Globs relative to the repository root")
+    parser.add_argument("--repeat", type=int, default=1, help="Times every corpus file is processed")
+    parser.add_argument("--latency", default="lognormal:0.8,0.4",
+                        help="OpenAI latency (to the first chunk when streaming): fixed:S, uniform:A,B or lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of provider requests that fail")
+    parser.add_argument("--stream-words", type=int, default=400, help="Length of the streamed proces-verbaal")
+    parser.add_argument("--chunk-interval", type=float, default=0.02, help="Seconds between streamed chunks")
+    parser.add_argument("--qopilot-questions", type=int, default=0, help="QoPilot prompts per report, 0 to skip")
+    parser.add_argument("--qopilot-latency", default="lognormal:1.5,0.4")
+    parser.add_argument("--blocks", action="store_true", help="Also precompute the proto3 Blocks")
+    parser.add_argument("--skip-pdf", action="store_true", help="Skip create_pdf_report, e.g. without Playwright browsers")
+    parser.add_argument("--seed", type=int, help="Seed of the fake providers, for repeatable latencies and errors")
+    parser.add_argument("--cassette", help="Replay this cassette instead of calling the fake providers")
+    parser.add_argument("--cassette-latency", type=float, default=0.0,
+                        help="Factor on the recorded latencies when replaying, 1 for provider speed")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directory with its logs and PDFs")
+    parser.add_argument("-o", "--output", help="Result file, default tmp/benchmarks/reports-<time>.json")
+    options = parser.parse_args()
+
+    results = run(options)
+    output = options.output or os.path.join(REPO_ROOT, "tmp", "benchmarks",
+                                            f"reports-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    write_results(output, results)
+    print(f"[Benchmark] {results['reports']} reports ({results['failed']} failed) in {results['wall_s']} s: "
+          f"{results['reports_per_minute']} reports/min")
+    for name, stage in results["stages"].items():
+        print(f"[Benchmark]   {name:<40} p50 {stage['p50_s']:>8} s  p95 {stage['p95_s']:>8} s  (n={stage['count']})")
@@ -0,0 +1,98 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+
+def percentile(values: list, q: float) -> float | None:
+    """Exact percentile (0 <= q <= 1) by linear interpolation between the nearest ranks."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = q * (len(ordered) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(durations: list) -> dict:
+    """Count, mean, p50, p95 and max of durations in seconds."""
+    if not durations:
+        return {"count": 0}
+    return {
+        "count": len(durations),
+        "mean_s": round(sum(durations) / len(durations), 4),
+        "p50_s": round(percentile(durations, 0.5), 4),
+        "p95_s": round(percentile(durations, 0.95), 4),
+        "max_s": round(max(durations), 4),
+    }
+
+
+def peak_rss_mb() -> dict:
+    """Peak resident memory of this process and of its finished child processes (e.g. the PDF browser)."""
+    # ru_maxrss is in kilobytes on Linux
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+
+def environment() -> dict:
+    """What a run was measured on, to tell apart runs that aren't comparable."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                timeout=5, check=True).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "cpus": os.cpu_count(),
+    }
+
+
+def write_results(path: str, results: dict) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"[Benchmark] Results written to {path}")
+
+
+def compare(baseline: dict, candidate: dict) -> list[str]:
+    """Lines with the relative change of the throughput and of every stage's p50/p95 between two runs."""
+
+    def change(old, new):
+        if old in (None, 0) or new is None:
+            return "n/a"
+        return f"{(new - old) / old * 100:+.1f}%"
+
+    lines = []
+    for key in ("reports_per_minute", "messages_per_second"):
+        if key in baseline or key in candidate:
+            old, new = baseline.get(key), candidate.get(key)
+            lines.append(f"{key:<40} {old!s:>10} -> {new!s:>10}  {change(old, new)}")
+    for stage in sorted(set(baseline.get("stages", {})) | set(candidate.get("stages", {}))):
+        old, new = baseline.get("stages", {}).get(stage, {}), candidate.get("stages", {}).get(stage, {})
+        for metric in ("p50_s", "p95_s"):
+            lines.append(f"{stage + ' ' + metric:<40} {old.get(metric)!s:>10} -> {new.get(metric)!s:>10}  "
+                         f"{change(old.get(metric), new.get(metric))}")
+    old, new = baseline.get("peak_rss_mb", {}).get("self"), candidate.get("peak_rss_mb", {}).get("self")
+    lines.append(f"{'peak_rss_mb':<40} {old!s:>10} -> {new!s:>10}  {change(old, new)}")
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files.")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    options = parser.parse_args()
+
+    with open(options.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(options.candidate, "r", encoding="utf-8") as f:
+        candidate = json.load(f)
+    print("\n".join(compare(baseline, candidate)))
@@ -0,0 +1,162 @@
+"""
+Startup-time benchmark: how long a fresh process takes to import the web modules (what every Sanic
+worker pays on start and on every dev reload), which packages dominate that, and what the SAJE worker's
+warm-up costs against the first job it would otherwise slow down.
+
+Run from the repository root:
+    PYTHONPATH=src python -m benchmarks.startup --repeat 10
+    PYTHONPATH=src python -m benchmarks.startup --pdf   # Also the first PDF render, cold versus warmed up
+    PYTHONPATH=src python -m benchmarks.results tmp/benchmarks/<baseline>.json tmp/benchmarks/<candidate>.json
+
+Every measurement runs in a new interpreter in a scratch copy of the working directory (see
+benchmarks/reports.py), so nothing is cached in sys.modules and the logs of the application are left alone.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from benchmarks.reports import REPO_ROOT, prepare_workdir
+from benchmarks.results import environment, summarize, write_results
+
+MODULES = ["app", "blueprints.endpoints", "blueprints.websocket", "APR", "prompting.engine", "saje"]
+
+IMPORT = """
+import json, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - start}}))
+"""
+
+WARM_UP = """
+import json, time
+start = time.perf_counter()
+import APR
+imported = time.perf_counter() - start
+steps = APR.warm_up()
+print(json.dumps({"import_s": imported, "steps_s": steps}))
+"""
+
+# Two renders in one process: the first is what the first PDF job of a (cold or warmed up) worker takes
+FIRST_PDF = """
+import json, time, APR
+if {warm}:
+    APR.warm_up()
+renders = []
+for n in range(2):
+    start = time.perf_counter()
+    APR.html_to_pdf("<html><body><h1>Proces-verbaal</h1></body></html>", f"startup-benchmark-{{n}}")
+    renders.append(time.perf_counter() - start)
+print(json.dumps({{"first_s": renders[0], "second_s": renders[1]}}))
+"""
+
+
+def run_child(code: str, workdir: str, env: dict, *flags: str) -> tuple[dict | None, str]:
+    """Runs `code` in a fresh interpreter. Returns the JSON it printed last (None on failure) and its stderr."""
+    # A failing child is reported through its stderr, not raised
+    process = subprocess.run([sys.executable, *flags, "-c", code], cwd=workdir, env=env,
+                             capture_output=True, text=True, timeout=300, check=False)
+    lines = process.stdout.strip().splitlines()
+    if process.returncode != 0 or not lines:
+        return None, process.stderr
+    return json.loads(lines[-1]), process.stderr
+
+
+def heaviest_imports(importtime: str, top: int) -> list[dict]:
+    """The top-level packages with the largest cumulative import time, from `python -X importtime` output."""
+    packages = []
+    for line in importtime.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Nested imports are indented; the top-level ones include the time of everything they import
+        if name.startswith("  "):
+            continue
+        packages.append({"module": name.strip(), "cumulative_ms": round(int(cumulative) / 1000, 1)})
+    return sorted(packages, key=lambda package: package["cumulative_ms"], reverse=True)[:top]
+
+
+def run(options) -> dict:
+    workdir = prepare_workdir([])
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [os.path.join(REPO_ROOT, "src"),
+                                                                    os.environ.get("PYTHONPATH")]))}
+    # Keys are needed to create the clients, but no request is made
+    env.setdefault("OPENAI_API_KEY", "benchmark")
+    env.setdefault("CINTIQO_API_KEY", "benchmark")
+    results = {"imports": {}, "failed": {}}
+    try:
+        for module in options.modules:
+            durations = []
+            for _ in range(options.repeat):
+                result, stderr = run_child(IMPORT.format(module=module), workdir, env)
+                if result is None:
+                    results["failed"][module] = stderr.strip().splitlines()[-1:] or ["no output"]
+                    break
+                durations.append(result["seconds"])
+            if durations:
+                results["imports"][module] = summarize(durations)
+                print(f"[Benchmark] import {module:<24} p50 {results['imports'][module]['p50_s']:>8} s")
+            else:
+                print(f"[Benchmark] import {module:<24} failed: {results['failed'][module][0]}")
+
+        _, stderr = run_child(IMPORT.format(module=options.modules[0]), workdir, env, "-X", "importtime")
+        results["heaviest_imports"] = heaviest_imports(stderr, options.top)
+
+        warm_up, stderr = run_child(WARM_UP, workdir, env)
+        results["warm_up"] = warm_up
+        if warm_up is None:
+            results["failed"]["warm_up"] = stderr.strip().splitlines()[-1:] or ["no output"]
+
+        if options.pdf:
+            results["first_pdf"] = {}
+            for label, warm in (("cold", False), ("warm", True)):
+                renders, stderr = run_child(FIRST_PDF.format(warm=warm), workdir, env)
+                results["first_pdf"][label] = renders
+                if renders is None:
+                    results["failed"][f"first_pdf_{label}"] = stderr.strip().splitlines()[-1:] or ["no output"]
+    finally:
+        if not options.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    # Stages in the format of the other benchmarks, so benchmarks.results can compare runs
+    stages = {f"import.{module}": summary for module, summary in results["imports"].items()}
+    for step, seconds in ((results.get("warm_up") or {}).get("steps_s") or {}).items():
+        stages[f"warm_up.{step}"] = summarize([seconds])
+    for label, renders in (results.get("first_pdf") or {}).items():
+        if renders is not None:
+            stages[f"first_pdf.{label}"] = summarize([renders["first_s"]])
+    return {
+        **environment(),
+        "config": {"modules": options.modules, "repeat": options.repeat, "pdf": options.pdf},
+        "stages": stages,
+        **results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark import and warm-up times of the APR processes.")
+    parser.add_argument("--modules", nargs="+", default=MODULES, help="Modules to time; the first is also profiled "
+                                                                     "with -X importtime")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per module")
+    parser.add_argument("--top", type=int, default=15, help="Number of heaviest top-level imports to list")
+    parser.add_argument("--pdf", action="store_true", help="Also time the first PDF render, needs Playwright browsers")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directory")
+    parser.add_argument("-o", "--output", help="Result file, default tmp/benchmarks/startup-<time>.json")
+    options = parser.parse_args()
+
+    results = run(options)
+    output = options.output or os.path.join(REPO_ROOT, "tmp", "benchmarks",
+                                            f"startup-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    write_results(output, results)
+    for package in results["heaviest_imports"]:
+        print(f"[Benchmark]   {package['module']:<40} {package['cumulative_ms']:>8} ms")
+    if results["warm_up"] is not None:
+        print(f"[Benchmark] warm-up {results['warm_up']['steps_s']} after importing APR in "
+              f"{results['warm_up']['import_s']:.3f} s")
+    for label, renders in (results.get("first_pdf") or {}).items():
+        if renders is not None:
+            print(f"[Benchmark] first PDF ({label}) {renders['first_s']:.3f} s, second {renders['second_s']:.3f} s")
+    for name, error in results["failed"].items():
+        print(f"[Benchmark] {name} failed: {error[0]}")
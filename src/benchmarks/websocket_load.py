@@ -0,0 +1,409 @@
+"""
+Load test of the websocket protocol: N simulated officers, each doing what an apr-js.js tab does, against
+a local APR server that uses the fake LLM providers. The client count is stepped up to see where one
+Sanic worker runs out of headroom.
+
+Run from the repository root (needs Sanic's dependencies, among which the websockets client):
+    PYTHONPATH=src python -m benchmarks.websocket_load --clients 10,50,100,200 --step-duration 30
+
+Every client connects to /ws/<uuid>, sends "connection" and a heartbeat every 5 s and answers every
+heartbeat with a "table-update", like the page does. Clients can also upload interrogations
+(/upload + "watch-job", then "generateReport" for the finished report) and request thoughts.
+Per step the harness reports message latency percentiles per action, the event loop lag of the
+server (its apr_event_loop_lag_seconds metric) and the CPU and peak memory of the server's processes.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from collections import deque
+from uuid import uuid4
+from benchmarks.fake_providers import FakeOpenAI
+from benchmarks.reports import REPO_ROOT, prepare_workdir
+from benchmarks.results import environment, summarize, write_results
+import metrics
+
+ACCESS_KEY = "benchmark"
+# Action sent -> response that completes it
+RESPONSES = {
+    "connection": "connected",
+    "heartbeat": "heartbeat",
+    "table-update": "table-update",
+    "requested-thought": "thought-suggestions",
+}
+# The server snapshots its metrics every second (APR_METRICS_FLUSH_S), so this includes a full step
+SNAPSHOT_WAIT = 2.0
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+class Recorder:
+    """Latencies and errors of all clients within the current step."""
+
+    def __init__(self) -> None:
+        self.latencies = {}
+        self.errors = {}
+        self.messages = 0
+
+    def latency(self, name: str, seconds: float) -> None:
+        self.latencies.setdefault(name, []).append(seconds)
+
+    def error(self, name: str) -> None:
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+
+class SimulatedOfficer:
+    """One browser tab on the APR page, following the protocol of static/apr-js.js."""
+
+    def __init__(self, options, recorder: Recorder, corpus: list[str], reports: list[str]) -> None:
+        self.options = options
+        self.recorder = recorder
+        self.corpus = corpus
+        self.reports = reports
+        self.pending = {action: deque() for action in RESPONSES}  # Send times of unanswered messages
+        self.uploads = {}  # Job ID -> upload start
+        self.generating = deque()  # Start times of generateReport requests
+        self.ws = None
+
+    async def send(self, action: str, **fields) -> None:
+        if action in self.pending:
+            self.pending[action].append(time.perf_counter())
+        await self.ws.send(json.dumps({"action": action, **fields}))
+        self.recorder.messages += 1
+
+    async def run(self, stop: asyncio.Event) -> None:
+        import websockets
+
+        url = f"ws://127.0.0.1:{self.options.port}/ws/{uuid4()}"
+        start = time.perf_counter()
+        try:
+            self.ws = await websockets.connect(url, max_size=None, open_timeout=30)
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+            self.recorder.error("connect")
+            return
+        self.recorder.latency("connect", time.perf_counter() - start)
+
+        tasks = [asyncio.create_task(self.receive()), asyncio.create_task(self.heartbeat(stop))]
+        tasks += [asyncio.create_task(self.after(delay, self.upload)) for delay in self.schedule(self.options.uploads)]
+        tasks += [asyncio.create_task(self.after(delay, self.thought)) for delay in self.schedule(self.options.thoughts)]
+        try:
+            await self.send("connection")
+            await stop.wait()
+        except websockets.WebSocketException:
+            self.recorder.error("send")
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.ws.close()
+
+    def schedule(self, count: int) -> list[float]:
+        """Random moments within the step for `count` actions of this client."""
+        return sorted(random.uniform(0, self.options.step_duration * 0.8) for _ in range(count))
+
+    async def after(self, delay: float, action) -> None:
+        await asyncio.sleep(delay)
+        await action()
+
+    async def heartbeat(self, stop: asyncio.Event) -> None:
+        # Tabs are opened at different moments, so their heartbeats aren't in phase
+        await asyncio.sleep(random.uniform(0, self.options.heartbeat_interval))
+        while not stop.is_set():
+            await self.send("heartbeat")
+            await asyncio.sleep(self.options.heartbeat_interval)
+
+    async def receive(self) -> None:
+        import websockets
+
+        try:
+            async for raw in self.ws:
+                now = time.perf_counter()
+                message = json.loads(raw)
+                response = message.get("response")
+                for action, expected in RESPONSES.items():
+                    if response == expected and self.pending[action]:
+                        self.recorder.latency(action, now - self.pending[action].popleft())
+                        break
+
+                if response == "heartbeat":
+                    # apr-js.js re-fetches the table on every heartbeat
+                    await self.send("table-update")
+                elif response == "done" and message.get("data") and self.uploads:
+                    # GenerateReport finished: the data is the report ID, the oldest upload is the one done first
+                    job_id = next(iter(self.uploads))
+                    self.recorder.latency("upload-to-report", now - self.uploads.pop(job_id))
+                    self.generating.append(time.perf_counter())
+                    await self.send("generateReport", ID=message["data"])
+                elif response == "report" and self.generating:
+                    self.recorder.latency("generateReport", now - self.generating.popleft())
+                elif response == "error":
+                    self.recorder.error(f"server: {str(message.get('data'))[:60]}")
+        except websockets.ConnectionClosed:
+            pass
+
+    async def upload(self) -> None:
+        job_id = str(uuid4())
+        start = time.perf_counter()
+        try:
+            status = await asyncio.to_thread(self._post_upload, job_id, random.choice(self.corpus))
+        except OSError:
+            status = None
+        if status != 200:
+            self.recorder.error("upload")
+            return
+        self.recorder.latency("upload", time.perf_counter() - start)
+        self.uploads[job_id] = start
+        await self.send("watch-job", ID=job_id)
+        await self.send("table-update")
+
+    def _post_upload(self, job_id: str, path: str) -> int:
+        with open(path, "rb") as f:
+            content = f.read()
+        boundary = uuid4().hex
+        body = b"".join([
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{job_id}.txt"\r\n'
+            f"Content-Type: text/plain\r\n\r\n".encode(),
+            content,
+            f'\r\n--{boundary}\r\nContent-Disposition: form-data; name="config"\r\n\r\n'
+            f'{json.dumps({"UUID": job_id})}\r\n--{boundary}--\r\n'.encode(),
+        ])
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{self.options.port}/upload/{job_id}", data=body, method="POST",
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}", "Cookie": f"auth={ACCESS_KEY}"})
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return response.status
+
+    async def thought(self) -> None:
+        filename = random.choice(self.reports)
+        context = {"datum": "14-05-2025", "tijd": "13:53", "locatie": "Politiebureau", "verdachte": "Onbekend",
+                   "proces_verbaal": "Op 14 mei 2025 verklaarde de verdachte dat hij op de avond van de inbraak thuis was."}
+        await self.send("requested-thought", filename=filename, context=context)
+
+
+# ---- Server under test ------------------------------------------------------
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def seed_reports(workdir: str, count: int) -> list[str]:
+    """Fills the scratch meta_data.json with `count` reports, copies of the bundled ones, for a table of realistic size."""
+    with open(os.path.join(REPO_ROOT, "data", "meta_data.json"), "r", encoding="utf-8") as f:
+        samples = list(json.load(f).values())
+    reports = {}
+    for i in range(count):
+        report_id = f"seed-{i:05d}.pdf"
+        reports[report_id] = {**samples[i % len(samples)], "ID": report_id, "original_filename": report_id[:-4]}
+    with open(os.path.join(workdir, "data", "meta_data.json"), "w", encoding="utf-8") as f:
+        json.dump(reports, f)
+    return list(reports)
+
+
+def start_server(workdir: str, options, openai_url: str) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.path.join(workdir, "src"),
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_BASE_URL": openai_url,
+        "APP_ACCES_KEY": ACCESS_KEY,
+        "APR_METRICS_FLUSH_S": "1",
+    }
+    with open(os.path.join(workdir, "server.log"), "wb") as log:  # The server keeps its own copy of the handle
+        server = subprocess.Popen(
+            [sys.executable, "-m", "sanic", "app:app", "--host", "127.0.0.1", "--port", str(options.port),
+             "--workers", str(options.workers)],
+            cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"[LoadTest] Server exited with {server.returncode}, see {workdir}/server.log")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{options.port}/authorize", timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.5)
+    server.terminate()
+    raise SystemExit(f"[LoadTest] Server did not start within 60 s, see {workdir}/server.log")
+
+
+def process_tree(root: int) -> list[int]:
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    tree, todo = [], [root]
+    while todo:
+        pid = todo.pop()
+        tree.append(pid)
+        todo.extend(children.get(pid, ()))
+    return tree
+
+
+def tree_usage(root: int) -> tuple[float, float]:
+    """CPU seconds used and resident memory (MB) of a process and its descendants, from /proc (Linux)."""
+    cpu, rss = 0.0, 0.0
+    for pid in process_tree(root):
+        try:
+            with open(f"/proc/{pid}/stat", "r") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{pid}/statm", "r") as f:
+                resident = int(f.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            continue  # Exited in the meantime
+        cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        rss += resident * PAGE_SIZE / 1024 / 1024
+    return cpu, rss
+
+
+def loop_lag(before: dict, after: dict) -> dict:
+    """Event loop lag percentiles of the server between two metric collections."""
+    key = next((k for k in after if k[0] == "apr_event_loop_lag_seconds"), None)
+    if key is None:
+        return {}
+    values = [b - a for a, b in zip(before.get(key, [0] * len(after[key])), after[key])]
+    p50, p95, p99 = (metrics.quantile(values, q) for q in (0.5, 0.95, 0.99))
+    return {
+        "samples": sum(values[:-1]),
+        "p50_s": round(p50, 4) if p50 is not None else None,
+        "p95_s": round(p95, 4) if p95 is not None else None,
+        "p99_s": round(p99, 4) if p99 is not None else None,
+    }
+
+
+# ---- Steps ------------------------------------------------------------------
+
+
+async def run_step(clients: int, options, server: subprocess.Popen, metrics_dir: str, corpus, reports) -> dict:
+    # Reading the metric snapshots and /proc is file I/O, kept off the loop that drives the clients
+    recorder = Recorder()
+    stop = asyncio.Event()
+    _, lag_before = await asyncio.to_thread(metrics.collect, metrics_dir)
+    cpu_before, _ = await asyncio.to_thread(tree_usage, server.pid)
+    peak_rss = 0.0
+
+    officers = [SimulatedOfficer(options, recorder, corpus, reports) for _ in range(clients)]
+    tasks = []
+    for officer in officers:
+        tasks.append(asyncio.create_task(officer.run(stop)))
+        await asyncio.sleep(options.ramp / max(clients, 1))  # Spread the connects like tabs being opened
+
+    started = time.perf_counter()
+    while time.perf_counter() - started < options.step_duration:
+        await asyncio.sleep(1)
+        peak_rss = max(peak_rss, (await asyncio.to_thread(tree_usage, server.pid))[1])
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    cpu_after, _ = await asyncio.to_thread(tree_usage, server.pid)
+
+    await asyncio.sleep(SNAPSHOT_WAIT)  # Let the server write the snapshot with the step's last samples
+    _, lag_after = await asyncio.to_thread(metrics.collect, metrics_dir)
+    unanswered = sum(len(queue) for officer in officers for queue in officer.pending.values())
+
+    return {
+        "clients": clients,
+        "duration_s": round(elapsed, 1),
+        "messages_sent": recorder.messages,
+        "messages_per_second": round(recorder.messages / elapsed, 1),
+        "unanswered": unanswered,
+        "errors": recorder.errors,
+        "latency": {name: summarize(values) for name, values in sorted(recorder.latencies.items())},
+        "event_loop_lag": loop_lag(lag_before, lag_after),
+        "server": {
+            "cpu_percent": round((cpu_after - cpu_before) / (elapsed + options.ramp) * 100, 1),
+            "peak_rss_mb": round(peak_rss, 1),
+        },
+    }
+
+
+def run(options) -> dict:
+    """Sets up the scratch server synchronously, and runs an event loop with the simulated officers per step."""
+    corpus = [os.path.join(REPO_ROOT, "data", name) for name in sorted(os.listdir(os.path.join(REPO_ROOT, "data")))
+              if name.endswith(".txt")]
+    openai_stub = FakeOpenAI(options.latency, options.error_rate, seed=options.seed).start()
+    workdir = prepare_workdir(corpus)
+    os.makedirs(os.path.join(workdir, "tmp", "error"), exist_ok=True)
+    reports = seed_reports(workdir, options.table_size)
+    options.port = options.port or free_port()
+    server = start_server(workdir, options, openai_stub.url)
+    print(f"[LoadTest] Server on port {options.port}, workdir {workdir}")
+
+    steps = []
+    try:
+        for clients in options.clients:
+            print(f"[LoadTest] {clients} clients for {options.step_duration} s")
+            step = asyncio.run(run_step(clients, options, server, os.path.join(workdir, "tmp", "metrics"),
+                                        corpus, reports))
+            steps.append(step)
+            print(f"[LoadTest]   {step['messages_per_second']} msg/s, table-update p95 "
+                  f"{step['latency'].get('table-update', {}).get('p95_s')} s, loop lag p95 "
+                  f"{step['event_loop_lag'].get('p95_s')} s, server CPU {step['server']['cpu_percent']}%, "
+                  f"RSS {step['server']['peak_rss_mb']} MB, errors {sum(step['errors'].values())}")
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        openai_stub.stop()
+        if not options.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        **environment(),
+        "config": {
+            "clients": options.clients,
+            "step_duration_s": options.step_duration,
+            "heartbeat_interval_s": options.heartbeat_interval,
+            "uploads_per_client": options.uploads,
+            "thoughts_per_client": options.thoughts,
+            "table_size": options.table_size,
+            "workers": options.workers,
+            "latency": options.latency,
+            "error_rate": options.error_rate,
+        },
+        "steps": steps,
+        "providers": {"openai": dict(openai_stub.stats)},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Websocket load test with simulated officers against a local APR server.")
+    parser.add_argument("--clients", type=lambda value: [int(n) for n in value.split(",")], default=[10, 50, 100],
+                        help="Comma-separated client counts, one step each")
+    parser.add_argument("--step-duration", type=float, default=30.0, help="Seconds per step, after the ramp-up")
+    parser.add_argument("--ramp", type=float, default=2.0, help="Seconds over which a step's clients connect")
+    parser.add_argument("--heartbeat-interval", type=float, default=5.0, help="As in apr-js.js")
+    parser.add_argument("--uploads", type=int, default=0, help="Uploads (and generateReports) per client per step")
+    parser.add_argument("--thoughts", type=int, default=0, help="Thought requests per client per step")
+    parser.add_argument("--table-size", type=int, default=50, help="Reports in the table sent on every table-update")
+    parser.add_argument("--workers", type=int, default=1, help="Sanic workers of the server")
+    parser.add_argument("--port", type=int, help="Server port, a free one by default")
+    parser.add_argument("--latency", default="lognormal:0.8,0.4", help="Fake OpenAI latency, see benchmarks.fake_providers")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directory with the server's logs")
+    parser.add_argument("-o", "--output", help="Result file, default tmp/benchmarks/websocket-load-<time>.json")
+    options = parser.parse_args()
+
+    results = run(options)
+    output = options.output or os.path.join(REPO_ROOT, "tmp", "benchmarks",
+                                            f"websocket-load-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    write_results(output, results)
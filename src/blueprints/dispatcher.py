@@ -0,0 +1,230 @@
+import hmac
+from collections import deque
+from time import perf_counter
+from uuid import uuid4
+from sanic import Request, Websocket
+from saje import SajeClient
+from APRLogger import technical_log
+import metrics
+import tracing
+import profiling
+from setup_env import APR_ADMIN_KEY
+import ujson
+import asyncio
+
+# Maximum number of actions handled at the same time per websocket connection.
+# While the limit is reached no new messages are read, so the client is slowed down by the socket.
+MAX_CONCURRENT_ACTIONS = 4
+
+
+class ActionContext:
+    """Per-connection state handed to every action handler."""
+
+    def __init__(self, request: Request, ws: Websocket, saje_client: SajeClient, gebruikersID: str, sessieID: str,
+                 state: dict | None = None) -> None:
+        self.request = request
+        self.ws = ws
+        self.saje_client = saje_client
+        self.gebruikersID = gebruikersID
+        self.sessieID = sessieID
+        self.state = state if state is not None else {}  # Shared by all messages of the connection
+        self.job_id = None  # Fresh ID per message, set by the dispatcher
+
+    @property
+    def job_status(self):
+        return self.request.app.shared_ctx.job_status
+
+    @property
+    def is_admin(self) -> bool:
+        """Whether the connection was opened with the admin cookie set by /authorize."""
+        cookie = self.request.cookies.get("admin")
+        return bool(APR_ADMIN_KEY and cookie) and hmac.compare_digest(cookie, APR_ADMIN_KEY)
+
+    async def send(self, response: str, data=None) -> None:
+        message = {"response": response}
+        if data is not None:
+            message["data"] = data
+        await self.ws.send(ujson.dumps(message))
+
+
+class Dispatcher:
+    """
+    Routes websocket messages to registered action handlers.
+
+    Every message is parsed once and validated against the schema of its action before the
+    handler runs. Handlers of one connection run concurrently, up to MAX_CONCURRENT_ACTIONS;
+    handlers registered with `ordered=True` (those that mutate reports) additionally run one
+    at a time in the order their messages arrived.
+    """
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_ACTIONS) -> None:
+        self.handlers = {}
+        self.max_concurrent = max_concurrent
+        # Recent handling times in ms per action, across the connections of this worker
+        self.latency = {}
+
+    def action(self, name: str, required: dict | None = None, optional: dict | None = None, ordered: bool = False,
+               admin: bool = False):
+        """
+        Registers `handler(ctx, msg)` for an action.
+
+        :param name: Value of the "action" field that selects the handler.
+        :param required: Fields that must be present, mapped to their type (or tuple of types).
+        :param optional: Fields that may be present, mapped to their type when they are not null.
+        :param ordered: Whether the handler must run after all earlier ordered actions of the connection.
+        :param admin: Whether only admin connections (see ActionContext.is_admin) may use the action.
+        """
+        def register(handler):
+            self.handlers[name] = {
+                "handler": handler,
+                "required": required or {},
+                "optional": optional or {},
+                "ordered": ordered,
+                "admin": admin,
+            }
+            return handler
+        return register
+
+    def validate(self, spec: dict, msg: dict) -> str | None:
+        """Returns a description of the first schema violation, or None when the message is valid."""
+        for field, expected in spec["required"].items():
+            value = msg.get(field)
+            if value is None or value == "":
+                return f"Missing field '{field}'"
+            if not isinstance(value, expected):
+                return f"Field '{field}' has an invalid type"
+        for field, expected in spec["optional"].items():
+            value = msg.get(field)
+            if value is not None and not isinstance(value, expected):
+                return f"Field '{field}' has an invalid type"
+        return None
+
+    async def serve(self, ctx: ActionContext, fallback) -> None:
+        """
+        Reads messages from the websocket until it closes and dispatches them.
+
+        :param fallback: Handler `(ctx, raw)` for messages without a registered action.
+        """
+        slots = asyncio.Semaphore(self.max_concurrent)
+        ordered_lock = asyncio.Lock()
+        tasks = set()
+        connection_latency = {}
+
+        try:
+            while True:
+                # Backpressure: wait for a free slot before reading the next message
+                await slots.acquire()
+                try:
+                    data = await ctx.ws.recv()
+                except BaseException:
+                    slots.release()
+                    raise
+                if data is None:
+                    slots.release()
+                    continue
+
+                received = perf_counter()
+                try:
+                    msg = ujson.loads(data)
+                    action = msg.get("action")
+                except (ValueError, AttributeError):
+                    msg, action = None, None
+                if not isinstance(action, str):
+                    action = None  # E.g. a list, which can't select a handler; answered by the fallback
+
+                task = asyncio.create_task(
+                    self._run(ctx, action, msg, data, fallback, received, slots, ordered_lock, connection_latency))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._log_latency(ctx, connection_latency)
+
+    async def _run(self, ctx, action, msg, raw, fallback, received, slots, ordered_lock, connection_latency):
+        # Every message gets its own context copy, so handlers can keep a job ID of their own
+        message_ctx = ActionContext(ctx.request, ctx.ws, ctx.saje_client, ctx.gebruikersID, ctx.sessieID, ctx.state)
+        message_ctx.job_id = str(uuid4())
+        spec, span = None, None
+        status = "ok"
+
+        # Everything after acquiring the slot runs in the try, so the finally always releases it
+        try:
+            spec = self.handlers.get(action)
+            # Root span of the transaction; jobs sent to SAJE by the handler continue it
+            span = tracing.Span(f"ws.{action}", gebruikersID=ctx.gebruikersID, sessieID=ctx.sessieID)
+            if spec is None:
+                await fallback(message_ctx, raw)
+                return
+
+            error = self.validate(spec, msg)
+            if error:
+                await message_ctx.send("error", f"Invalid '{action}' message: {error}")
+                return
+            if spec["admin"] and not message_ctx.is_admin:
+                technical_log(
+                    "ws-unauthorized",
+                    gebruikersID=ctx.gebruikersID,
+                    sessieID=ctx.sessieID,
+                    function_call=action,
+                )
+                await message_ctx.send("error", f"Not authorized for '{action}'")
+                return
+
+            with profiling.profile("ws", action, message_ctx.job_id):
+                if spec["ordered"]:
+                    async with ordered_lock:
+                        await spec["handler"](message_ctx, msg)
+                else:
+                    await spec["handler"](message_ctx, msg)
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        except Exception as e:
+            status = "error"
+            technical_log(
+                "ws-dispatch-error",
+                gebruikersID=ctx.gebruikersID,
+                sessieID=ctx.sessieID,
+                function_call=action,
+                error_message=str(e),
+            )
+            print(f"[Dispatcher] Error handling '{action}': {e}")
+            try:
+                await message_ctx.send("error", f"Error while handling '{action}'")
+            except Exception:
+                pass
+        finally:
+            if span is not None:
+                span.end(status)
+            slots.release()
+            elapsed_ms = (perf_counter() - received) * 1000
+            name = action if spec is not None else "unknown"
+            connection_latency.setdefault(name, []).append(elapsed_ms)
+            self.latency.setdefault(name, deque(maxlen=1024)).append(elapsed_ms)
+            metrics.observe("apr_ws_action_seconds", elapsed_ms / 1000, action=name)
+
+    def _log_latency(self, ctx, connection_latency: dict) -> None:
+        """Writes per-action latency statistics of a closed connection to the technical log."""
+        if not connection_latency:
+            return
+        technical_log(
+            "ws-action-latency",
+            gebruikersID=ctx.gebruikersID,
+            sessieID=ctx.sessieID,
+            performance_metric={
+                action: latency_summary(samples)
+                for action, samples in connection_latency.items()
+            },
+        )
+
+
+def latency_summary(samples) -> dict:
+    """Count, p50, p95 and max (in ms) of a list of latency samples."""
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "p50_ms": round(ordered[len(ordered) // 2], 2),
+        "p95_ms": round(ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)], 2),
+        "max_ms": round(ordered[-1], 2),
+    }
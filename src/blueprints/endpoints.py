@@ -1,14 +1,52 @@
 import os
-from aiofiles import open as async_open
 from sanic import Blueprint, Request
-from sanic.response import text, file, redirect, html
+from sanic.response import text, file, redirect, json, raw, empty
 from sanic.exceptions import NotFound
-from APR import GenerateReport
-from saje import SajeClient
+from APR import GenerateReport, remove_file
+from saje import SajeClient, job_key
+from ingestion import receive_upload, receive_batch, UploadTooLarge
+import assets
+import metrics
+import tracing
+import asyncio
 
 
 
 epts = Blueprint("epts")
+PAGES = ["home.html", "APR.html", "proto3.html", "proto4.html"]
+
+@epts.before_server_start
+async def load_assets(app):
+    # Pages and static assets are served from memory, see assets.py
+    await asyncio.to_thread(assets.load, PAGES)
+
+
+def serve_asset(request: Request, asset: assets.Asset, cache_control: str):
+    """Responds with the asset in the best encoding the client accepts, or 304 when its copy is current."""
+    headers = {"ETag": asset.etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if asset.matches(request.headers.get("if-none-match")):
+        return empty(status=304, headers=headers)
+    encoding = asset.select(request.headers.get("accept-encoding", ""))
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return raw(asset.bodies[encoding], content_type=asset.content_type, headers=headers)
+
+
+def serve_page(request: Request, name: str):
+    page = assets.page(name)
+    if page is None:
+        raise NotFound(f"Page {name} not found")
+    return serve_asset(request, page, assets.REVALIDATE)
+
+
+@epts.get("/static/<path:path>")
+async def static(request: Request, path: str):
+    asset = assets.static_asset(path)
+    if asset is None:
+        raise NotFound(f"/static/{path} not found")
+    # Only the version the pages link to may be cached for good
+    versioned = request.args.get("v") == asset.version
+    return serve_asset(request, asset, assets.IMMUTABLE if versioned else assets.REVALIDATE)
 
 @epts.get("/download/<job_id>")
 async def download(request: Request, job_id: str):
@@ -25,46 +63,83 @@ async def download_d_v(request: Request, job_id: str):
         return await file(file_path, filename=f"{job_id}", mime_type="text/plain")
     return text("File not found")
 
-@epts.post("/upload/<job_id>",)
+@epts.post("/upload/<job_id>", stream=True)
 async def upload(request: Request, job_id: str, saje_client: SajeClient):
-    formData = request.form
-    if formData is None:
-        return text("error, no form data provided", status=400)
-    
-    if request.files is None:
-        return text("error, No file uploaded", status=400)
-    file = request.files['file']
-    
-    with open(f"./tmp/{job_id}", "wb") as f:
-        f.write(file[0].body)
+    # The body is streamed to disk as it arrives instead of being buffered in memory
+    tmp_path = f"./tmp/{job_id}"
+    try:
+        sha256 = await receive_upload(request, job_id, tmp_path)
+    except UploadTooLarge as e:
+        return text(f"error, {e}", status=413)
+    except ValueError as e:
+        return text(f"error, {e}", status=400)
 
     #TODO SajeClient van QoPilot porten
-    saje_client.send(job_id, GenerateReport, "Generating Proces-verbaal PDF", f"./tmp/{job_id}")
+    key = job_key(GenerateReport, (tmp_path,), {}, file_hashes={tmp_path: sha256})
+    with tracing.span("http.upload", dataID=job_id):
+        owner = saje_client.send(job_id, GenerateReport, "Generating Proces-verbaal PDF", tmp_path, key=key)
+    if owner != job_id:
+        # Duplicate upload, the job status of job_id now points to the in-flight job
+        remove_file(f"./tmp/{job_id}")
     return text("uploaded")
 
+@epts.post("/upload-batch/<batch_id>", stream=True)
+async def upload_batch(request: Request, batch_id: str, saje_client: SajeClient):
+    """
+    Ingests many interrogations at once: every "files" part of the form, where ZIP archives are
+    unpacked, becomes its own GenerateReport job. The jobs run in SAJE's low-priority queue, so
+    interactive work goes first, and are grouped into one batch for /batch/<batch_id>.
+
+    Smoke test with the bundled interrogations:
+        curl -b auth=<key> $(for f in data/Interrogation_*.txt; do printf -- '-F files=@"%s" ' "$f"; done) \
+            http://127.0.0.1:8080/upload-batch/smoke-test
+    """
+    try:
+        files = await receive_batch(request, "./tmp")
+    except UploadTooLarge as e:
+        return text(f"error, {e}", status=413)
+    except ValueError as e:
+        return text(f"error, {e}", status=400)
+
+    saje_client.register_batch(batch_id, {f["ID"]: f["filename"] for f in files})
+    for f in files:
+        key = job_key(GenerateReport, (f["path"],), {}, file_hashes={f["path"]: f["sha256"]})
+        with tracing.span("http.upload-batch", dataID=f["ID"], batch=batch_id):
+            owner = saje_client.send(f["ID"], GenerateReport, f"Batch {batch_id}: {f['filename']}", f["path"],
+                                     key=key, low_priority=True)
+        if owner != f["ID"]:
+            remove_file(f["path"])
+
+    return json({"batch": batch_id, "jobs": {f["ID"]: f["filename"] for f in files}})
+
+@epts.get("/batch/<batch_id>")
+async def batch_status(request: Request, batch_id: str, saje_client: SajeClient):
+    progress = saje_client.batch_progress(batch_id)
+    if progress is None:
+        return text("Batch not found", status=404)
+    return json(progress)
+
+@epts.get("/metrics")
+async def metrics_endpoint(request: Request):
+    # Merged over all Sanic workers and the SAJE worker, see metrics.collect
+    body = await asyncio.to_thread(metrics.render_prometheus)
+    return text(body, content_type="text/plain; version=0.0.4; charset=utf-8")
+
 @epts.get('/home')
 async def home(request: Request):
-    async with async_open("templates/home.html", mode="r") as file:
-        html_content = await file.read()
-    return html(html_content)
+    return serve_page(request, "home.html")
 
 @epts.route('/APR', methods=["POST", "GET"])
 async def APR(request: Request):
-    async with async_open("templates/APR.html", mode="r") as file:
-        html_conent = await file.read()
-    return html(html_conent)
+    return serve_page(request, "APR.html")
 
 @epts.route('/APR/proto3', methods=["POST", "GET"])
 async def APRproto3(request: Request):
-    async with async_open("templates/proto3.html", mode="r") as file:
-        html_conent = await file.read()
-    return html(html_conent)
+    return serve_page(request, "proto3.html")
 
 @epts.route('/APR/proto4', methods=["POST", "GET"])
 async def APRproto4(request: Request):
-    async with async_open("templates/proto4.html", mode="r") as file:
-        html_conent = await file.read()
-    return html(html_conent)
+    return serve_page(request, "proto4.html")
 
 # handle missing pages
 @epts.exception(NotFound)
@@ -1,19 +1,36 @@
 from sanic import Blueprint, Request, Websocket
 from saje import SajeClient
+from blueprints.dispatcher import ActionContext, Dispatcher
 from uuid import uuid4
-from prompting.engine import PromptingEngine
-from setup_env import API_DICT
-from APR import GenerateReport, move_file, update_metadata, create_pdf_report, delete_metadata_entry, remove_file
-from APRLogger import technical_log, administrative_log
+from prompting.engine import shared_engine
+from prompting.thoughts import ThoughtSession, normalize_section
+from transcription import transcript_text
+import metrics
+import prefetch
+import tracing
+import profiling
+from APR import GenerateReport, move_file, update_metadata, create_pdf_report, delete_metadata_entry, remove_file, \
+    extractBlocks, open_blocks, generateThoughts, speculate
+from APRLogger import technical_log, administrative_log, load_payload
 import ujson
 import asyncio
 import os
 import datetime
 
 ws = Blueprint("ws")
-engine = PromptingEngine(API_DICT, "src/prompting/templates.json")
 
 async def handle_table_loader(ws):
+    # Reading the metadata and parsing the logs is blocking file I/O, keep it off the event loop
+    payload_data = await asyncio.to_thread(load_table_payload)
+
+    if not payload_data:
+        await ws.send(ujson.dumps({"response": "table-update", "data": "none"}))
+    else:
+        await ws.send(ujson.dumps({"response": "table-update", "data": payload_data}))
+
+
+def load_table_payload():
+    """Collects the table rows: finished reports, running and failed uploads and the log files."""
     tmp_files = []
     error_files = []
     payload_data = []
@@ -25,7 +42,7 @@ async def handle_table_loader(ws):
 
     # Load metadata JSON
     try:
-        with open(meta_data_path, "r", encoding="utf-8") as f:
+        with metrics.timer("apr_metadata_io_seconds", operation="read"), open(meta_data_path, "r", encoding="utf-8") as f:
             meta_data = ujson.load(f)
     except FileNotFoundError:
         print(f"Warning: meta_data.json not found at {meta_data_path}")
@@ -152,37 +169,57 @@ async def handle_table_loader(ws):
                 "log_errors": file_log_errors,
             })
 
-    # ------------------------------- Send payload -------------------------------
-    if not payload_data:
-        await ws.send(ujson.dumps({"response": "table-update", "data": "none"}))
-    else:
-        await ws.send(ujson.dumps({"response": "table-update", "data": payload_data}))
+    return payload_data
 
-async def monitor_job(job_id: str, ws: Websocket, shared_status: dict, gebruikersID: str = None, sessieID: str = None):
+async def monitor_job(job_id: str, ws: Websocket, shared_status: dict, gebruikersID: str = None, sessieID: str = None,
+                      done_response: str = "done"):
     """
     Polls the SAJE job status dict and notifies the websocket on cases.
+    The result of a "done" job is sent as `done_response`.
     """
-    transactieID = str(uuid4())
+    # Logged under the trace of the action that started the job, so its records join the trace's spans
+    transactieID = tracing.current_trace_id() or str(uuid4())
+    last_update_seq = None
 
     while True:
         await asyncio.sleep(0.2)
         job = shared_status.get(job_id, {})
         status = job.get("status")
         match status:
-            case "queued":
+            case None | "queued":
+                # Not picked up by the worker yet
+                continue
+
+            case "coalesced":
+                # Duplicate submission, follow the in-flight job it was attached to
+                job_id = job.get("UUID")
+                last_update_seq = None
                 continue
 
             case "ongoing":
                 continue
 
             case "update":
+                # The worker keeps the latest update in place, only forward new ones
+                if job.get("seq") == last_update_seq:
+                    continue
+                last_update_seq = job.get("seq")
+
+                technical_log(
+                    "job-update",
+                    gebruikersID=gebruikersID,
+                    sessieID=sessieID,
+                    transactieID=transactieID,
+                    dataID=job_id,
+                    update=job.get("update"),
+                )
 
                 await ws.send(ujson.dumps({"response": "update", "data": job.get("update")}))
 
             case "done":
                 # Technical logging for done case
 
-                await ws.send(ujson.dumps({"response": "done", "data": job.get("res")}))
+                await ws.send(ujson.dumps({"response": done_response, "data": job.get("res")}))
                 break
 
             case "report":
@@ -192,6 +229,10 @@ async def monitor_job(job_id: str, ws: Websocket, shared_status: dict, gebruiker
                 await ws.send(ujson.dumps({"response": "report", "data": download_link}))
                 break
 
+            case "cancelled":
+                await ws.send(ujson.dumps({"response": "cancelled", "data": job_id}))
+                break
+
             case "error":
                 # Technical logging for error case
                 error_message = f"error {job.get('error')} occurred, uwu try again"
@@ -207,378 +248,376 @@ async def monitor_job(job_id: str, ws: Websocket, shared_status: dict, gebruiker
                 await ws.send(ujson.dumps({"response": "error", "data": unknown_error_msg}))
 
 
-@ws.websocket("/ws/<id>")
-async def ws_job(request: Request, ws: Websocket, id: str, saje_client: SajeClient):
-    # Generate session identifiers for logging
-    gebruikersID = "TEST_GEBRUIKER"  # Using the websocket id as user identifier
-    sessieID = id
-
+async def monitor_batch(batch_id: str, ctx: ActionContext) -> None:
+    """Streams "batch-update" messages whenever the progress of a batch changes, until all its jobs finished."""
+    last_counts = None
     while True:
+        progress = ctx.saje_client.batch_progress(batch_id)
+        if progress is None:
+            await ctx.send("error", f"Unknown batch '{batch_id}'")
+            return
+
+        counts = tuple(progress[state] for state in ("done", "error", "cancelled", "running", "queued"))
+        if counts != last_counts:
+            last_counts = counts
+            await ctx.send("batch-update", progress)
+        if progress["finished"]:
+            await ctx.send("batch-done", progress)
+            return
         await asyncio.sleep(1)
-        data = await ws.recv()
-        if data is None:
-            continue
 
-        action = ujson.loads(data).get("action")
-        job_id = str(uuid4())
 
-        match action:
-            case "connection":
-                # Technical logging for connection
-                technical_log(
-                    "ws-connection",
-                    gebruikersID=gebruikersID,
-                    sessieID=sessieID,
-                )
+dispatcher = Dispatcher()
 
-                await ws.send(ujson.dumps({"response": "connected"}))
-                continue
 
-            case "heartbeat":
-                # Technical logging for heartbeat
-                technical_log(
-                    "heartbeat",
-                    gebruikersID=gebruikersID,
-                    sessieID=sessieID,
-                )
+def _monitor(ctx: ActionContext, job_id: str, done_response: str = "done") -> None:
+    """Launches a background task that streams the SAJE job's status to this websocket."""
+    asyncio.create_task(monitor_job(
+        job_id, ctx.ws, ctx.job_status, ctx.gebruikersID, ctx.sessieID, done_response))
 
-                await ws.send(ujson.dumps({"response": "heartbeat"}))
-                continue
 
-            case "prompt":
-                await ws.send(ujson.dumps({"response": "initiated"}))
-                prompt = ujson.loads(data).get("prompt", None)
+@dispatcher.action("connection")
+async def handle_connection(ctx: ActionContext, msg: dict):
+    # Technical logging for connection
+    technical_log(
+        "ws-connection",
+        gebruikersID=ctx.gebruikersID,
+        sessieID=ctx.sessieID,
+    )
 
-                if not prompt:
-                    await ws.send(ujson.dumps({"response": "error", "data": "no prompt passed"}))
+    await ctx.send("connected")
 
-                saje_client.send(job_id, engine.generate_response,
-                                 "Generating engine response", "verhoren", prompt=prompt)
-                # Launch background task to monitor SAJE job
-                asyncio.create_task(monitor_job(
-                    job_id, ws, request.app.shared_ctx.job_status, gebruikersID, sessieID))
-                continue
 
-            case "json_upload":
-                await ws.send(ujson.dumps({"response": "initiated"}))
-                template = ujson.loads(data).get("template", None)
-                first_segment_text = ujson.loads(data).get("fileContent").get(
-                    "output").get("segments")[0].get("text", None)
+@dispatcher.action("heartbeat")
+async def handle_heartbeat(ctx: ActionContext, msg: dict):
+    # Technical logging for heartbeat
+    technical_log(
+        "heartbeat",
+        gebruikersID=ctx.gebruikersID,
+        sessieID=ctx.sessieID,
+    )
 
-                if not template or not first_segment_text:
-                    await ws.send(ujson.dumps({"response": "error", "data": "no template or text provided"}))
+    await ctx.send("heartbeat")
 
-                saje_client.send(job_id, engine.generate_response,
-                                 "Generating engine response", template, prompt=first_segment_text)
-                # Launch background task to monitor SAJE job
-                asyncio.create_task(monitor_job(
-                    job_id, ws, request.app.shared_ctx.job_status, gebruikersID, sessieID))
-                continue
 
-            case "table-update":
-                # Technical and Administrative logging for table-update
-                technical_log(
-                    "table-update",
-                    gebruikersID=gebruikersID,
-                    sessieID=sessieID,
-                )
+@dispatcher.action("prompt", required={"prompt": str})
+async def handle_prompt(ctx: ActionContext, msg: dict):
+    await ctx.send("initiated")
 
-                await handle_table_loader(ws)
-                continue
+    ctx.saje_client.send(ctx.job_id, shared_engine().generate_response,
+                         "Generating engine response", "verhoren", prompt=msg["prompt"])
+    # Launch background task to monitor SAJE job
+    _monitor(ctx, ctx.job_id)
 
-            case "Blocks":
-                filename_pdf = ujson.loads(data).get("filename")
-                if not filename_pdf:
-                    await ws.send(ujson.dumps({"response": "error", "data": "No filename provided for Blocks action"}))
-                    continue
 
-                meta_data_path = "./data/meta_data.json"
-                try:
-                    with open(meta_data_path, "r", encoding="utf-8") as f:
-                        meta_data = ujson.load(f)
-                except (FileNotFoundError, ValueError):
-                    await ws.send(ujson.dumps({"response": "error", "data": "Metadata file not found or is invalid."}))
-                    continue
-                
-                item_metadata = meta_data.get(filename_pdf)
-                if not item_metadata:
-                    await ws.send(ujson.dumps({"response": "error", "data": f"No metadata found for {filename_pdf}"}))
-                    continue
-
-                original_input = item_metadata.get("original_input")
-                if not original_input:
-                     await ws.send(ujson.dumps({"response": "error", "data": f"No original_input found for {filename_pdf}"}))
-                     continue
-
-                json_prompt = f'''
-                Analyze the following interrogation transcript.
-                Your task is to extract two types of information:
-                1.  A list of all proper names of individuals mentioned.
-                2.  Pairs of questions asked and the verbatim answers given in response.
-
-                Return the output as a single valid JSON object.
-                The JSON object should have:
-                - A key "extracted names" with a value that is a list of strings (the names).
-                - For each question-answer pair you find, the question should be a key, and its value should be a list containing a single string: the verbatim answer.
-
-                Example of final JSON structure:
-                {{
-                  "extracted names": ["John Doe", "Officer Smith"],
-                  "What is your full name?": ["My name is John Doe."],
-                  "Where were you on the night of October 31st?": ["I was at a friend's party."]
-                }}
-
-                Here is the text to analyze:
-                ---
-                {original_input}
-                ---
-
-                Your response should be ONLY the JSON object. Do not include any other text or explanations.
-                '''
-                
-                try:
-                    response_str = engine.generate_response("verhoor-vragen-gpt-4o", prompt=json_prompt)
-                    # Clean the response to get only the JSON
-                    response_str = response_str.strip()
-                    if response_str.startswith("```json"):
-                        response_str = response_str[7:]
-                    if response_str.endswith("```"):
-                        response_str = response_str[:-3]
-                    response_str = response_str.strip()
-                    
-                    response_data = ujson.loads(response_str)
-                except Exception as e:
-                    print(f"Failed to get or parse structured data from LLM: {e}")
-                    response_data = {
-                        "extracted names": [], 
-                        "responses to shown item 1": [], 
-                        "gestelde vragen": [f"Error: Could not process text. Details: {e}"] 
-                    }
-
-                await ws.send(ujson.dumps({"response": "word-interface-data", "data": response_data}))
-                continue
-
-            case "pv-individual-retry":
-                # Administrative logging for pv-individual-retry
-
-                file = ujson.loads(data).get("file", None)
-                move_file(f"./tmp/error/{file}", "./tmp/")
-                saje_client.send(file, GenerateReport,
-                                 "Updating MetaData.json", f"./tmp/{file}")
-                continue
-
-            case "update-pv-information":
-                # Administrative logging for update-pv-information
-                updated_data = ujson.loads(data)['currentData']
-                administrative_log(
-                    "update-pv-information",
-                    gebruikersID=gebruikersID,
-                    sessieID=sessieID,
-                    updated_data=updated_data,
-                )
+@dispatcher.action("json_upload", required={"template": str, "fileContent": dict})
+async def handle_json_upload(ctx: ActionContext, msg: dict):
+    await ctx.send("initiated")
+    try:
+        # All segments, merged into speaker turns
+        output = msg["fileContent"].get("output") or msg["fileContent"]
+        transcript = transcript_text(output.get("segments") or [])
+    except (AttributeError, KeyError, TypeError):
+        transcript = None
 
-                if not updated_data:
-                    continue
+    if not transcript:
+        await ctx.send("error", "no template or text provided")
+        return
 
-                update_metadata(updated_data)
-                continue
+    ctx.saje_client.send(ctx.job_id, shared_engine().generate_response,
+                         "Generating engine response", msg["template"], prompt=transcript)
+    # Launch background task to monitor SAJE job
+    _monitor(ctx, ctx.job_id)
 
-            case "generateReport":
-                # Administrative logging for generateReport
-                ID = ujson.loads(data).get("ID", None)
-                administrative_log(
-                    "generateReport",
-                    gebruikersID=gebruikersID,
-                    sessieID=sessieID,
-                    fileId=ID
-                )
 
-                saje_client.send(
-                    ID, create_pdf_report, "creating pdf after generate_report websocket send", ID)
-                asyncio.create_task(monitor_job(
-                    ID, ws, request.app.shared_ctx.job_status, gebruikersID, sessieID))
-                continue
+@dispatcher.action("watch-job", required={"ID": str})
+async def handle_watch_job(ctx: ActionContext, msg: dict):
+    # Stream progress of a job that was started outside of this websocket (e.g. /upload)
+    _monitor(ctx, msg["ID"])
 
-            case "cancel-task":
-                # Administrative logging for cancel-task
-                ID = ujson.loads(data).get("filename", None)
-                administrative_log(
-                    "cancel-task",
-                    gebruikersID=gebruikersID,
-                    sessieID=sessieID,
-                    fileID=ID
-                )
 
-                remove_file(f"./tmp/{ID}")
-                saje_client.send(ID, delete_metadata_entry,
-                                 "deleting metadata entry of cancelled task", ID)
-                continue
+@dispatcher.action("watch-batch", required={"batch": str})
+async def handle_watch_batch(ctx: ActionContext, msg: dict):
+    # Stream the combined progress of a /upload-batch upload
+    asyncio.create_task(monitor_batch(msg["batch"], ctx))
 
-            case "delete-pv":
-                # Administrative logging for delete-pv
-                ID = ujson.loads(data).get("filename", None)
 
-                administrative_log(
-                    "delete-pv",
-                    gebruikersID=gebruikersID,
-                    sessieID=sessieID,
-                    fileId=ID
-                )
+@dispatcher.action("table-update")
+async def handle_table_update(ctx: ActionContext, msg: dict):
+    # Technical and Administrative logging for table-update
+    technical_log(
+        "table-update",
+        gebruikersID=ctx.gebruikersID,
+        sessieID=ctx.sessieID,
+    )
 
-                delete_metadata_entry(ID)
-                continue
+    await handle_table_loader(ctx.ws)
 
-            case "delete-unfinished-pv":
-                ID = ujson.loads(data).get("filename", None)
 
-                administrative_log(
-                    "delete-unfinished-pv",
-                    gebruikersID=gebruikersID,
-                    sessieID=sessieID,
-                    fileId=ID
-                )
+@dispatcher.action("metrics")
+async def handle_metrics(ctx: ActionContext, msg: dict):
+    # Counters and latency percentiles of all processes, for the logging view
+    await ctx.send("metrics", await asyncio.to_thread(metrics.summary))
 
-                remove_file(f"./tmp/error/{ID}")
-                continue
 
-            case "update-and-generate-pdf":
-                update_data = ujson.loads(data).get("data")
-                if not update_data:
-                    await ws.send(ujson.dumps({"response": "error", "data": "No data provided"}))
-                    continue
-                
-                file_id = update_data.get("ID")
-                if not file_id:
-                    await ws.send(ujson.dumps({"response": "error", "data": "No ID provided in update data"}))
-                    continue
-
-                # 1. Update metadata
-                try:
-                    update_metadata(update_data)
-                    administrative_log(
-                        "update-pv-information",
-                        gebruikersID=gebruikersID,
-                        sessieID=sessieID,
-                        updated_data=update_data,
-                    )
-                except Exception as e:
-                    await ws.send(ujson.dumps({"response": "error", "data": f"Failed to update metadata: {e}"}))
-                    continue
+@dispatcher.action("profiling", optional={"targets": list, "rate": (int, float), "mode": str}, admin=True)
+async def handle_profiling(ctx: ActionContext, msg: dict):
+    # Switches profiling of SAJE jobs and websocket actions for all processes; without fields it reports the settings
+    if any(field in msg for field in ("targets", "rate", "mode")):
+        try:
+            config = await asyncio.to_thread(profiling.configure, msg.get("targets"), msg.get("rate"), msg.get("mode"))
+        except ValueError as e:
+            await ctx.send("error", str(e))
+            return
+        administrative_log(
+            "profiling-configured",
+            gebruikersID=ctx.gebruikersID,
+            sessieID=ctx.sessieID,
+            updated_data=config,
+        )
+    else:
+        config = profiling.settings()
+    await ctx.send("profiling", config)
 
-                # 2. Generate PDF
-                administrative_log(
-                    "generateReport",
-                    gebruikersID=gebruikersID,
-                    sessieID=sessieID,
-                    fileId=file_id
-                )
-                saje_client.send(
-                    file_id, create_pdf_report, "Creating PDF after metadata update", file_id)
-                asyncio.create_task(monitor_job(
-                    file_id, ws, request.app.shared_ctx.job_status, gebruikersID, sessieID))
-                continue
 
-            case "requested-thought":
-                request_data = ujson.loads(data)
-                filename = request_data.get("filename")
-                context = request_data.get("context") # This context includes preamble fields and proces_verbaal
+@dispatcher.action("log-payload", required={"hash": str})
+async def handle_log_payload(ctx: ActionContext, msg: dict):
+    # Large logged values are stored once and referenced by input_content_hash in the log records
+    try:
+        payload = await asyncio.to_thread(load_payload, msg["hash"])
+    except KeyError:
+        # Pruned (see logarchive.py prune) or never stored; the view keeps showing the reference
+        await ctx.send("log-payload", {"hash": msg["hash"], "data": None, "error": "Unknown log payload"})
+        return
+    await ctx.send("log-payload", {"hash": msg["hash"], "data": payload})
+
+
+@dispatcher.action("Blocks", required={"filename": str})
+async def handle_blocks(ctx: ActionContext, msg: dict):
+    filename_pdf = msg["filename"]
+
+    # Usually prefetched after GenerateReport or on selection, otherwise extracted by SAJE
+    cached = await asyncio.to_thread(open_blocks, filename_pdf)
+    if cached is not None:
+        await ctx.send("word-interface-data", cached)
+        return
+
+    ctx.saje_client.send(ctx.job_id, extractBlocks, "Extracting Blocks", filename_pdf)
+    _monitor(ctx, ctx.job_id, done_response="word-interface-data")
+
+
+@dispatcher.action("prefetch", required={"filename": str}, optional={"kinds": list})
+async def handle_prefetch(ctx: ActionContext, msg: dict):
+    # A report was selected in the table: compute what its editor asks for first, behind all interactive jobs
+    filename = msg["filename"]
+    kinds = [kind for kind in msg.get("kinds") or prefetch.PREFETCH_KINDS
+             if (filename, kind) not in ctx.state["prefetched"]]
+    if kinds:
+        queued = speculate(ctx.saje_client, filename, kinds)
+        ctx.state["prefetched"].update((filename, kind) for kind in queued)
+
+
+@dispatcher.action("pv-individual-retry", required={"file": str}, ordered=True)
+async def handle_pv_individual_retry(ctx: ActionContext, msg: dict):
+    # Administrative logging for pv-individual-retry
+
+    file = msg["file"]
+    move_file(f"./tmp/error/{file}", "./tmp/")
+    owner = ctx.saje_client.send(file, GenerateReport,
+                                 "Updating MetaData.json", f"./tmp/{file}")
+    if owner != file:
+        # Same transcript is already being processed under another ID
+        remove_file(f"./tmp/{file}")
+    _monitor(ctx, file)
+
+
+@dispatcher.action("update-pv-information", optional={"currentData": dict}, ordered=True)
+async def handle_update_pv_information(ctx: ActionContext, msg: dict):
+    # Administrative logging for update-pv-information
+    updated_data = msg.get("currentData")
+    administrative_log(
+        "update-pv-information",
+        gebruikersID=ctx.gebruikersID,
+        sessieID=ctx.sessieID,
+        updated_data=updated_data,
+    )
+
+    if not updated_data:
+        return
+
+    update_metadata(updated_data)
+
+
+@dispatcher.action("generateReport", required={"ID": str}, ordered=True)
+async def handle_generate_report(ctx: ActionContext, msg: dict):
+    # Administrative logging for generateReport
+    ID = msg["ID"]
+    administrative_log(
+        "generateReport",
+        gebruikersID=ctx.gebruikersID,
+        sessieID=ctx.sessieID,
+        fileId=ID
+    )
+
+    ctx.saje_client.send(
+        ID, create_pdf_report, "creating pdf after generate_report websocket send", ID)
+    _monitor(ctx, ID)
+
+
+@dispatcher.action("cancel-task", required={"filename": str}, ordered=True)
+async def handle_cancel_task(ctx: ActionContext, msg: dict):
+    # Administrative logging for cancel-task
+    ID = msg["filename"]
+    administrative_log(
+        "cancel-task",
+        gebruikersID=ctx.gebruikersID,
+        sessieID=ctx.sessieID,
+        fileID=ID
+    )
+
+    # Stops the running GenerateReport job (and its LLM calls) for this upload
+    ctx.saje_client.cancel(ID)
+    remove_file(f"./tmp/{ID}")
+    ctx.saje_client.send(ID, delete_metadata_entry,
+                         "deleting metadata entry of cancelled task", ID)
+
+
+@dispatcher.action("delete-pv", required={"filename": str}, ordered=True)
+async def handle_delete_pv(ctx: ActionContext, msg: dict):
+    # Administrative logging for delete-pv
+    ID = msg["filename"]
+
+    administrative_log(
+        "delete-pv",
+        gebruikersID=ctx.gebruikersID,
+        sessieID=ctx.sessieID,
+        fileId=ID
+    )
+
+    delete_metadata_entry(ID)
+
+
+@dispatcher.action("delete-unfinished-pv", required={"filename": str}, ordered=True)
+async def handle_delete_unfinished_pv(ctx: ActionContext, msg: dict):
+    ID = msg["filename"]
+
+    administrative_log(
+        "delete-unfinished-pv",
+        gebruikersID=ctx.gebruikersID,
+        sessieID=ctx.sessieID,
+        fileId=ID
+    )
+
+    remove_file(f"./tmp/error/{ID}")
+
+
+@dispatcher.action("update-and-generate-pdf", required={"data": dict}, ordered=True)
+async def handle_update_and_generate_pdf(ctx: ActionContext, msg: dict):
+    update_data = msg["data"]
+
+    file_id = update_data.get("ID")
+    if not file_id:
+        await ctx.send("error", "No ID provided in update data")
+        return
+
+    # 1. Update metadata
+    try:
+        update_metadata(update_data)
+        administrative_log(
+            "update-pv-information",
+            gebruikersID=ctx.gebruikersID,
+            sessieID=ctx.sessieID,
+            updated_data=update_data,
+        )
+    except Exception as e:
+        await ctx.send("error", f"Failed to update metadata: {e}")
+        return
+
+    # 2. Generate PDF
+    administrative_log(
+        "generateReport",
+        gebruikersID=ctx.gebruikersID,
+        sessieID=ctx.sessieID,
+        fileId=file_id
+    )
+    ctx.saje_client.send(
+        file_id, create_pdf_report, "Creating PDF after metadata update", file_id)
+    _monitor(ctx, file_id)
+
+
+@dispatcher.action("requested-thought", required={"filename": str, "context": dict})
+async def handle_requested_thought(ctx: ActionContext, msg: dict):
+    filename = msg["filename"]
+    context = msg["context"] # This context includes preamble fields and proces_verbaal
+    proces_verbaal_draft = context.get("proces_verbaal", "") # User's current draft
+
+    section = normalize_section(proces_verbaal_draft)
+    if filename not in ctx.state["editor_opened"]:
+        # The editor's first request: prefetched for the stored draft when the report was finished or selected
+        ctx.state["editor_opened"].add(filename)
+        prefetched = await asyncio.to_thread(prefetch.cache.claim, "thoughts", filename, section)
+        if prefetched is not None:
+            ctx.state["thoughts"].cache.put(filename, section, prefetched["data"])
+        elif prefetch.enabled("thoughts"):
+            prefetch.record("thoughts", "miss")
+
+    def generate(cancel_event):
+        return generateThoughts(filename, context, cancel_event=cancel_event)
 
-                if not filename or not context:
-                    await ws.send(ujson.dumps({"response": "error", "data": "Bestandsnaam of context ontbreekt voor het genereren van gedachten."}))
-                    continue
-                
-                meta_data_path = "./data/meta_data.json"
-                original_input = ""
-                try:
-                    with open(meta_data_path, "r", encoding="utf-8") as f:
-                        meta_data = ujson.load(f)
-                        item_metadata = meta_data.get(filename)
-                        if item_metadata and "original_input" in item_metadata:
-                            original_input = item_metadata["original_input"]
-                        else:
-                            await ws.send(ujson.dumps({"response": "error", "data": f"Geen originele input gevonden voor {filename} in metadata."}))
-                            continue
-                except FileNotFoundError:
-                    await ws.send(ujson.dumps({"response": "error", "data": "metadata.json niet gevonden."}))
-                    continue
-                except Exception as e:
-                    await ws.send(ujson.dumps({"response": "error", "data": f"Fout bij laden metadata: {e}"}))
-                    continue
+    try:
+        # Debounced, cancelled when superseded and cached per (report, draft section)
+        thoughts = await ctx.state["thoughts"].request(filename, proces_verbaal_draft, generate)
+    except LookupError as e:
+        await ctx.send("error", str(e))
+        return
+    except Exception as e:
+        technical_log(
+            "llm-thought-generation-error",
+            gebruikersID=ctx.gebruikersID,
+            sessieID=ctx.sessieID,
+            error=str(e),
+            context={
+                "filename": filename,
+            }
+        )
+        await ctx.send("error", f"Fout bij het genereren van gedachten: {e}")
+        return
+
+    if thoughts is None:
+        # A newer request of this connection took over
+        return
+    await ctx.send("thought-suggestions", thoughts)
+
+
+async def handle_unknown(ctx: ActionContext, data: str):
+    technical_log(
+        "unknow communication",
+        gebruikersID=ctx.gebruikersID,
+        sessieID=ctx.sessieID,
+        params=data
+    )
+    print(f"unknown communication: {data}")
+
+    await ctx.send("error", "Unexpected communication")
 
-                # Extract individual fields from context received from frontend
-                datum = context.get("datum", "N/A")
-                tijd = context.get("tijd", "N/A")
-                locatie = context.get("locatie", "N/A")
-                verdachte = context.get("verdachte", "N/A")
-                proces_verbaal_draft = context.get("proces_verbaal", "") # User's current draft
-
-                llm_prompt = f"""
-                Je bent een assistent die de gebruiker helpt met het opstellen van een proces-verbaal.
-                Analyseer de volgende originele transcriptie van een verhoor en de huidige conceptversie van het proces-verbaal van de gebruiker.
-                Genereer 3 tot 5 beknopte en contextueel relevante gedachten die de gebruiker kunnen helpen bij het schrijven van het proces-verbaal.
-                Elke gedachte moet een korte zin of zinsnede zijn die een inzicht, een vraag, een mogelijke inconsistentie, een relevante observatie, of een alternatief perspectief biedt op basis van de GEHELE verhoortekst, in relatie tot wat al in het conceptproces-verbaal staat.
-                De gedachten moeten in het Nederlands zijn en als een JSON-array van strings worden geretourneerd.
-
-                Originele Verhoortranscriptie:
-                ---
-                {original_input}
-                ---
-
-                Huidig concept Proces-verbaal:
-                ---
-                Datum: {datum}
-                Tijd: {tijd}
-                Locatie: {locatie}
-                Verdachte: {verdachte}
-                Proces-verbaal tekst:
-                {proces_verbaal_draft}
-                ---
-
-                Geef alleen de JSON-array terug. Voorbeeld:
-                ["Overweeg de alibi-details van de verdachte.", "Zijn er inconsistenties in de tijdlijn?", "Welke motieven kunnen aanwezig zijn?", "Vergelijk met soortgelijke zaken.", "Focus op de emotionele toestand van getuigen."]
-                """
-
-                try:
-                    response_str = engine.generate_response("thought-generator", prompt=llm_prompt)
-                    
-                    # Clean the response to get only the JSON
-                    response_str = response_str.strip()
-                    if response_str.startswith("```json"):
-                        response_str = response_str[7:]
-                    if response_str.endswith("```"):
-                        response_str = response_str[:-3]
-                    response_str = response_str.strip()
-
-                    thoughts = ujson.loads(response_str)
-                    if not isinstance(thoughts, list):
-                        raise ValueError("LLM-antwoord is geen lijst met gedachten.")
-                    
-                    # Ensure thoughts are in Dutch, if not, attempt translation or flag
-                    # (For this task, we assume the LLM will generate in Dutch based on prompt)
-
-                    await ws.send(ujson.dumps({"response": "thought-suggestions", "data": thoughts}))
-                except Exception as e:
-                    technical_log(
-                        "llm-thought-generation-error",
-                        gebruikersID=gebruikersID,
-                        sessieID=sessieID,
-                        error=str(e),
-                        context={
-                            "filename": filename,
-                            "llm_prompt": llm_prompt # Log the constructed prompt
-                        } 
-                    )
-                    await ws.send(ujson.dumps({"response": "error", "data": f"Fout bij het genereren van gedachten: {e}"}))
-                continue
 
-            case _:
-                technical_log(
-                    "unknow communication",
-                    gebruikersID=gebruikersID,
-                    sessieID=sessieID,
-                    params=data
-                )
-                print(f"unknown communication: {data}")
+@ws.websocket("/ws/<id>")
+async def ws_job(request: Request, ws: Websocket, id: str, saje_client: SajeClient):
+    # Generate session identifiers for logging
+    gebruikersID = "TEST_GEBRUIKER"  # Using the websocket id as user identifier
+    sessieID = id
 
-                await ws.send(ujson.dumps({"response": "error", "data": "Unexpected communication"}))
-                continue
+    ctx = ActionContext(request, ws, saje_client, gebruikersID, sessieID)
+    ctx.state["thoughts"] = ThoughtSession()
+    ctx.state["prefetched"] = set()  # (report, kind) prefetches this connection asked for
+    ctx.state["editor_opened"] = set()  # Reports whose first thought request was counted as prefetch hit or miss
+    try:
+        await dispatcher.serve(ctx, handle_unknown)
+    finally:
+        if ctx.state["thoughts"].requests:
+            technical_log(
+                "thought-generation",
+                gebruikersID=gebruikersID,
+                sessieID=sessieID,
+                performance_metric=ctx.state["thoughts"].stats(),
+            )
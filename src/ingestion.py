@@ -0,0 +1,292 @@
+import asyncio
+import hashlib
+import os
+import re
+import zipfile
+from uuid import uuid4
+from aiofiles import open as async_open
+
+INCOMING_DIRECTORY = "./tmp/incoming"
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "50")) * 1024 * 1024
+# Limit for a whole batch request, and for the unpacked content of a ZIP archive in it
+MAX_BATCH_BYTES = int(os.getenv("MAX_BATCH_MB", "500")) * 1024 * 1024
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class MultipartStreamParser:
+    """
+    Incremental multipart/form-data parser. Feed it the request body chunk by chunk;
+    it yields `(part, field_name, filename, data)` tuples with the content of each part as it arrives,
+    holding back only enough bytes to recognise a boundary split over two chunks.
+    `part` is the index of the part in the body, so consecutive chunks of one file can be told
+    apart from the next file.
+    """
+
+    def __init__(self, content_type: str) -> None:
+        match = re.search(r'boundary="?([^";]+)"?', content_type or "")
+        if not match:
+            raise ValueError("No multipart boundary in Content-Type")
+        boundary = match.group(1).encode("latin-1")
+        self.opening = b"--" + boundary
+        self.delimiter = b"\r\n--" + boundary
+        self.buffer = b""
+        self.state = "preamble"
+        self.part = -1
+        self.name = None
+        self.filename = None
+
+    def feed(self, chunk: bytes):
+        self.buffer += chunk
+        while True:
+            match self.state:
+                case "preamble":
+                    index = self.buffer.find(self.opening)
+                    if index < 0:
+                        self.buffer = self.buffer[-len(self.opening):]
+                        return
+                    self.buffer = self.buffer[index + len(self.opening):]
+                    self.state = "boundary"
+
+                case "boundary":
+                    # After a boundary: CRLF starts the next part, "--" ends the body
+                    if len(self.buffer) < 2:
+                        return
+                    if self.buffer.startswith(b"--"):
+                        self.state = "done"
+                        self.buffer = b""
+                        return
+                    self.buffer = self.buffer[2:]
+                    self.state = "headers"
+
+                case "headers":
+                    index = self.buffer.find(b"\r\n\r\n")
+                    if index < 0:
+                        return
+                    self.name, self.filename = self._parse_headers(self.buffer[:index])
+                    self.part += 1
+                    self.buffer = self.buffer[index + 4:]
+                    self.state = "body"
+
+                case "body":
+                    index = self.buffer.find(self.delimiter)
+                    if index < 0:
+                        keep = len(self.delimiter) - 1
+                        if len(self.buffer) > keep:
+                            yield self.part, self.name, self.filename, self.buffer[:-keep]
+                            self.buffer = self.buffer[-keep:]
+                        return
+                    if index:
+                        yield self.part, self.name, self.filename, self.buffer[:index]
+                    self.buffer = self.buffer[index + len(self.delimiter):]
+                    self.state = "boundary"
+
+                case _:
+                    return
+
+    @staticmethod
+    def _parse_headers(raw: bytes) -> tuple[str | None, str | None]:
+        disposition = ""
+        for line in raw.decode("utf-8", errors="replace").split("\r\n"):
+            if line.lower().startswith("content-disposition:"):
+                disposition = line
+        name = re.search(r'\bname="([^"]*)"', disposition)
+        filename = re.search(r'\bfilename="([^"]*)"', disposition)
+        return (name.group(1) if name else None, filename.group(1) if filename else None)
+
+
+class UploadSink:
+    """
+    Writes an upload to a temporary file in INCOMING_DIRECTORY while hashing it, and moves it
+    into place atomically on commit, so SAJE and the table never see a half-written file.
+    """
+
+    def __init__(self, job_id: str, max_bytes: int = MAX_UPLOAD_BYTES) -> None:
+        os.makedirs(INCOMING_DIRECTORY, exist_ok=True)
+        self.part_path = os.path.join(INCOMING_DIRECTORY, f"{os.path.basename(job_id)}.part")
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.file = None
+
+    async def __aenter__(self) -> "UploadSink":
+        self.file = await async_open(self.part_path, mode="wb")
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.file.close()
+        if exc_type is not None:
+            self.discard()
+
+    async def write(self, data: bytes) -> None:
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise UploadTooLarge(f"Upload exceeds {self.max_bytes} bytes")
+        self.sha256.update(data)
+        await self.file.write(data)
+
+    def commit(self, destination: str) -> str:
+        os.replace(self.part_path, destination)
+        return destination
+
+    def discard(self) -> None:
+        try:
+            os.remove(self.part_path)
+        except OSError:
+            pass
+
+
+async def receive_upload(request, job_id: str, destination: str, field: str = "file") -> str:
+    """
+    Streams the `field` part of a multipart request body to `destination`.
+
+    :return: The sha256 hex digest of the stored file.
+    :raises UploadTooLarge: If the body exceeds MAX_UPLOAD_BYTES.
+    :raises ValueError: If the request is not multipart or contains no such part.
+    """
+    content_length = int(request.headers.get("content-length") or 0)
+    if content_length > MAX_UPLOAD_BYTES:
+        raise UploadTooLarge(f"Upload exceeds {MAX_UPLOAD_BYTES} bytes")
+
+    parser = MultipartStreamParser(request.headers.get("content-type"))
+    received = False
+
+    async with UploadSink(job_id) as sink:
+        while True:
+            chunk = await request.stream.read()
+            if chunk is None:
+                break
+            for _, name, _, data in parser.feed(chunk):
+                if name == field:
+                    received = True
+                    await sink.write(data)
+
+        if not received:
+            raise ValueError(f"No '{field}' part in upload")
+
+    sink.commit(destination)
+    return sink.sha256.hexdigest()
+
+
+def _hidden(member: str) -> bool:
+    """Archive entries that are not interrogations: OS metadata folders and dotfiles."""
+    parts = member.replace("\\", "/").split("/")
+    return "__MACOSX" in parts or any(part.startswith(".") for part in parts if part)
+
+
+def extract_archive(archive_path: str, directory: str) -> list[dict]:
+    """
+    Unpacks the files of a ZIP archive into `directory`, each under a new job ID.
+    Sizes are checked while copying, as the sizes in the archive's directory can't be trusted.
+
+    :return: One `{"ID", "filename", "path", "sha256"}` dict per file, in archive order.
+    :raises UploadTooLarge: If a file exceeds MAX_UPLOAD_BYTES or all files together MAX_BATCH_BYTES.
+    :raises ValueError: If the file is not a valid ZIP archive.
+    """
+    files, total = [], 0
+    try:
+        with zipfile.ZipFile(archive_path) as archive:
+            for member in archive.infolist():
+                if member.is_dir() or _hidden(member.filename):
+                    continue
+
+                job_id = str(uuid4())
+                part_path = os.path.join(INCOMING_DIRECTORY, f"{job_id}.part")
+                sha256, size = hashlib.sha256(), 0
+                try:
+                    with archive.open(member) as source, open(part_path, "wb") as target:
+                        while chunk := source.read(64 * 1024):
+                            size += len(chunk)
+                            total += len(chunk)
+                            if size > MAX_UPLOAD_BYTES or total > MAX_BATCH_BYTES:
+                                raise UploadTooLarge(f"Archive content exceeds the upload limit at {member.filename}")
+                            sha256.update(chunk)
+                            target.write(chunk)
+                except BaseException:
+                    os.remove(part_path)
+                    raise
+
+                path = os.path.join(directory, job_id)
+                os.replace(part_path, path)
+                files.append({"ID": job_id, "filename": os.path.basename(member.filename),
+                              "path": path, "sha256": sha256.hexdigest()})
+    except BaseException as e:
+        _remove_stored(files)
+        if isinstance(e, zipfile.BadZipFile):
+            raise ValueError(f"Invalid ZIP archive: {e}") from e
+        raise
+    return files
+
+
+def _remove_stored(files: list[dict]) -> None:
+    for stored in files:
+        try:
+            os.remove(stored["path"])
+        except OSError:
+            pass
+
+
+async def receive_batch(request, directory: str, field: str = "files") -> list[dict]:
+    """
+    Streams every file in the `field` parts of a multipart request body to `directory`, each under
+    a new job ID. ZIP archives are unpacked, so their files become separate entries.
+
+    :return: One `{"ID", "filename", "path", "sha256"}` dict per file, in upload order.
+    :raises UploadTooLarge: If a file exceeds MAX_UPLOAD_BYTES or the body MAX_BATCH_BYTES.
+    :raises ValueError: If the request is not multipart or contains no files.
+    """
+    content_length = int(request.headers.get("content-length") or 0)
+    if content_length > MAX_BATCH_BYTES:
+        raise UploadTooLarge(f"Batch exceeds {MAX_BATCH_BYTES} bytes")
+
+    parser = MultipartStreamParser(request.headers.get("content-type"))
+    received = []  # (UploadSink, filename) per file part, in order
+    files = []
+    current_part, sink, total = None, None, 0
+
+    try:
+        while True:
+            chunk = await request.stream.read()
+            if chunk is None:
+                break
+            total += len(chunk)
+            if total > MAX_BATCH_BYTES:
+                raise UploadTooLarge(f"Batch exceeds {MAX_BATCH_BYTES} bytes")
+
+            for part, name, filename, data in parser.feed(chunk):
+                if name != field or not filename:
+                    continue
+                if part != current_part:
+                    if sink is not None:
+                        await sink.__aexit__(None, None, None)
+                    current_part = part
+                    sink = await UploadSink(str(uuid4())).__aenter__()
+                    received.append((sink, filename))
+                await sink.write(data)
+
+        if sink is not None:
+            await sink.__aexit__(None, None, None)
+            sink = None
+        if not received:
+            raise ValueError(f"No '{field}' files in upload")
+
+        for stored, filename in received:
+            if filename.lower().endswith(".zip"):
+                files.extend(await asyncio.to_thread(extract_archive, stored.part_path, directory))
+                stored.discard()
+                continue
+            job_id = os.path.basename(stored.part_path).removesuffix(".part")
+            path = stored.commit(os.path.join(directory, job_id))
+            files.append({"ID": job_id, "filename": os.path.basename(filename),
+                          "path": path, "sha256": stored.sha256.hexdigest()})
+        return files
+
+    except BaseException:
+        if sink is not None:
+            await sink.__aexit__(None, None, None)
+        for stored, _ in received:
+            stored.discard()
+        _remove_stored(files)
+        raise
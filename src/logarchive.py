@@ -0,0 +1,532 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+# Archived segments of a log, partitioned by the UTC day of their records:
+#   <archive>/<log>/<YYYY>/<MM>/<DD>/<log>-<HHMMSS>-<digest>.jsonl.gz  with an .index.json next to it
+ARCHIVE_DIRNAME = "archive"
+INDEX_SUFFIX = ".index.json"
+# Per log, how far each rotated file (by inode) has been archived: <archive>/<log>/offsets.json
+OFFSETS_FILENAME = "offsets.json"
+# The payload store of the logs (see APRLogger.PayloadStore), next to the archive
+PAYLOADS_DIRNAME = "payloads"
+# Days that archived segments are kept by `prune`, 0 to keep them forever
+RETENTION_DAYS = int(os.getenv("APR_LOG_RETENTION_DAYS", "365"))
+
+_HASH_PATTERN = re.compile(r'"input_content_hash": ?"([0-9a-f]{64})"')
+# Records without a usable timestamp, e.g. truncated lines of a crashed process
+_UNDATED = "undated"
+
+
+def _parse_time(value: str) -> datetime | None:
+    try:
+        moment = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def _partition(archive_directory: str, log_name: str, day: str) -> str:
+    if day == _UNDATED:
+        return os.path.join(archive_directory, log_name, _UNDATED)
+    return os.path.join(archive_directory, log_name, *day.split("-"))
+
+
+class _Segment:
+    """The records of one day of a rotated log file, written compressed while they are read."""
+
+    def __init__(self, directory: str, tmp_path: str) -> None:
+        self.directory = directory
+        self.tmp_path = tmp_path
+        os.makedirs(directory, exist_ok=True)
+        self.file = gzip.open(tmp_path, "wb", compresslevel=6)
+        self.index = {
+            "records": 0,
+            "bytes": 0,
+            "start": None,
+            "end": None,
+            "event_types": {},
+            "event_sources": {},
+            "sessieIDs": set(),
+            "gebruikersIDs": set(),
+            "payload_hashes": set(),
+        }
+        self.first = self.last = None
+
+    def add(self, line: bytes, record: dict | None, moment: datetime | None) -> None:
+        self.file.write(line)
+        index = self.index
+        index["records"] += 1
+        index["bytes"] += len(line)
+        if moment is not None:
+            if self.first is None or moment < self.first:
+                self.first, index["start"] = moment, record["datetime_utc"]
+            if self.last is None or moment > self.last:
+                self.last, index["end"] = moment, record["datetime_utc"]
+        if record is not None:
+            event_type = record.get("event_type") or "unknown"
+            index["event_types"][event_type] = index["event_types"].get(event_type, 0) + 1
+            event_source = record.get("event_source") or "unknown"
+            index["event_sources"][event_source] = index["event_sources"].get(event_source, 0) + 1
+            if record.get("sessieID"):
+                index["sessieIDs"].add(str(record["sessieID"]))
+            if record.get("gebruikersID"):
+                index["gebruikersIDs"].add(str(record["gebruikersID"]))
+        if b"input_content_hash" in line:
+            index["payload_hashes"].update(_HASH_PATTERN.findall(line.decode("utf-8", "replace")))
+
+
+def archive_segment(path: str, archive_directory: str, log_name: str, start: int = 0,
+                    end: int | None = None) -> list[str]:
+    """
+    Compacts (the bytes start to end of) a rotated log file into the archive: its records are split by
+    UTC day into gzipped segments, each with an index of its time range, record count, counts per event
+    type (technical or administrative) and per event source (heartbeat, trace-span, ...), session and
+    user IDs and the payloads it references. Archiving the same bytes again is a no-op.
+
+    :return: Paths of the segments that were written.
+    """
+    with open(path, "rb") as f:
+        end = end if end is not None else os.fstat(f.fileno()).st_size
+        f.seek(start)
+        digest = hashlib.sha256()
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(remaining, 1024 * 1024))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    digest = digest.hexdigest()[:12]
+
+    segments = {}  # day -> _Segment
+    day = _UNDATED
+    try:
+        with open(path, "rb") as f:
+            f.seek(start)
+            position = start
+            while position < end:
+                line = f.readline(end - position)
+                if not line:
+                    break
+                position += len(line)
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                moment = _parse_time(record.get("datetime_utc")) if isinstance(record, dict) else None
+                if moment is not None:
+                    day = moment.astimezone(timezone.utc).date().isoformat()
+                # Undecodable lines go with the record before them
+
+                segment = segments.get(day)
+                if segment is None:
+                    directory = _partition(archive_directory, log_name, day)
+                    segment = segments[day] = _Segment(directory, os.path.join(directory, f".{digest}.tmp"))
+                segment.add(line if line.endswith(b"\n") else line + b"\n",
+                            record if isinstance(record, dict) else None, moment)
+    except BaseException:
+        for segment in segments.values():
+            segment.file.close()
+            os.remove(segment.tmp_path)
+        raise
+
+    written = []
+    for day, segment in segments.items():
+        segment.file.close()
+        index = segment.index
+        first = segment.first.astimezone(timezone.utc).strftime("%H%M%S") if segment.first else "000000"
+        name = f"{log_name}-{first}-{digest}.jsonl.gz"
+        segment_path = os.path.join(segment.directory, name)
+        if os.path.exists(segment_path + INDEX_SUFFIX):
+            os.remove(segment.tmp_path)  # Archived before
+            continue
+
+        os.replace(segment.tmp_path, segment_path)
+        index.update({
+            "log": log_name,
+            "day": day,
+            "segment": name,
+            "compressed_bytes": os.path.getsize(segment_path),
+            "sessieIDs": sorted(index["sessieIDs"]),
+            "gebruikersIDs": sorted(index["gebruikersIDs"]),
+            "payload_hashes": sorted(index["payload_hashes"]),
+        })
+        # The index is written last: a segment without one is incomplete and ignored by queries
+        with open(f"{segment_path}{INDEX_SUFFIX}.tmp", "w", encoding="utf-8") as f:
+            json.dump(index, f, separators=(",", ":"))
+        os.replace(f"{segment_path}{INDEX_SUFFIX}.tmp", segment_path + INDEX_SUFFIX)
+        written.append(segment_path)
+    return written
+
+
+def archive_rotated(log_path: str, archive_directory: str, backup_count: int) -> list[str]:
+    """
+    Archives what was not archived yet of the rotated files of a log (<log>.jsonl.1 to .backup_count).
+    How far each file was archived is tracked by inode, as files are renamed at every rollover, so
+    records that another process appends to a file after it was rotated are archived at a later run,
+    until the file is deleted. Only complete lines are archived, except from the oldest file, which is
+    deleted at the next rollover.
+
+    The archive is only complete for a single writer: a process that still writes to a file after
+    another process deleted it loses those records, and rollovers of two processes at the same moment
+    may archive the same records twice.
+
+    :return: Paths of the segments that were written.
+    """
+    log_name = os.path.basename(log_path).removesuffix(".jsonl")
+    offsets_path = os.path.join(archive_directory, log_name, OFFSETS_FILENAME)
+    try:
+        with open(offsets_path, "r", encoding="utf-8") as f:
+            offsets = json.load(f)
+    except (OSError, ValueError):
+        offsets = {}
+
+    written, current = [], {}
+    for n in range(backup_count, 0, -1):
+        path = f"{log_path}.{n}"
+        try:
+            with open(path, "rb") as f:
+                status = os.fstat(f.fileno())
+                end = status.st_size
+                if n < backup_count and end:
+                    # Up to the last newline: another process may be halfway through writing a record
+                    f.seek(max(0, end - 64 * 1024))
+                    tail = f.read()
+                    end -= len(tail) - (tail.rfind(b"\n") + 1)
+        except FileNotFoundError:
+            continue
+        inode = str(status.st_ino)
+        start = min(offsets.get(inode, 0), end)
+        if end > start:
+            written += archive_segment(path, archive_directory, log_name, start, end)
+        current[inode] = max(start, end)
+
+    # Inodes of deleted files are forgotten, so a new file that reuses one starts at 0
+    if current != offsets:
+        os.makedirs(os.path.dirname(offsets_path), exist_ok=True)
+        with open(f"{offsets_path}.{os.getpid()}.tmp", "w", encoding="utf-8") as f:
+            json.dump(current, f)
+        os.replace(f"{offsets_path}.{os.getpid()}.tmp", offsets_path)
+    return written
+
+
+def prune(log_directory: str, retention_days: int = RETENTION_DAYS, min_age: int = 3600) -> dict:
+    """
+    Applies the retention policy of the logs: archived segments of days longer than retention_days ago
+    are deleted (none when 0), then the payloads that no log file nor kept segment references anymore.
+    Payloads used in the last min_age seconds are kept, as their record may still be on its way to the file.
+    Meant to run outside the application, e.g. daily from cron, as it reads all live log files.
+    """
+    archive_directory = os.path.join(log_directory, ARCHIVE_DIRNAME)
+    removed = {"segments": 0, "payloads": 0}
+    if retention_days > 0 and os.path.isdir(archive_directory):
+        cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+        for log_name in os.listdir(archive_directory):
+            for index in iter_indexes(archive_directory, log_name, until=cutoff):
+                if index["end"] is not None and _parse_time(index["end"]) >= cutoff:
+                    continue
+                if index["end"] is None and os.path.getmtime(index["path"]) >= cutoff.timestamp():
+                    continue
+                # The index goes first, so an interrupted prune leaves no segment that queries would read
+                os.remove(index["path"] + INDEX_SUFFIX)
+                os.remove(index["path"])
+                removed["segments"] += 1
+                try:
+                    os.removedirs(os.path.dirname(index["path"]))  # Day, month and year once empty
+                except OSError:
+                    pass
+
+    referenced = referenced_payloads(archive_directory)
+    for entry in os.listdir(log_directory):
+        path = os.path.join(log_directory, entry)
+        if os.path.isfile(path) and ".jsonl" in entry:
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    referenced.update(_HASH_PATTERN.findall(line))
+
+    cutoff = time.time() - min_age
+    for root, _, files in os.walk(os.path.join(log_directory, PAYLOADS_DIRNAME)):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                if name.split(".", 1)[0] not in referenced and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed["payloads"] += 1
+            except OSError:
+                pass
+    return removed
+
+
+def iter_indexes(archive_directory: str, log_name: str, since: datetime | None = None,
+                 until: datetime | None = None):
+    """
+    Yields the indexes of the archived segments of a log that may hold records between since and until.
+    Day partitions outside the range are skipped without opening anything in them.
+    """
+    root = os.path.join(archive_directory, log_name)
+    if not os.path.isdir(root):
+        return
+    first_day = since.astimezone(timezone.utc).date().isoformat() if since else None
+    last_day = until.astimezone(timezone.utc).date().isoformat() if until else None
+
+    for current, directories, files in os.walk(root):
+        directories.sort()
+        relative = os.path.relpath(current, root)
+        parts = [] if relative == "." else relative.split(os.sep)
+        if parts and parts[0] != _UNDATED:
+            # Compare the partition prefix (year, year-month or day) with the same prefix of the range
+            prefix = "-".join(parts)
+            if first_day and prefix < first_day[:len(prefix)]:
+                directories.clear()
+                continue
+            if last_day and prefix > last_day[:len(prefix)]:
+                directories.clear()
+                continue
+
+        for name in sorted(files):
+            if not name.endswith(INDEX_SUFFIX):
+                continue
+            try:
+                with open(os.path.join(current, name), "r", encoding="utf-8") as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if since and index["end"] and _parse_time(index["end"]) < since:
+                continue
+            if until and index["start"] and _parse_time(index["start"]) > until:
+                continue
+            index["path"] = os.path.join(current, name[:-len(INDEX_SUFFIX)])
+            yield index
+
+
+def referenced_payloads(archive_directory: str) -> set[str]:
+    """Payload hashes referenced by archived records, which the payload store must keep."""
+    referenced = set()
+    if not os.path.isdir(archive_directory):
+        return referenced
+    for log_name in os.listdir(archive_directory):
+        for index in iter_indexes(archive_directory, log_name):
+            referenced.update(index.get("payload_hashes", ()))
+    return referenced
+
+
+# The record fields a Query filters and counts on, with the index field that counts them per segment
+DIMENSIONS = {"event_type": "event_types", "event_source": "event_sources"}
+
+
+class Query:
+    """
+    Filter over archived (and optionally live) log records. Segments are selected on their index,
+    so only those that can contain matching records are decompressed.
+
+    :param event_types: "technical" and/or "administrative", i.e. which logger wrote the record.
+    :param event_sources: What the record is about, e.g. "heartbeat", "GPT-communication" or "trace-span".
+    """
+
+    def __init__(self, since: datetime | None = None, until: datetime | None = None,
+                 event_types: list[str] | None = None, sessieID: str | None = None,
+                 gebruikersID: str | None = None, event_sources: list[str] | None = None) -> None:
+        self.since = since
+        self.until = until
+        self.event_types = set(event_types or ())
+        self.event_sources = set(event_sources or ())
+        self.sessieID = sessieID
+        self.gebruikersID = gebruikersID
+
+    def filters(self) -> dict:
+        """The value filters per dimension (see DIMENSIONS) that are set."""
+        return {field: values for field, values in (("event_type", self.event_types),
+                                                    ("event_source", self.event_sources)) if values}
+
+    def selects(self, index: dict) -> bool:
+        for field, values in self.filters().items():
+            counted = index.get(DIMENSIONS[field])
+            # Segments archived before a dimension was indexed may hold anything
+            if counted is not None and not values & set(counted):
+                return False
+        if self.sessieID and self.sessieID not in index["sessieIDs"]:
+            return False
+        if self.gebruikersID and self.gebruikersID not in index["gebruikersIDs"]:
+            return False
+        return True
+
+    def covers(self, index: dict) -> bool:
+        """Whether every record of the segment matches on time, so its index counts can be used as they are."""
+        if self.sessieID or self.gebruikersID or not index["start"]:
+            return False
+        if self.since and _parse_time(index["start"]) < self.since:
+            return False
+        if self.until and _parse_time(index["end"]) > self.until:
+            return False
+        return True
+
+    def matches(self, record: dict) -> bool:
+        for field, values in self.filters().items():
+            if (record.get(field) or "unknown") not in values:
+                return False
+        if self.sessieID and str(record.get("sessieID")) != self.sessieID:
+            return False
+        if self.gebruikersID and str(record.get("gebruikersID")) != self.gebruikersID:
+            return False
+        if self.since or self.until:
+            moment = _parse_time(record.get("datetime_utc"))
+            if moment is None:
+                return False
+            if (self.since and moment < self.since) or (self.until and moment > self.until):
+                return False
+        return True
+
+
+def _read_lines(path: str):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict):
+                yield record
+
+
+def iter_records(log_directory: str, log_name: str, query: Query, live: bool = True, stats: dict | None = None):
+    """
+    Yields the matching records of a log: from the archive, then from the active log file when `live`.
+    The rotated plain files are not read, as they are archived when they are rotated (see archive_rotated).
+    """
+    stats = stats if stats is not None else {}
+    stats.setdefault("segments_total", 0)
+    stats.setdefault("segments_scanned", 0)
+    for index in iter_indexes(os.path.join(log_directory, ARCHIVE_DIRNAME), log_name, query.since, query.until):
+        stats["segments_total"] += 1
+        if not query.selects(index):
+            continue
+        stats["segments_scanned"] += 1
+        for record in _read_lines(index["path"]):
+            if query.matches(record):
+                yield record
+
+    active = os.path.join(log_directory, f"{log_name}.jsonl")
+    if live and os.path.exists(active):
+        for record in _read_lines(active):
+            if query.matches(record):
+                yield record
+
+
+def count(log_directory: str, log_name: str, query: Query, by: str = "event_source", live: bool = True) -> dict:
+    """
+    Counts matching records per event source, event type or day. Segments that lie entirely within the
+    queried time range are counted from their index alone, without decompressing them, when the query
+    filters on at most the dimension that is counted (the index has no counts per combination).
+    """
+    filters = query.filters()
+    # The one dimension whose index counts answer the query: the counted one, or the filtered one per day
+    dimension = by if by in DIMENSIONS else next(iter(filters), "event_type")
+    from_index = set(filters) <= {dimension}
+    counts, stats = {}, {"segments_total": 0, "segments_scanned": 0, "segments_from_index": 0}
+    archive_directory = os.path.join(log_directory, ARCHIVE_DIRNAME)
+
+    partial = []
+    for index in iter_indexes(archive_directory, log_name, query.since, query.until):
+        stats["segments_total"] += 1
+        if not query.selects(index):
+            continue
+        counted = index.get(DIMENSIONS[dimension])
+        if not from_index or counted is None or not query.covers(index):
+            partial.append(index)
+            continue
+        stats["segments_from_index"] += 1
+        for value, n in counted.items():
+            if dimension in filters and value not in filters[dimension]:
+                continue
+            key = value if by in DIMENSIONS else index["day"]
+            counts[key] = counts.get(key, 0) + n
+
+    records = []
+    for index in partial:
+        stats["segments_scanned"] += 1
+        records.append(_read_lines(index["path"]))
+    active = os.path.join(log_directory, f"{log_name}.jsonl")
+    if live and os.path.exists(active):
+        records.append(_read_lines(active))
+
+    for source in records:
+        for record in source:
+            if not query.matches(record):
+                continue
+            if by in DIMENSIONS:
+                key = record.get(by) or "unknown"
+            else:
+                key = (record.get("datetime_utc") or _UNDATED)[:10]
+            counts[key] = counts.get(key, 0) + 1
+    return {"counts": dict(sorted(counts.items())), **stats}
+
+
+def _time_argument(value: str) -> datetime:
+    moment = _parse_time(value)
+    if moment is None:
+        raise argparse.ArgumentTypeError(f"Not an ISO date or time: {value}")
+    return moment
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive rotated APR logs and query the archive.")
+    parser.add_argument("--logs", default="./tmp/logs", help="Log directory, with the archive in its 'archive' directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    archive_parser = commands.add_parser("archive", help="Archive what is not archived yet of the rotated files (<log>.jsonl.N)")
+    archive_parser.add_argument("--log", default="technical", choices=["technical", "administrative"])
+    archive_parser.add_argument("--backup-count", type=int, default=5, help="backupCount of the log's handler")
+
+    prune_parser = commands.add_parser("prune", help="Delete archived segments past retention and unreferenced payloads")
+    prune_parser.add_argument("--retention-days", type=int, default=RETENTION_DAYS,
+                              help="Days archived segments are kept, 0 for ever (default: APR_LOG_RETENTION_DAYS or 365)")
+
+    for command in ("query", "count"):
+        sub = commands.add_parser(command)
+        sub.add_argument("--log", default="technical", choices=["technical", "administrative"])
+        sub.add_argument("--since", type=_time_argument, help="ISO date or time, UTC unless given")
+        sub.add_argument("--until", type=_time_argument, help="ISO date or time, UTC unless given")
+        sub.add_argument("--event-source", action="append", dest="event_sources",
+                         help="E.g. heartbeat, GPT-communication, trace-span; repeat for several")
+        sub.add_argument("--event-type", action="append", dest="event_types", choices=["technical", "administrative"])
+        sub.add_argument("--session", dest="sessieID")
+        sub.add_argument("--user", dest="gebruikersID")
+        sub.add_argument("--no-live", action="store_true", help="Only read the archive, not the active log file")
+        if command == "count":
+            sub.add_argument("--by", choices=["event_source", "event_type", "day"], default="event_source")
+        else:
+            sub.add_argument("--limit", type=int)
+    options = parser.parse_args()
+
+    if options.command == "archive":
+        written = archive_rotated(os.path.join(options.logs, f"{options.log}.jsonl"),
+                                  os.path.join(options.logs, ARCHIVE_DIRNAME), options.backup_count)
+        print(f"[LogArchive] {options.log}: {len(written)} new segment(s)")
+    elif options.command == "prune":
+        removed = prune(options.logs, options.retention_days)
+        print(f"[LogArchive] Removed {removed['segments']} segment(s) and {removed['payloads']} payload(s)")
+    else:
+        query = Query(options.since, options.until, options.event_types, options.sessieID, options.gebruikersID,
+                      options.event_sources)
+        if options.command == "count":
+            print(json.dumps(count(options.logs, options.log, query, options.by, not options.no_live), indent=2))
+        else:
+            stats = {}
+            for n, record in enumerate(iter_records(options.logs, options.log, query, not options.no_live, stats)):
+                if options.limit is not None and n >= options.limit:
+                    break
+                print(json.dumps(record, ensure_ascii=False))
+            print(f"[LogArchive] Scanned {stats['segments_scanned']} of {stats['segments_total']} segments",
+                  file=sys.stderr)
@@ -0,0 +1,250 @@
+import asyncio
+import atexit
+import json
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+from uuid import uuid4
+
+METRICS_DIR = "./tmp/metrics"
+# Seconds between snapshots of a process's metrics to METRICS_DIR
+FLUSH_INTERVAL = float(os.getenv("APR_METRICS_FLUSH_S", "5"))
+
+# Upper bounds (in seconds) of the histogram buckets: from event loop lag to full LLM calls
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+METRICS = {
+    "apr_llm_request_seconds": ("histogram", "Duration of LLM provider calls"),
+    "apr_llm_requests_total": ("counter", "LLM provider calls by outcome"),
+    # kind="prompt_cached" over both prompt kinds is the provider's prefix cache hit rate
+    "apr_llm_tokens_total": ("counter", "LLM tokens by kind: uncached prompt, cached prompt and completion"),
+    "apr_saje_queue_wait_seconds": ("histogram", "Time SAJE jobs spend queued before they start"),
+    "apr_saje_run_seconds": ("histogram", "Run time of SAJE jobs"),
+    "apr_saje_jobs_total": ("counter", "Finished SAJE jobs by outcome"),
+    "apr_pdf_render_seconds": ("histogram", "Duration of HTML to PDF rendering"),
+    "apr_ws_action_seconds": ("histogram", "Handling time of websocket actions"),
+    "apr_metadata_io_seconds": ("histogram", "Duration of meta_data.json reads and writes"),
+    # Per-field skip rate of the LLM: outcome="skipped" over all outcomes
+    "apr_preextract_fields_total": ("counter", "Preamble fields by whether the rule-based extraction filled them"),
+    "apr_prompt_tokens_saved_total": ("counter", "Estimated prompt tokens saved by sending normalized transcripts"),
+    # outcome="hit" over hit and miss is the share of editor openings served by a speculative result
+    "apr_prefetch_total": ("counter", "Speculative prefetches by outcome: queued, stored, hit, miss and wasted"),
+    "apr_event_loop_lag_seconds": ("histogram", "Delay of the Sanic workers' event loops in waking up a sleeping task"),
+}
+# Seconds between event loop lag samples
+LOOP_LAG_INTERVAL = 0.25
+
+
+class Registry:
+    """
+    Counters and histograms of one process. Every process (Sanic workers, the SAJE worker) keeps its
+    own and snapshots it to METRICS_DIR, where `collect` merges the snapshots of all processes.
+    """
+
+    def __init__(self, directory: str = METRICS_DIR) -> None:
+        self.directory = directory
+        self._reset()
+        # A forked child starts empty with a file of its own, instead of counting the parent's values twice
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self) -> None:
+        self.path = os.path.join(self.directory, f"{os.getpid()}-{uuid4().hex[:8]}.json")
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+        self.changed = False
+        self._flusher = None
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+            self.changed = True
+        self._start_flusher()
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            values = self.histograms.get(key)
+            if values is None:
+                values = self.histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            values[bisect_left(BUCKETS, seconds)] += 1
+            values[-1] += seconds
+            self.changed = True
+        self._start_flusher()
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observes the duration of the block, also when it raises."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "counters": [[name, dict(labels), value] for (name, labels), value in self.counters.items()],
+                "histograms": [[name, dict(labels), list(values)] for (name, labels), values in self.histograms.items()],
+            }
+
+    def flush(self) -> None:
+        """Writes the snapshot of this process when something changed since the last one."""
+        if not self.changed:
+            return
+        self.changed = False
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, self.path)
+
+    def _start_flusher(self) -> None:
+        if self._flusher is not None:
+            return
+        with self.lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True)
+            self._flusher.start()
+            atexit.register(self.flush)
+
+    def _flush_loop(self) -> None:
+        event = threading.Event()
+        while not event.wait(FLUSH_INTERVAL):
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"[Metrics] Could not write snapshot: {e}")
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+
+
+def reset() -> None:
+    """Removes the snapshots of earlier runs. Called once by the main process at startup."""
+    if not os.path.isdir(METRICS_DIR):
+        return
+    for entry in os.listdir(METRICS_DIR):
+        try:
+            os.remove(os.path.join(METRICS_DIR, entry))
+        except OSError:
+            pass
+
+
+async def monitor_event_loop(interval: float = LOOP_LAG_INTERVAL) -> None:
+    """
+    Samples how late the running event loop wakes up a task, which is how long other tasks keep it
+    busy: blocking calls in handlers show up here as lag for every connection of the worker.
+    """
+    while True:
+        start = perf_counter()
+        await asyncio.sleep(interval)
+        observe("apr_event_loop_lag_seconds", max(perf_counter() - start - interval, 0.0))
+
+
+def collect(directory: str = METRICS_DIR) -> tuple[dict, dict]:
+    """
+    Merges the snapshots of all processes, using the live values for the calling process.
+
+    :param directory: Where the processes write their snapshots; another one for e.g. a benchmarked server.
+    :return: Counters and histograms, both keyed by (name, labels).
+    """
+    snapshots = [registry.snapshot()]
+    if os.path.isdir(directory):
+        for entry in os.listdir(directory):
+            path = os.path.join(directory, entry)
+            if not entry.endswith(".json") or path == registry.path:
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+
+    counters, histograms = {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot["counters"]:
+            key = (name, tuple(sorted(labels.items())))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in snapshot["histograms"]:
+            key = (name, tuple(sorted(labels.items())))
+            merged = histograms.get(key)
+            histograms[key] = values if merged is None else [a + b for a, b in zip(merged, values)]
+    return counters, histograms
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: tuple, **extra) -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in (*labels, *extra.items())]
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def render_prometheus() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    counters, histograms = collect()
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_labels(labels)} {value}")
+            continue
+
+        for (metric, labels), values in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip((*BUCKETS, "+Inf"), values[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {values[-1]}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def quantile(values: list, q: float) -> float | None:
+    """Estimates a quantile from bucket counts by linear interpolation within its bucket."""
+    counts = values[:-1]
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(counts):
+        if seen + count >= rank and count:
+            lower = BUCKETS[i - 1] if i else 0.0
+            upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+    return BUCKETS[-1]
+
+
+def summary() -> dict:
+    """Compact JSON view of all metrics, for the logging view: totals and p50/p95/avg per histogram."""
+    counters, histograms = collect()
+    result = {}
+    for (name, labels), value in sorted(counters.items()):
+        result.setdefault(name, []).append({"labels": dict(labels), "value": value})
+    for (name, labels), values in sorted(histograms.items()):
+        count = sum(values[:-1])
+        p50, p95 = quantile(values, 0.5), quantile(values, 0.95)
+        result.setdefault(name, []).append({
+            "labels": dict(labels),
+            "count": count,
+            "avg_s": round(values[-1] / count, 4) if count else None,
+            "p50_s": round(p50, 4) if p50 is not None else None,
+            "p95_s": round(p95, 4) if p95 is not None else None,
+        })
+    return result
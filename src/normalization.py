@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import re
+from bisect import bisect_right
+from time import perf_counter
+
+NORMALIZED_DIR = "data/normalized"
+# Filler words are dropped only when enabled: they can matter for how a statement reads
+STRIP_FILLERS = os.getenv("APR_NORMALIZE_FILLERS", "0") == "1"
+# Rough size of a token of Dutch text, for reporting the prompt tokens saved without a tokenizer
+CHARS_PER_TOKEN = 4
+
+_SPEAKER = re.compile(r"(?P<label>[A-Za-zÀ-ÿ][\w'.-]*(?: [\w'.-]+){0,2}):[ \t]+")
+# Line-level noise: page headers/footers and subtitle cue lines ("00:00:01,000 --> 00:00:04,000")
+_HEADER = re.compile(r"(?:(?:pagina|page|blad)\s+\d+(?:\s*(?:van|of|/)\s*\d+)?|-\s*\d+\s*-|"
+                     r"[\d:.,]+\s*-->\s*[\d:.,]+)", re.IGNORECASE)
+# Timestamps in front of a line: "[00:01:23]", "(01:23)" or a bare "00:01:23"
+_TIMESTAMP = re.compile(r"(?:[\[(]\d{1,2}:\d{2}(?::\d{2})?(?:[.,]\d+)?[\])]|\d{1,2}:\d{2}:\d{2}(?:[.,]\d+)?)[ \t]*")
+_FILLER = re.compile(r"(?:e+h+m*|e+u+h+|u+h+m*|u+m+|h+m+)[,.…]*", re.IGNORECASE)
+_WORD = re.compile(r"\S+")
+
+
+class Normalization:
+    """
+    A transcript normalized for prompting, with the map from its offsets back to the original.
+
+    :param runs: The pieces of `text` copied from the original as `[text offset, original offset, length]`;
+                 the characters between them (separators) were inserted.
+    :param counts: What was removed, for logging.
+    """
+
+    def __init__(self, original_hash: str, text: str, runs: list, counts: dict) -> None:
+        self.original_hash = original_hash
+        self.text = text
+        self.runs = runs
+        self.counts = counts
+        self._starts = [run[0] for run in runs]
+
+    def to_original(self, start: int, end: int) -> tuple[int, int]:
+        """The span of the original that text[start:end] came from."""
+        return self._map(start), self._map(end - 1) + 1 if end > start else self._map(start)
+
+    def _map(self, offset: int) -> int:
+        index = bisect_right(self._starts, offset) - 1
+        if index < 0:
+            return 0
+        text_start, original_start, length = self.runs[index]
+        # Inserted separators map to the end of the copied run before them
+        return original_start + min(offset - text_start, length)
+
+    def original_quote(self, original: str, quote: str) -> str | None:
+        """
+        The verbatim passage of the original behind a quote from the normalized text, with the
+        fillers, timestamps and labels that normalization removed. None when the quote isn't in the text.
+        """
+        start = self.text.find(quote)
+        if start < 0 or not quote:
+            return None
+        original_start, original_end = self.to_original(start, start + len(quote))
+        return original[original_start:original_end]
+
+    def tokens_saved(self, original: str) -> int:
+        return estimate_tokens(original) - estimate_tokens(self.text)
+
+    def to_dict(self) -> dict:
+        return {"original_hash": self.original_hash, "text": self.text, "runs": self.runs, "counts": self.counts}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Normalization":
+        return cls(data["original_hash"], data["text"], data["runs"], data["counts"])
+
+
+def estimate_tokens(text: str) -> int:
+    return round(len(text) / CHARS_PER_TOKEN)
+
+
+def original_hash(original: str) -> str:
+    return hashlib.sha256(original.encode("utf-8")).hexdigest()
+
+
+def normalize(original: str, strip_fillers: bool = STRIP_FILLERS) -> Normalization:
+    """
+    Normalizes a transcript for prompting: whitespace runs become one space or one line break,
+    consecutive turns of the same speaker are merged under one label, page headers and timestamps
+    are dropped and, when `strip_fillers`, so are filler words ("ehh", "uhm").
+    """
+    started = perf_counter()
+    builder = _Builder(original)
+    counts = {"headers": 0, "timestamps": 0, "labels": 0, "fillers": 0}
+    speaker = None
+    position = 0
+    for line in original.splitlines(keepends=True):
+        start, end = position, position + len(line.rstrip("\r\n"))
+        position += len(line)
+        content = original[start:end].strip()
+        if not content:
+            continue
+        if _HEADER.fullmatch(content):
+            counts["headers"] += 1
+            continue
+
+        start += len(original[start:end]) - len(original[start:end].lstrip())
+        timestamp = _TIMESTAMP.match(original, start, end)
+        if timestamp:
+            counts["timestamps"] += 1
+            start = timestamp.end()
+        label = _SPEAKER.match(original, start, end)
+        if label and label.group("label") == speaker:
+            counts["labels"] += 1  # Same speaker continues, the turn goes on in the same line
+            builder.separator(" ", start)
+            start = label.end()
+        else:
+            if builder.length:
+                builder.separator("\n", start)
+            if label:
+                speaker = label.group("label")
+                builder.copy(label.start(), label.end("label") + 1)  # "label:"
+                builder.separator(" ", label.end("label") + 1)
+                start = label.end()
+
+        first = True
+        for word in _WORD.finditer(original, start, end):
+            if strip_fillers and _FILLER.fullmatch(word.group()):
+                counts["fillers"] += 1
+                continue
+            if not first:
+                builder.separator(" ", word.start())
+            builder.copy(word.start(), word.end())
+            first = False
+
+    counts["duration_ms"] = round((perf_counter() - started) * 1000, 2)
+    return Normalization(original_hash(original), "".join(builder.pieces), builder.runs, counts)
+
+
+class _Builder:
+    """Collects the normalized text and the runs of it that are copied from the original."""
+
+    def __init__(self, original: str) -> None:
+        self.original = original
+        self.pieces = []
+        self.runs = []
+        self.length = 0
+
+    def copy(self, start: int, end: int) -> None:
+        if end <= start:
+            return
+        last = self.runs[-1] if self.runs else None
+        if last and last[0] + last[2] == self.length and last[1] + last[2] == start:
+            last[2] += end - start  # Continues the previous run
+        else:
+            self.runs.append([self.length, start, end - start])
+        self.pieces.append(self.original[start:end])
+        self.length += end - start
+
+    def separator(self, text: str, original_offset: int) -> None:
+        # A separator that is already there in the original is copied, which keeps the runs long
+        if self.original[original_offset - len(text):original_offset] == text:
+            self.copy(original_offset - len(text), original_offset)
+        elif self.original[original_offset:original_offset + len(text)] == text:
+            self.copy(original_offset, original_offset + len(text))
+        else:
+            self.pieces.append(text)
+            self.length += len(text)
+
+
+def normalized_path(file_id: str) -> str:
+    return os.path.join(NORMALIZED_DIR, f"{os.path.basename(file_id)}.json")
+
+
+def store_normalization(file_id: str, normalization: Normalization) -> None:
+    os.makedirs(NORMALIZED_DIR, exist_ok=True)
+    path = normalized_path(file_id)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(normalization.to_dict(), f, separators=(",", ":"), ensure_ascii=False)
+    os.replace(f"{path}.tmp", path)
+
+
+def load_normalization(file_id: str, original: str) -> Normalization | None:
+    """The stored normalization of a report, None when there is none or the original has changed since."""
+    try:
+        with open(normalized_path(file_id), "r", encoding="utf-8") as f:
+            normalization = Normalization.from_dict(json.load(f))
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+    if normalization.original_hash != original_hash(original):
+        return None
+    return normalization
+
+
+def remove_normalization(file_id: str) -> None:
+    try:
+        os.remove(normalized_path(file_id))
+    except OSError:
+        pass
@@ -0,0 +1,157 @@
+import json
+import os
+import re
+import threading
+from time import time
+from APRLogger import technical_log
+import metrics
+
+PREFETCH_DIR = "./tmp/prefetch"
+# What is computed ahead of the editors when a report is finished or selected in the table, empty to switch it off
+PREFETCH_KINDS = [kind.strip() for kind in os.getenv("APR_PREFETCH", "blocks,thoughts").split(",") if kind.strip()]
+# Speculative results kept at most, the least recently used one is evicted first
+CACHE_SIZE = int(os.getenv("APR_PREFETCH_CACHE_SIZE", "64"))
+
+
+def enabled(kind: str) -> bool:
+    return kind in PREFETCH_KINDS
+
+
+def record(kind: str, outcome: str) -> None:
+    """Counts a speculation outcome: queued, stored, hit, miss or wasted (see apr_prefetch_total)."""
+    metrics.inc("apr_prefetch_total", kind=kind, outcome=outcome)
+
+
+class SpeculationCache:
+    """
+    Results of speculative jobs, kept on disk so the SAJE worker that computes them and every Sanic
+    worker that serves them share one bounded cache. There is one entry per kind and report; `key` says
+    which input it was computed for (the transcript hash for Blocks, the draft section for thoughts).
+
+    An entry that is evicted, replaced or discarded before anything claimed it was wasted speculation.
+    """
+
+    def __init__(self, directory: str = PREFETCH_DIR, size: int = CACHE_SIZE) -> None:
+        self.directory = directory
+        self.size = size
+        self._lock = threading.Lock()  # Within a process; across processes the writes are atomic replaces
+
+    def _path(self, kind: str, report: str) -> str:
+        safe = re.sub(r"[^A-Za-z0-9_.-]+", "_", os.path.basename(report))
+        return os.path.join(self.directory, f"{kind}-{safe}.json")
+
+    def _read(self, path: str) -> dict | None:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, path: str, entry: dict) -> None:
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def contains(self, kind: str, report: str, key: str) -> bool:
+        entry = self._read(self._path(kind, report))
+        return entry is not None and entry["key"] == key
+
+    def put(self, kind: str, report: str, key: str, data=None) -> None:
+        """Stores the result of a speculative job, replacing the report's previous entry of this kind."""
+        path = self._path(kind, report)
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            previous = self._read(path)
+            if previous is not None and previous["key"] != key:
+                self._wasted(previous, "replaced")
+            self._write(path, {"kind": kind, "report": report, "key": key, "created_at": time(), "claims": 0,
+                               "data": data})
+            self._evict()
+        record(kind, "stored")
+
+    def claim(self, kind: str, report: str, key: str) -> dict | None:
+        """
+        The entry of a report when it was computed for `key`. Only its first claim counts as a hit;
+        it stays until evicted for later openings, which are served without being counted again.
+        An entry for another key is stale: it is removed, and counted as wasted when it was never claimed.
+        """
+        path = self._path(kind, report)
+        entry = self._read(path)
+        if entry is None:
+            return None
+        if entry["key"] != key:
+            try:
+                os.remove(path)
+            except OSError:
+                return None
+            if not entry["claims"]:
+                self._wasted(entry, "stale")
+            return None
+        entry["claims"] += 1
+        try:
+            self._write(path, entry)  # Also marks it as recently used
+        except OSError:
+            pass
+        if entry["claims"] > 1:
+            return entry
+        record(kind, "hit")
+        technical_log(
+            "prefetch",
+            dataID=report,
+            function_call=kind,
+            performance_metric={"outcome": "hit", "age_s": round(time() - entry["created_at"], 2),
+                                "claims": entry["claims"]},
+        )
+        return entry
+
+    def discard(self, report: str) -> None:
+        """Removes the entries of a deleted report."""
+        for kind in PREFETCH_KINDS:
+            path = self._path(kind, report)
+            entry = self._read(path)
+            if entry is None:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            if not entry["claims"]:
+                self._wasted(entry, "discarded")
+
+    def _evict(self) -> None:
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith(".json")]
+        except OSError:
+            return
+        if len(names) <= self.size:
+            return
+        paths = sorted((os.path.join(self.directory, name) for name in names), key=_mtime)
+        for path in paths[:len(paths) - self.size]:
+            entry = self._read(path)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            if entry is not None and not entry["claims"]:
+                self._wasted(entry, "evicted")
+
+    def _wasted(self, entry: dict, reason: str) -> None:
+        record(entry["kind"], "wasted")
+        technical_log(
+            "prefetch",
+            dataID=entry["report"],
+            function_call=entry["kind"],
+            performance_metric={"outcome": "wasted", "reason": reason,
+                                "age_s": round(time() - entry["created_at"], 2)},
+        )
+
+
+def _mtime(path: str) -> float:
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return 0.0
+
+
+cache = SpeculationCache()
@@ -0,0 +1,220 @@
+import cProfile
+import json
+import os
+import random
+import re
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from time import monotonic, perf_counter, strftime
+from APRLogger import technical_log
+
+PROFILES_DIR = "./tmp/profiles"
+# Written by `configure` (e.g. from the "profiling" websocket action) and read by every process
+CONFIG_PATH = os.path.join(PROFILES_DIR, "config.json")
+
+# Defaults until a config file exists. Targets are "<kind>:<name>" entries, e.g. "saje:GenerateReport,ws:table-update";
+# "saje:*" selects all SAJE jobs, "*" everything. Empty disables profiling.
+DEFAULT_CONFIG = {
+    "targets": [target.strip() for target in os.getenv("APR_PROFILE", "").split(",") if target.strip()],
+    # Fraction of the selected jobs and actions that is profiled
+    "rate": float(os.getenv("APR_PROFILE_RATE", "1.0")),
+    # "sampling" records the stack every interval_ms with little overhead, "deterministic" runs cProfile
+    "mode": os.getenv("APR_PROFILE_MODE", "sampling"),
+    "interval_ms": float(os.getenv("APR_PROFILE_INTERVAL_MS", "5")),
+}
+MODES = ("sampling", "deterministic")
+# Seconds a process keeps using the settings it read before checking the config file again
+CONFIG_CHECK_INTERVAL = 2.0
+
+_config = dict(DEFAULT_CONFIG)
+_config_mtime = None
+_config_checked = None  # monotonic() of the last check of the config file
+_deterministic_threads = set()  # Threads with an active cProfile, which can't be nested
+
+
+def settings() -> dict:
+    """The current profiling settings: the config file when there is one, else the environment defaults."""
+    global _config, _config_mtime, _config_checked
+    now = monotonic()
+    if _config_checked is not None and now - _config_checked < CONFIG_CHECK_INTERVAL:
+        return _config
+    _config_checked = now
+    try:
+        mtime = os.stat(CONFIG_PATH).st_mtime
+    except OSError:
+        mtime = None
+    if mtime != _config_mtime:
+        _config_mtime = mtime
+        _config = dict(DEFAULT_CONFIG)
+        if mtime is not None:
+            try:
+                with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+                    _config.update(json.load(f))
+            except (OSError, ValueError) as e:
+                print(f"[Profiling] Ignoring unreadable {CONFIG_PATH}: {e}")
+    return _config
+
+
+def configure(targets: list[str] | None = None, rate: float | None = None, mode: str | None = None,
+              interval_ms: float | None = None) -> dict:
+    """
+    Changes the profiling settings of all processes (Sanic workers and the SAJE worker).
+    Arguments left None keep their current value; empty targets switch profiling off.
+
+    :raises ValueError: For an unknown mode or a rate outside [0, 1].
+    """
+    global _config_checked
+    config = dict(settings())
+    if targets is not None:
+        config["targets"] = [str(target) for target in targets]
+    if rate is not None:
+        if not 0 <= rate <= 1:
+            raise ValueError("rate must be between 0 and 1")
+        config["rate"] = rate
+    if mode is not None:
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {', '.join(MODES)}")
+        config["mode"] = mode
+    if interval_ms is not None:
+        config["interval_ms"] = max(float(interval_ms), 1.0)
+
+    os.makedirs(PROFILES_DIR, exist_ok=True)
+    with open(f"{CONFIG_PATH}.tmp", "w", encoding="utf-8") as f:
+        json.dump(config, f)
+    os.replace(f"{CONFIG_PATH}.tmp", CONFIG_PATH)
+    _config_checked = None  # This process applies the change right away, the others within CONFIG_CHECK_INTERVAL
+    return config
+
+
+def selected(kind: str, name: str) -> bool:
+    config = settings()
+    targets = config["targets"]
+    if not targets:
+        return False
+    if "*" not in targets and f"{kind}:*" not in targets and f"{kind}:{name}" not in targets:
+        return False
+    return random.random() < config["rate"]
+
+
+class _Sampler(threading.Thread):
+    """Records the call stack of one thread every interval, as counts per stack."""
+
+    def __init__(self, thread_id: int, interval: float) -> None:
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+
+class Profile:
+    """
+    A running profile of the current thread. In the event loop of a Sanic worker that includes the
+    other tasks that ran while the profiled action was awaiting; work it hands to threads is not included.
+    """
+
+    def __init__(self, kind: str, name: str, tag: str, mode: str, interval_ms: float) -> None:
+        self.kind, self.name, self.tag, self.mode = kind, name, tag, mode
+        self.thread_id = threading.get_ident()
+        self.started = perf_counter()
+        if mode == "deterministic":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            _deterministic_threads.add(self.thread_id)
+        else:
+            self.sampler = _Sampler(self.thread_id, interval_ms / 1000)
+            self.sampler.start()
+
+    def stop(self, outcome: str = "ok") -> str | None:
+        """Stops profiling and writes the profile. Returns its path."""
+        duration = perf_counter() - self.started
+        if self.mode == "deterministic":
+            self.profiler.disable()
+            _deterministic_threads.discard(self.thread_id)
+        else:
+            self.sampler.stopped.set()
+            self.sampler.join()
+
+        base = os.path.join(PROFILES_DIR,
+                            f"{strftime('%Y%m%d-%H%M%S')}-{self.kind}-{_safe(self.name)}-{_safe(self.tag)}")
+        try:
+            os.makedirs(PROFILES_DIR, exist_ok=True)
+            if self.mode == "deterministic":
+                path = f"{base}.prof"  # Open with pstats, snakeviz or `python -m pstats`
+                self.profiler.dump_stats(path)
+                samples = None
+            else:
+                path = f"{base}.folded"  # Folded stacks, for flamegraph.pl or speedscope.app
+                with open(path, "w", encoding="utf-8") as f:
+                    for stack, count in self.sampler.stacks.most_common():
+                        f.write(f"{stack} {count}\n")
+                samples = sum(self.sampler.stacks.values())
+        except OSError as e:
+            print(f"[Profiling] Could not write profile of {self.kind}:{self.name}: {e}")
+            return None
+
+        technical_log(
+            "profile",
+            dataID=self.tag,
+            function_call=f"{self.kind}:{self.name}",
+            performance_metric={
+                "duration_ms": round(duration * 1000, 2),
+                "mode": self.mode,
+                "samples": samples,
+                "outcome": outcome,
+                "path": path,
+            },
+        )
+        return path
+
+
+def _safe(value) -> str:
+    """`value` reduced to characters that are safe in a file name."""
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", str(value))[:80]
+
+
+def start(kind: str, name: str, tag: str) -> Profile | None:
+    """
+    Starts a profile of a SAJE job ("saje", function name) or websocket action ("ws", action name)
+    when the settings select it; None otherwise. `tag` (job ID) goes into the file name.
+    """
+    if not selected(kind, name):
+        return None
+    config = settings()
+    mode = config["mode"] if config["mode"] in MODES else "sampling"
+    if mode == "deterministic" and threading.get_ident() in _deterministic_threads:
+        return None  # A cProfile is already running on this thread, e.g. for a concurrent action
+    try:
+        return Profile(kind, name, tag, mode, config["interval_ms"])
+    except ValueError as e:
+        # Another profiler or debugger holds the thread's profiling hook
+        print(f"[Profiling] Not profiling {kind}:{name}: {e}")
+        return None
+
+
+@contextmanager
+def profile(kind: str, name: str, tag: str):
+    """Profiles the block when the settings select it, see `start`."""
+    current = start(kind, name, tag)
+    outcome = "ok"
+    try:
+        yield current
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        if current is not None:
+            current.stop(outcome)
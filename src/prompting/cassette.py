@@ -0,0 +1,149 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+from time import perf_counter, sleep
+
+# "record" stores provider responses, "replay" serves them back without network; anything else is off.
+CASSETTE_MODE = os.getenv("APR_CASSETTE_MODE", "")
+CASSETTE_PATH = os.getenv("APR_CASSETTE_PATH", "./tmp/cassettes/default.jsonl.gz")
+# Replayed latencies are the recorded ones times this factor: 1 to replay at provider speed, 0 for none.
+CASSETTE_LATENCY_SCALE = float(os.getenv("APR_CASSETTE_LATENCY_SCALE", "0"))
+
+
+class CassetteMiss(KeyError):
+    """A replayed request that the cassette holds no (more) responses for."""
+
+
+def request_key(template_name: str, model: str, system_prompt: str, user_prompt: str) -> str:
+    data = json.dumps([template_name, model, system_prompt, user_prompt], ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class Cassette:
+    """
+    Recorded provider responses, keyed by the hash of (template, model, prompts). Prompts themselves
+    are not stored, which keeps cassettes of long transcripts small.
+
+    The file holds one JSON entry per call as its own gzip member, so several processes (Sanic
+    workers, the SAJE worker) can append to it while recording. A request made more than once is
+    answered with its recorded responses in recorded order.
+
+    :param mode: "record" or "replay".
+    :param latency_scale: Factor on the recorded latencies when replaying.
+    """
+
+    def __init__(self, path: str, mode: str, latency_scale: float = CASSETTE_LATENCY_SCALE) -> None:
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode '{mode}'")
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.lock = threading.Lock()
+        self.entries = None  # key -> recorded entries, loaded on first replay
+        self.served = {}  # key -> number of entries replayed
+
+    def response(self, template_name, model, system_prompt, user_prompt, call, cancel_event=None):
+        """The response of `call()`, recorded or replayed."""
+        key = request_key(template_name, model, system_prompt, user_prompt)
+        if self.mode == "replay":
+            entry = self._next(key, template_name)
+            self._wait(entry["latency_s"], cancel_event)
+            response = entry["response"]
+            return tuple(response) if entry.get("tuple") else response
+
+        start = perf_counter()
+        response = call()
+        self._append({
+            "key": key,
+            "template": template_name,
+            "model": model,
+            "latency_s": round(perf_counter() - start, 4),
+            "response": response,
+            **({"tuple": True} if isinstance(response, tuple) else {}),
+        })
+        return response
+
+    def stream(self, template_name, model, system_prompt, user_prompt, call, cancel_event=None):
+        """The chunks of the generator `call()`, recorded with their arrival times or replayed."""
+        key = request_key(template_name, model, system_prompt, user_prompt)
+        if self.mode == "replay":
+            entry = self._next(key, template_name)
+            previous = 0.0
+            for chunk, offset in zip(entry["chunks"], entry["offsets_s"]):
+                self._wait(offset - previous, cancel_event)
+                if cancel_event is not None and cancel_event.is_set():
+                    return  # The engine raises JobCancelled
+                previous = offset
+                yield chunk
+            return
+
+        start = perf_counter()
+        chunks, offsets = [], []
+        for chunk in call():
+            chunks.append(chunk)
+            offsets.append(round(perf_counter() - start, 4))
+            yield chunk
+        # Only complete streams are recorded: a stream stopped early isn't the provider's answer
+        self._append({"key": key, "template": template_name, "model": model, "chunks": chunks, "offsets_s": offsets})
+
+    def _next(self, key, template_name):
+        with self.lock:
+            if self.entries is None:
+                self.entries = self._load()
+            recorded = self.entries.get(key)
+            if not recorded:
+                raise CassetteMiss(f"No recorded response for template '{template_name}' (key {key[:12]}) in {self.path}")
+            served = self.served.get(key, 0)
+            self.served[key] = served + 1
+            # Requests made more often than recorded get the last response again
+            return recorded[min(served, len(recorded) - 1)]
+
+    def _load(self) -> dict:
+        entries = {}
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    entries.setdefault(entry["key"], []).append(entry)
+        except FileNotFoundError:
+            raise CassetteMiss(f"Cassette {self.path} does not exist, record it first with APR_CASSETTE_MODE=record")
+        except EOFError:
+            pass  # The last member is incomplete when a recording process was killed
+        return entries
+
+    def _append(self, entry: dict) -> None:
+        data = gzip.compress((json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8"))
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # A single O_APPEND write per entry, so concurrent recorders don't interleave their members
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def _wait(self, seconds: float, cancel_event=None) -> None:
+        seconds *= self.latency_scale
+        deadline = perf_counter() + seconds
+        while seconds > 0:
+            if cancel_event is not None and cancel_event.is_set():
+                return  # The engine raises JobCancelled after the call
+            sleep(min(seconds, 0.1))
+            seconds = deadline - perf_counter()
+
+
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+def active_cassette() -> Cassette | None:
+    """The cassette configured through APR_CASSETTE_MODE/APR_CASSETTE_PATH, shared by all engines of the process."""
+    if CASSETTE_MODE not in ("record", "replay"):
+        return None
+    with _cassettes_lock:
+        cassette = _cassettes.get(CASSETTE_PATH)
+        if cassette is None:
+            cassette = _cassettes[CASSETTE_PATH] = Cassette(CASSETTE_PATH, CASSETTE_MODE)
+            print(f"[Cassette] {CASSETTE_MODE.capitalize()}ing provider responses: {CASSETTE_PATH}")
+        return cassette
@@ -1,10 +1,25 @@
 import json
 import os
-import requests
-import websocket
 import asyncio
+import threading
+import metrics
+import tracing
+from contextlib import contextmanager
+from time import perf_counter
 from setup_env import API_DICT
-from openai import OpenAI
+from saje import JobCancelled
+from APRLogger import technical_log
+from prompting.cassette import active_cassette
+
+# The provider SDKs (openai, websocket-client) are imported on first use: the Sanic workers import this
+# module through the blueprints but only the SAJE worker and thought generation talk to the providers.
+
+REQUEST_TIMEOUT = 120.0
+TEMPLATES_PATH = "src/prompting/templates.json"
+
+_clients = {}  # (api key, base url) -> OpenAI client, shared so connections are reused across requests
+_engines = {}  # templates path -> PromptingEngine, see shared_engine
+_lock = threading.Lock()
 
 
 class PromptingEngine:
@@ -14,19 +29,22 @@ class PromptingEngine:
     {
       "template_key": {
         "system": "System prompt with {placeholders}",
+        "context": "Optional stable content, e.g. a transcript, with {placeholders}",
         "user": "User prompt with {placeholders}"        
       },
       ...
     }
     """
 
-    def __init__(self, api, templates_path: str):
+    def __init__(self, api, templates_path: str, cassette=None):
         """
         Initializes the PromptingEngine by loading the prompt templates from a JSON file
         and setting up the OpenAI API key if provided.
 
         :param api: Dictionary containing the API credentials, expected to have an "openAI" key with the API key.
         :param templates_path: Path to the JSON file containing the prompt templates.
+        :param cassette: Cassette that records or replays the provider responses, defaults to the one
+                         configured by APR_CASSETTE_MODE (see prompting/cassette.py), if any.
         """
         with open(templates_path, 'r', encoding='utf-8') as f:
             # Loads the prompt templates from the file.
@@ -42,15 +60,51 @@ class PromptingEngine:
         if api.get("cintiqo", ""):
             self.cintiqo_key = api["cintiqo"]
 
+        # Provider endpoints, None for OpenAI's own API
+        self.openAI_base_url = api.get("openAI_base_url") or None
+        self.qopilot_uri = api.get("qopilot_uri") or "ws://127.0.0.1:8001/ws/QoPilot"
+        self.cassette = cassette if cassette is not None else active_cassette()
+
+    def __getstate__(self) -> dict:
+        # Bound methods of the engine are sent to the SAJE worker, the cassette (with its lock) is not
+        state = dict(self.__dict__)
+        state["cassette"] = None
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.cassette = active_cassette()
+
+    def warm_up(self) -> None:
+        """Imports the provider SDKs and creates the OpenAI client, so the first request doesn't pay for it."""
+        import websocket  # noqa: F401
+        if getattr(self, "openAI_key", None):
+            self._openai_client()
+
     def generate_prompt(self, template_name: str, **kwargs) -> tuple[str, str]:
         """
         Generates the system and user prompts based on the specified template and keyword arguments.
+        A template's context precedes its user prompt.
 
         :param template_name: The key of the template to use from the loaded templates.
         :param kwargs: The dynamic variables that will replace placeholders in the template.
         :return: A tuple containing the generated system and user prompts.
         :raises KeyError: If the specified template name is not found in the templates.
         """
+        return _flatten(self.generate_messages(template_name, **kwargs))
+
+    def generate_messages(self, template_name: str, **kwargs) -> list[dict]:
+        """
+        Assembles the chat messages of a template with the stable content first: the system prompt,
+        then the template's context (e.g. the transcript every field question is about) as a message
+        of its own, and the variable user prompt last. Providers that cache prompt prefixes (OpenAI
+        from 1024 tokens) can then reuse everything up to the question across calls about the same context.
+
+        :param template_name: The key of the template to use from the loaded templates.
+        :param kwargs: The dynamic variables that will replace placeholders in the template.
+        :return: The messages in the OpenAI chat format.
+        :raises KeyError: If the specified template name is not found in the templates.
+        """
         template = self.templates.get(
             template_name)  # Retrieves the template based on the name.
         if not template:
@@ -58,46 +112,96 @@ class PromptingEngine:
             raise KeyError(
                 f"Template '{template_name}' not found in templates.")
 
-        # Fills the system prompt template with variables.
+        messages = []
         system_prompt = template.get('system', '').format(**kwargs)
-        # Fills the user prompt template with variables.
-        user_prompt = template.get('user', '').format(**kwargs)
-
-        return (system_prompt, user_prompt)  # Returns the generated prompts.
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        if template.get('context'):
+            messages.append({"role": "user", "content": template['context'].format(**kwargs)})
+        messages.append({"role": "user", "content": template.get('user', '').format(**kwargs)})
+        return messages
 
-    def generate_response(self, template_name, **kwargs):
+    def generate_response(self, template_name, cancel_event=None, **kwargs):
         """
         Generates a response from the specified model (e.g., OpenAI GPT) using the given template and variables.
 
         :param template_name: The template key to use for generating the system and user prompts.
+        :param cancel_event: Optional cancellation token (anything with `is_set()`, e.g. a SAJE CancelToken).
+                             A set token aborts the in-flight provider request; its `remaining()` deadline,
+                             when present, bounds the request timeout.
         :param kwargs: The dynamic variables to substitute into the template.
         :return: The generated response from the model.
         :raises KeyError: If the template is not found in the loaded templates.
+        :raises JobCancelled: If the cancel_event is set before or during the request.
         """
-        system_prompt, user_prompt = self.generate_prompt(
-            template_name, **kwargs)
+        messages = self.generate_messages(template_name, **kwargs)
+        system_prompt, user_prompt = _flatten(messages)
 
         template = self.templates.get(template_name)
         model = template.get("model", "")
+        _check_cancelled(cancel_event)
+
+        with _measure(template_name, model):
+            if self.cassette is not None:
+                res = self.cassette.response(
+                    template_name, model, system_prompt, user_prompt,
+                    lambda: self._call_model(messages, model, cancel_event, template_name), cancel_event)
+                _check_cancelled(cancel_event)
+            else:
+                res = self._call_model(messages, model, cancel_event, template_name)
 
+        return res  # Returns the generated response.
+
+    def _call_model(self, messages, model, cancel_event=None, template_name=""):
+        """Requests a completion from the provider of the model."""
         match model:
             # OAI models
             case "gpt-4o":
-                res = self._generate_openAI(system_prompt, user_prompt, model)
+                if cancel_event is not None:
+                    # Streaming lets us check the token between chunks and close the connection early
+                    return "".join(self._stream_openAI(messages, model, cancel_event, template_name))
+                return self._generate_openAI(messages, model, template_name)
             # Anthropic models
             case "claude-3-7-sonnet-20250219":
-                res = self._generate_anthropic(
-                    system_prompt, user_prompt, model)
+                return self._generate_anthropic(*_flatten(messages), model)
             # Cintiqo models
             case "QoPilot-1":
-                res = self._generate_QoPilot(system_prompt, user_prompt, model)
+                return self._generate_QoPilot(*_flatten(messages), model, cancel_event)
             case _:
-                print(system_prompt, user_prompt, model)
+                print(messages, model)
                 raise NotImplementedError("Passed model not found!")
 
-        return res  # Returns the generated response.
+    def stream_response(self, template_name, cancel_event=None, **kwargs):
+        """
+        Generates a response like `generate_response`, but yields it in chunks as they arrive.
+        Models without streaming support yield their full response as a single chunk.
+
+        :param template_name: The template key to use for generating the system and user prompts.
+        :param cancel_event: Optional cancellation token, see `generate_response`.
+        :param kwargs: The dynamic variables to substitute into the template.
+        :return: A generator of text chunks.
+        :raises KeyError: If the template is not found in the loaded templates.
+        """
+        messages = self.generate_messages(template_name, **kwargs)
+        system_prompt, user_prompt = _flatten(messages)
+
+        template = self.templates.get(template_name)
+        model = template.get("model", "")
 
-    def _generate_QoPilot(self, system_prompt, user_prompt, model):
+        match model:
+            case "gpt-4o":
+                with _measure(template_name, model):
+                    if self.cassette is not None:
+                        yield from self.cassette.stream(
+                            template_name, model, system_prompt, user_prompt,
+                            lambda: self._stream_openAI(messages, model, cancel_event, template_name), cancel_event)
+                        _check_cancelled(cancel_event)
+                    else:
+                        yield from self._stream_openAI(messages, model, cancel_event, template_name)
+            case _:
+                yield self.generate_response(template_name, cancel_event=cancel_event, **kwargs)
+
+    def _generate_QoPilot(self, system_prompt, user_prompt, model, cancel_event=None):
         if not self.cintiqo_key:
             raise NotImplementedError("Cintiqo API key not provided.")
 
@@ -107,22 +211,24 @@ class PromptingEngine:
             "conversation": False
         }
 
-        uri = "ws://127.0.0.1:8001/ws/QoPilot"
-        ws = websocket.create_connection(uri)
+        import websocket
+
+        ws = websocket.create_connection(self.qopilot_uri, timeout=_request_timeout(cancel_event))
         ws.send(json.dumps(payload))
         response = ws.recv()
         second_res = ws.recv()
         ws.close()
+        _check_cancelled(cancel_event)
 
         return response, second_res
 
-    def _generate_openAI(self, system_prompt, user_prompt, model):
+    def _generate_openAI(self, messages, model, template_name=""):
         """
-        Makes a request to OpenAI's API to generate a response based on the provided prompts.
+        Makes a request to OpenAI's API to generate a response based on the provided messages.
 
-        :param system_prompt: The system prompt to guide the model's behavior.
-        :param user_prompt: The user prompt containing the user's query.
+        :param messages: The chat messages, see `generate_messages`.
         :param model: The model to use (e.g., "gpt-4o").
+        :param template_name: Template of the request, for the usage log.
         :return: The generated response from OpenAI.
         :raises NotImplementedError: If the OpenAI API key is not provided.
         """
@@ -130,23 +236,71 @@ class PromptingEngine:
             # Raises an error if the OpenAI key is not set.
             raise NotImplementedError("OpenAI API key not provided.")
 
-        # Initializes the OpenAI client with the API key.
-        client = OpenAI(api_key=self.openAI_key, timeout=120.0, max_retries=3)
-
-        messages = []  # Initializes a list to hold the conversation messages.
-        if system_prompt:
-            # Adds the system prompt if it exists.
-            messages.append({"role": "system", "content": system_prompt})
-        # Adds the user prompt.
-        messages.append({"role": "user", "content": user_prompt})
+        client = self._openai_client().with_options(timeout=REQUEST_TIMEOUT, max_retries=3)
 
         response = client.chat.completions.create(  # Makes the API call to OpenAI to generate a completion.
             model=model,
             messages=messages
         )
+        _record_usage(template_name, model, response.usage)
         # Returns the content of the first response choice.
         return response.choices[0].message.content
 
+    def _stream_openAI(self, messages, model, cancel_event=None, template_name=""):
+        """
+        Streaming variant of `_generate_openAI`, yielding content deltas as they arrive.
+
+        :param messages: The chat messages, see `generate_messages`.
+        :param model: The model to use (e.g., "gpt-4o").
+        :param cancel_event: Optional cancellation token, checked between chunks.
+        :param template_name: Template of the request, for the usage log.
+        :return: A generator of text chunks.
+        :raises NotImplementedError: If the OpenAI API key is not provided.
+        :raises JobCancelled: If the cancel_event is set while streaming; the HTTP stream is closed first.
+        """
+        if not self.openAI_key:
+            raise NotImplementedError("OpenAI API key not provided.")
+
+        # Retries would outlive a deadline, so only retry requests without one
+        client = self._openai_client().with_options(timeout=_request_timeout(cancel_event),
+                                                    max_retries=3 if cancel_event is None else 0)
+
+        stream = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            # The usage, with the cached prompt tokens, comes in a last chunk without choices
+            stream_options={"include_usage": True}
+        )
+        usage = None
+        try:
+            for chunk in stream:
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # Also reached when the consumer stops early, aborting the provider request
+            stream.close()
+        _record_usage(template_name, model, usage)
+        _check_cancelled(cancel_event)
+
+    def _openai_client(self):
+        """
+        The OpenAI client of this process for the engine's key and endpoint. Per-request timeouts and
+        retries are set with `with_options`, which shares the client's connection pool.
+        """
+        key = (self.openAI_key, self.openAI_base_url)
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                from openai import OpenAI
+                client = _clients[key] = OpenAI(api_key=self.openAI_key, base_url=self.openAI_base_url,
+                                                timeout=REQUEST_TIMEOUT, max_retries=3)
+            return client
+
     def _generate_anthropic(self, system_prompt, user_prompt, model):
         """
         Makes a request to Claude's API to generate a response based on the provided prompts.
@@ -180,6 +334,79 @@ class PromptingEngine:
         return response.content[0].text
 
 
+def shared_engine(templates_path: str = TEMPLATES_PATH) -> PromptingEngine:
+    """The engine of this process for the given templates, built on first use instead of at import."""
+    with _lock:
+        engine = _engines.get(templates_path)
+        if engine is None:
+            engine = _engines[templates_path] = PromptingEngine(API_DICT, templates_path)
+        return engine
+
+
+def _flatten(messages: list[dict]) -> tuple[str, str]:
+    """The system and user prompt of the messages, for providers that take a single prompt."""
+    system_prompt = "\n\n".join(m["content"] for m in messages if m["role"] == "system")
+    user_prompt = "\n\n".join(m["content"] for m in messages if m["role"] == "user")
+    return system_prompt, user_prompt
+
+
+def _record_usage(template_name, model, usage):
+    """Logs the token usage of a provider call, including the prompt tokens served from the provider's prefix cache."""
+    if usage is None:
+        return  # A stream closed before its usage chunk
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) or 0
+    prompt = usage.prompt_tokens or 0
+    completion = usage.completion_tokens or 0
+    metrics.inc("apr_llm_tokens_total", prompt - cached, template=template_name, model=model, kind="prompt")
+    metrics.inc("apr_llm_tokens_total", cached, template=template_name, model=model, kind="prompt_cached")
+    metrics.inc("apr_llm_tokens_total", completion, template=template_name, model=model, kind="completion")
+    technical_log(
+        "llm-usage",
+        function_call=template_name,
+        gebruikteModel=model,
+        performance_metric={
+            "prompt_tokens": prompt,
+            "cached_tokens": cached,
+            "completion_tokens": completion,
+            "cached_ratio": round(cached / prompt, 3) if prompt else None,
+        },
+    )
+
+
+@contextmanager
+def _measure(template_name, model):
+    """Records the duration and outcome of a provider call in the LLM metrics and as a trace span."""
+    start = perf_counter()
+    outcome = "ok"
+    try:
+        with tracing.span(f"llm.{template_name}", template=template_name, model=model):
+            yield
+    except (JobCancelled, GeneratorExit):
+        outcome = "cancelled"
+        raise
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        metrics.observe("apr_llm_request_seconds", perf_counter() - start, template=template_name, model=model)
+        metrics.inc("apr_llm_requests_total", template=template_name, model=model, outcome=outcome)
+
+
+def _check_cancelled(cancel_event):
+    """Raises JobCancelled when the given token is set."""
+    if cancel_event is not None and cancel_event.is_set():
+        raise JobCancelled(getattr(cancel_event, "reason", None) or "cancelled")
+
+
+def _request_timeout(cancel_event):
+    """Provider request timeout, shortened to the time left before the token's deadline."""
+    remaining = getattr(cancel_event, "remaining", lambda: None)()
+    if remaining is None:
+        return REQUEST_TIMEOUT
+    return max(min(REQUEST_TIMEOUT, remaining), 1.0)
+
+
 if __name__ == "__main__":
     engine = PromptingEngine(API_DICT, "src/prompting/templates.json")
 
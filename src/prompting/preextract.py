@@ -0,0 +1,140 @@
+"""
+Rule-based extraction of the preamble fields of an interrogation (datum, tijd, geboortedag, woonadres).
+
+The opening of a Dutch interrogation follows a fixed script: "Vandaag is het 24 april 2024 ...",
+"ik ben geboren op 13 maart 1985 in Den Haag", "U woont op de Molestraat 45, 3011 XD Rotterdam".
+Where a field is stated that way it is read with a regex, with a confidence that says how certain the
+match is; extractInformation only asks the LLM for the fields below PREEXTRACT_THRESHOLD.
+
+    PYTHONPATH=src python -m prompting.preextract data/*.txt
+"""
+import os
+import re
+from datetime import date
+
+# Fields at or above this confidence skip the LLM; above 1 always asks the LLM
+PREEXTRACT_THRESHOLD = float(os.getenv("APR_PREEXTRACT_THRESHOLD", "0.9"))
+# The preamble fields are stated at the start; later mentions are about the case, not the interrogation
+PREAMBLE_CHARS = 3000
+
+MONTHS = {
+    "januari": 1, "jan": 1, "februari": 2, "feb": 2, "maart": 3, "mrt": 3, "april": 4, "apr": 4, "mei": 5,
+    "juni": 6, "jun": 6, "juli": 7, "jul": 7, "augustus": 8, "aug": 8, "september": 9, "sep": 9, "sept": 9,
+    "oktober": 10, "okt": 10, "november": 11, "nov": 11, "december": 12, "dec": 12,
+}
+_MONTH = "|".join(sorted(MONTHS, key=len, reverse=True))
+# "24 april 2024", "24 apr. 2024" or "24-04-2024", "24/4/2024", "24.04.2024"
+DATE = (rf"(?P<day>\d{{1,2}})(?:e|ste|de)?\s+(?P<month_name>{_MONTH})\.?\s+(?P<year>\d{{4}})"
+        rf"|(?P<nday>\d{{1,2}})[-/.](?P<nmonth>\d{{1,2}})[-/.](?P<nyear>\d{{4}})")
+TIME = r"(?P<time>\d{1,2}[:.]\d{2}(?:\s*uur)?|\d{1,2}\s+uur(?:\s+\d{1,2})?)"
+STREET_SUFFIXES = ("straat", "laan", "weg", "gracht", "plein", "kade", "singel", "dijk", "pad", "hof", "dreef",
+                   "steeg", "markt", "park", "plantsoen", "wal", "erf", "baan", "dam", "haven", "veld", "burg")
+
+# (rule, confidence, pattern) per field, the first rule that matches wins
+RULES = {
+    "datum": [
+        ("vandaag-is-het", 0.95, re.compile(rf"\b(?:vandaag is het|het is vandaag|de datum is|datum van vandaag is)\s+"
+                                            rf"(?:\w+dag\s+)?(?:{DATE})", re.IGNORECASE)),
+    ],
+    "tijd": [
+        # "het is vandaag 14 mei 2025, 13:53": the time stated with the date
+        ("datum-tijd", 0.95, re.compile(rf"\b(?:vandaag is het|het is vandaag)\s+(?:\w+dag\s+)?(?:{DATE}),?\s+"
+                                        rf"(?:om\s+)?{TIME}", re.IGNORECASE)),
+        ("het-is-nu", 0.9, re.compile(rf"\b(?:het is nu|de tijd is|het is op dit moment)\s+{TIME}", re.IGNORECASE)),
+        ("verhoor-begint-om", 0.85, re.compile(rf"\bverhoor\s+(?:begint|begon|start|startte)\s+om\s+{TIME}",
+                                               re.IGNORECASE)),
+    ],
+    "geboortedag": [
+        ("geboren-op", 0.95, re.compile(rf"\bgeboren\s+(?:op\s+)?(?:{DATE})", re.IGNORECASE)),
+        ("geboortedatum-is", 0.95, re.compile(rf"\bgeboortedatum\s+(?:is\s+)?:?\s*(?:{DATE})", re.IGNORECASE)),
+    ],
+    "woonadres": [
+        ("woont-op", 0.9, re.compile(
+            r"\b(?:woont|woon|woonachtig|wonende)\s+(?:u\s+)?(?:op|aan)\s+(?:de\s+|het\s+)?"
+            r"(?P<street>[A-Za-zÀ-ÿ][\w'À-ÿ.-]*(?:\s+[A-Za-zÀ-ÿ][\w'À-ÿ.-]*){0,3}?)\s+"
+            r"(?P<number>\d{1,5}(?:\s?[a-zA-Z](?![a-zA-Z]))?(?:-\d{1,4})?)\b", re.IGNORECASE)),
+        ("woonadres-is", 0.9, re.compile(
+            r"\b(?:woonadres|adres)\s+is\s+(?:de\s+)?"
+            r"(?P<street>[A-Za-zÀ-ÿ][\w'À-ÿ.-]*(?:\s+[A-Za-zÀ-ÿ][\w'À-ÿ.-]*){0,3}?)\s+"
+            r"(?P<number>\d{1,5}(?:\s?[a-zA-Z](?![a-zA-Z]))?(?:-\d{1,4})?)\b", re.IGNORECASE)),
+    ],
+}
+FIELDS = tuple(RULES)
+
+
+def preextract(text: str) -> dict[str, dict]:
+    """
+    The preamble fields found in `text`, each as {"value", "confidence", "rule"}. Fields without a
+    match are left out. Values are in the format the LLM prompts of extractInformation ask for.
+    """
+    preamble = text[:PREAMBLE_CHARS]
+    found = {}
+    for field, rules in RULES.items():
+        for rule, confidence, pattern in rules:
+            candidates = []
+            for match in pattern.finditer(preamble):
+                value, certainty = _value(field, match)
+                if value is not None:
+                    candidates.append((value, certainty))
+            if not candidates:
+                continue
+            value, certainty = candidates[0]
+            if len({candidate for candidate, _ in candidates}) > 1:
+                certainty *= 0.6  # The script states the field once; different values need a reader
+            found[field] = {"value": value, "confidence": round(confidence * certainty, 3), "rule": rule}
+            break
+    return found
+
+
+def _value(field: str, match: re.Match) -> tuple[str | None, float]:
+    """The field value of a match in the prompts' format, with a factor on the rule's confidence."""
+    groups = match.groupdict()
+    if field in ("datum", "geboortedag"):
+        parsed = _date(groups)
+        if parsed is None:
+            return None, 0.0
+        if field == "geboortedag" and not 1900 <= parsed.year <= date.today().year:
+            return None, 0.0
+        return parsed.strftime("%d-%m-%Y"), 1.0
+    if field == "tijd":
+        spoken = groups["time"].strip()
+        hour = int(re.match(r"\d+", spoken).group())
+        if hour > 23:
+            return None, 0.0
+        # "12 uur" leaves open whether it is midday or midnight; a clock time doesn't
+        return spoken, 1.0 if re.search(r"\d[:.]\d", spoken) else 0.9
+    if field == "woonadres":
+        street = match.group("street").strip()
+        # A lowercase start means the transcription lost the spelling ("nieuwe gracht"), which the LLM restores
+        certainty = 1.0 if street[0].isupper() else 0.8
+        if not street.lower().endswith(STREET_SUFFIXES):
+            certainty *= 0.9
+        return f"{street} {match.group('number').replace(' ', '')}", certainty
+    return None, 0.0
+
+
+def _date(groups: dict) -> date | None:
+    try:
+        if groups.get("month_name"):
+            return date(int(groups["year"]), MONTHS[groups["month_name"].lower()], int(groups["day"]))
+        if groups.get("nmonth"):
+            return date(int(groups["nyear"]), int(groups["nmonth"]), int(groups["nday"]))
+    except ValueError:
+        return None  # E.g. 31 februari
+    return None
+
+
+if __name__ == "__main__":
+    import sys
+
+    for path in sys.argv[1:]:
+        with open(path, "r", encoding="utf-8") as f:
+            fields = preextract(f.read())
+        print(path)
+        for field in FIELDS:
+            result = fields.get(field)
+            if result is None:
+                print(f"  {field:<12} -")
+            else:
+                skip = "skip" if result["confidence"] >= PREEXTRACT_THRESHOLD else "llm"
+                print(f"  {field:<12} {result['value']!r:<24} {result['confidence']:<6} {result['rule']} ({skip})")
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import re
+from collections import Counter, OrderedDict
+import numpy as np
+
+INDEX_DIR = "data/index"
+
+# Speaker turns shorter than this are merged with the next turn, so a question stays with its answer.
+MIN_CHUNK_CHARS = 300
+# Longer turns, and transcripts without speaker labels, are split on sentence boundaries.
+MAX_CHUNK_CHARS = 900
+TOP_K = 5
+
+# BM25 parameters
+K1 = 1.5
+B = 0.75
+
+STOPWORDS = {
+    "de", "het", "een", "en", "van", "in", "is", "dat", "op", "te", "ik", "u", "je", "jij", "die",
+    "niet", "met", "zijn", "er", "voor", "aan", "ook", "als", "maar", "om", "bij", "wat", "dan",
+    "was", "of", "hij", "zij", "ze", "we", "wij", "nog", "al", "naar", "uit", "tot", "door", "over",
+    "heb", "ben", "hebben", "had", "wel", "nee", "ja", "dus", "uh", "uhm", "eh", "ehh", "nou", "heeft",
+}
+
+SPEAKER_PATTERN = re.compile(r"^\s*([^\W\d][\w .\-]{0,30}):\s", re.MULTILINE)
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?…])\s+")
+
+# Recently used indexes of this process, keyed by report ID
+_loaded = OrderedDict()
+_LOADED_SIZE = 32
+
+
+def tokenize(text: str) -> list[str]:
+    return [t for t in re.findall(r"\w+", text.lower()) if t not in STOPWORDS and len(t) > 1]
+
+
+def _split_long(text: str) -> list[str]:
+    """Splits text into pieces of at most MAX_CHUNK_CHARS, on sentence boundaries where possible."""
+    pieces, current = [], ""
+    for sentence in SENTENCE_PATTERN.split(text.strip()):
+        if current and len(current) + len(sentence) + 1 > MAX_CHUNK_CHARS:
+            pieces.append(current)
+            current = ""
+        current = f"{current} {sentence}".strip()
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def split_passages(text: str) -> list[str]:
+    """
+    Splits a transcript into passages: speaker turns ("MG: ...", "oa1: ..."), short turns merged
+    with the following one and long ones split. Transcripts without speaker labels are split
+    into sentence windows.
+    """
+    starts = [m.start() for m in SPEAKER_PATTERN.finditer(text)]
+    if len(starts) < 2:
+        return _split_long(text)
+
+    if starts[0] > 0 and text[:starts[0]].strip():
+        starts.insert(0, 0)
+    turns = [text[a:b].strip() for a, b in zip(starts, starts[1:] + [len(text)])]
+
+    passages, current = [], ""
+    for turn in turns:
+        if not turn:
+            continue
+        current = f"{current}\n{turn}".strip()
+        if len(current) >= MIN_CHUNK_CHARS:
+            passages.extend(_split_long(current) if len(current) > MAX_CHUNK_CHARS else [current])
+            current = ""
+    if current:
+        passages.append(current)
+    return passages
+
+
+class PassageIndex:
+    """BM25 index over the passages of one transcript, held as a (passages x terms) weight matrix."""
+
+    def __init__(self, passages: list[str], terms: list[str], weights: np.ndarray, input_hash: str) -> None:
+        self.passages = passages
+        self.terms = {term: i for i, term in enumerate(terms)}
+        self.weights = weights
+        self.input_hash = input_hash
+
+    @classmethod
+    def build(cls, text: str) -> "PassageIndex":
+        passages = split_passages(text)
+        counts = [Counter(tokenize(p)) for p in passages]
+        terms = sorted({t for c in counts for t in c})
+        term_ids = {t: i for i, t in enumerate(terms)}
+
+        tf = np.zeros((len(passages), len(terms)), dtype=np.float32)
+        for row, c in enumerate(counts):
+            for term, n in c.items():
+                tf[row, term_ids[term]] = n
+
+        lengths = tf.sum(axis=1, keepdims=True)
+        avg_length = float(lengths.mean()) if len(passages) else 0.0
+        df = (tf > 0).sum(axis=0)
+        idf = np.log(1 + (len(passages) - df + 0.5) / (df + 0.5)).astype(np.float32)
+        norm = K1 * (1 - B + B * lengths / max(avg_length, 1.0))
+        weights = idf * tf * (K1 + 1) / (tf + norm)
+
+        return cls(passages, terms, weights.astype(np.float32), _input_hash(text))
+
+    def search(self, query: str, k: int = TOP_K) -> list[str]:
+        """
+        Returns the k passages scoring highest for the query, in transcript order.
+        Without any matching term, the opening passages are returned.
+        """
+        if not self.passages:
+            return []
+        k = min(k, len(self.passages))
+
+        ids = [self.terms[t] for t in tokenize(query) if t in self.terms]
+        if not ids:
+            return self.passages[:k]
+
+        scores = self.weights[:, ids].sum(axis=1)
+        best = np.argpartition(-scores, k - 1)[:k]
+        return [self.passages[i] for i in sorted(best) if scores[i] > 0] or self.passages[:k]
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp.npz"
+        terms = sorted(self.terms, key=self.terms.get)
+        np.savez_compressed(
+            tmp_path,
+            weights=self.weights,
+            terms=np.array(terms, dtype=str),
+            passages=np.array([json.dumps(self.passages)]),
+            input_hash=np.array([self.input_hash]),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "PassageIndex":
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                json.loads(str(data["passages"][0])),
+                [str(t) for t in data["terms"]],
+                data["weights"],
+                str(data["input_hash"][0]),
+            )
+
+
+def _input_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _index_path(file_id: str) -> str:
+    return os.path.join(INDEX_DIR, f"{os.path.basename(file_id)}.npz")
+
+
+def build_passage_index(file_id: str, text: str) -> PassageIndex:
+    """Builds and stores the passage index of a report. Called once by GenerateReport."""
+    index = PassageIndex.build(text)
+    index.save(_index_path(file_id))
+    _remember(file_id, index)
+    return index
+
+
+def get_passage_index(file_id: str, text: str) -> PassageIndex:
+    """
+    Returns the index of a report for its current transcript, loading it from disk or
+    (for reports from before the index existed, or with a changed transcript) rebuilding it.
+    """
+    expected_hash = _input_hash(text)
+    index = _loaded.get(file_id)
+    if index is None or index.input_hash != expected_hash:
+        try:
+            index = PassageIndex.load(_index_path(file_id))
+        except (FileNotFoundError, OSError, ValueError, KeyError):
+            index = None
+        if index is None or index.input_hash != expected_hash:
+            return build_passage_index(file_id, text)
+    _remember(file_id, index)
+    return index
+
+
+def remove_passage_index(file_id: str) -> None:
+    _loaded.pop(file_id, None)
+    try:
+        os.remove(_index_path(file_id))
+    except OSError:
+        pass
+
+
+def _remember(file_id: str, index: PassageIndex) -> None:
+    _loaded[file_id] = index
+    _loaded.move_to_end(file_id)
+    while len(_loaded) > _LOADED_SIZE:
+        _loaded.popitem(last=False)
+
+
+def relevant_passages(file_id: str, text: str, query: str, k: int = TOP_K) -> str:
+    """The top-k passages of a report's transcript for the query, joined for use in a prompt."""
+    return "\n[...]\n".join(get_passage_index(file_id, text).search(query, k))
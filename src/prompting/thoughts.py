@@ -0,0 +1,152 @@
+import asyncio
+import re
+import threading
+from collections import OrderedDict
+from time import monotonic
+from saje import JobCancelled
+
+# Seconds without a newer request before a thought request is sent to the model.
+DEBOUNCE_SECONDS = 0.75
+# Minimal word overlap (Jaccard) for a cached draft section to be reused for an edited one.
+REUSE_SIMILARITY = 0.8
+CACHE_SIZE = 256
+
+
+def normalize_section(draft: str) -> str:
+    """
+    Reduces the paragraph the user is working on (the last one of the draft) to a cache key:
+    lowercased, punctuation and whitespace runs removed, and a half-typed last word dropped.
+    """
+    paragraphs = [p for p in re.split(r"\n\s*\n", draft or "") if p.strip()]
+    section = paragraphs[-1] if paragraphs else ""
+    words = re.findall(r"\w+", section.lower())
+    if words and section and not re.search(r"[\s.,;:!?]$", section):
+        words = words[:-1]
+    return " ".join(words)
+
+
+def _similarity(a: str, b: str) -> float:
+    a_words, b_words = set(a.split()), set(b.split())
+    if not a_words or not b_words:
+        return 1.0 if a_words == b_words else 0.0
+    return len(a_words & b_words) / len(a_words | b_words)
+
+
+class ThoughtCache:
+    """LRU cache of generated thoughts per (report, normalized draft section)."""
+
+    def __init__(self, size: int = CACHE_SIZE) -> None:
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, report: str, section: str):
+        key = (report, section)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        # Small edits: reuse the most similar section of the same report
+        best, best_score = None, REUSE_SIMILARITY
+        for (cached_report, cached_section), thoughts in self.entries.items():
+            if cached_report != report:
+                continue
+            score = _similarity(section, cached_section)
+            if score >= best_score:
+                best, best_score = thoughts, score
+        return best
+
+    def put(self, report: str, section: str, thoughts: list) -> None:
+        self.entries[(report, section)] = thoughts
+        self.entries.move_to_end((report, section))
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+# Shared by all connections of this worker
+thought_cache = ThoughtCache()
+
+
+class ThoughtSession:
+    """
+    Coordinates "requested-thought" requests of one websocket connection.
+
+    Bursts are coalesced: a request only reaches the model after DEBOUNCE_SECONDS without a newer
+    one, and a newer request cancels the provider call of an older one that is still running.
+    """
+
+    def __init__(self, cache: ThoughtCache = thought_cache) -> None:
+        self.cache = cache
+        self.generation = 0
+        self._pending_wake = None
+        self._inflight_cancel = None
+        self.requests = 0
+        self.cache_hits = 0
+        self.superseded = 0
+        self.llm_calls = 0
+        self.first_request = None
+        self.last_request = None
+
+    async def request(self, report: str, draft: str, generate):
+        """
+        :param report: ID of the report the thoughts are for.
+        :param draft: The user's current proces-verbaal draft.
+        :param generate: Blocking `generate(cancel_event) -> list` that calls the model,
+                         run in a thread and expected to stop when cancel_event is set.
+        :return: The thoughts, or None when the request was superseded by a newer one.
+        """
+        now = monotonic()
+        self.requests += 1
+        self.first_request = self.first_request or now
+        self.last_request = now
+
+        # Whatever was still pending is outdated now
+        self.generation += 1
+        generation = self.generation
+        if self._pending_wake is not None:
+            self._pending_wake.set()
+        if self._inflight_cancel is not None:
+            self._inflight_cancel.set()
+
+        section = normalize_section(draft)
+        cached = self.cache.get(report, section)
+        if cached is not None:
+            self.cache_hits += 1
+            return cached
+
+        wake = asyncio.Event()
+        self._pending_wake = wake
+        try:
+            await asyncio.wait_for(wake.wait(), DEBOUNCE_SECONDS)
+            self.superseded += 1
+            return None
+        except asyncio.TimeoutError:
+            pass
+
+        cancel_event = threading.Event()
+        self._inflight_cancel = cancel_event
+        self.llm_calls += 1
+        try:
+            thoughts = await asyncio.to_thread(generate, cancel_event)
+        except JobCancelled:
+            self.superseded += 1
+            return None
+        finally:
+            if self._inflight_cancel is cancel_event:
+                self._inflight_cancel = None
+
+        self.cache.put(report, section, thoughts)
+        if generation != self.generation:
+            self.superseded += 1
+            return None
+        return thoughts
+
+    def stats(self) -> dict:
+        typing_seconds = (self.last_request - self.first_request) if self.first_request else 0.0
+        return {
+            "requests": self.requests,
+            "llm_calls": self.llm_calls,
+            "cache_hits": self.cache_hits,
+            "superseded": self.superseded,
+            "typing_seconds": round(typing_seconds, 1),
+            "llm_calls_per_minute": round(self.llm_calls / (typing_seconds / 60), 2) if typing_seconds else self.llm_calls,
+        }
@@ -1,10 +1,255 @@
+import hashlib
+import os
 from multiprocessing.queues import Queue
-from time import sleep
+from queue import Empty
+from inspect import signature
+from time import sleep, monotonic, time
+from APRLogger import technical_log
+import metrics
+import tracing
+import profiling
+
+# Deadlines (in seconds after submission) per job function, used when `send` gets no explicit timeout.
+JOB_TIMEOUTS = {
+    "GenerateReport": 15 * 60,
+    "create_pdf_report": 2 * 60,
+    "delete_metadata_entry": 60,
+}
+DEFAULT_JOB_TIMEOUT = 10 * 60
+
+# Up to which stage a duplicate submission (same job type + same content/ID) is attached to the
+# in-flight job instead of running again. PDF jobs read the metadata when they start, so only
+# queued ones can be shared; job types not listed here are never coalesced.
+COALESCE_UNTIL = {
+    "GenerateReport": "ongoing",
+    "create_pdf_report": "queued",
+    "extractBlocks": "ongoing",
+    "speculateBlocks": "ongoing",
+    "speculateThoughts": "ongoing",
+}
+
+# Job statuses per batch progress category, see SajeClient.batch_progress
+FINISHED_STATUSES = {"done": "done", "report": "done", "deleted": "done", "error": "error", "cancelled": "cancelled"}
+RUNNING_STATUSES = ("ongoing", "update")
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when its CancelToken is set, either by the user or by its deadline."""
+
+    def __init__(self, reason: str = "cancelled") -> None:
+        super().__init__(f"Job {reason}")
+        self.reason = reason
+
+
+class CancelToken:
+    """
+    Cancellation token handed to SAJE jobs through their `cancel_event` keyword argument.
+    Exposes the same `is_set()` as a threading.Event, so it can be checked the same way,
+    and is set either when SajeClient.cancel was called for the job after it was submitted
+    or when the job's deadline has passed.
+
+    :param generation: The number of cancels of UUID when the job was submitted (see SajeClient.cancel).
+    """
+
+    def __init__(self, UUID: str, cancelled, generation: int, deadline: float | None = None) -> None:
+        self.UUID = UUID
+        self.cancelled = cancelled
+        self.generation = generation
+        self.deadline = deadline
+
+    @property
+    def reason(self) -> str | None:
+        # Cancels from before this submission belong to an earlier job under the same ID.
+        if self.cancelled is not None and self.cancelled.get(self.UUID, 0) > self.generation:
+            return "cancelled"
+        if self.deadline is not None and time() >= self.deadline:
+            return "timeout"
+        return None
+
+    def is_set(self) -> bool:
+        return self.reason is not None
+
+    def remaining(self) -> float | None:
+        """Seconds left until the deadline, or None when the job has no deadline."""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time(), 0.0)
+
+    def raise_if_set(self) -> None:
+        reason = self.reason
+        if reason:
+            raise JobCancelled(reason)
+
+
+class ProgressReporter:
+    """
+    Publishes "update" statuses for a running SAJE job, which monitor_job
+    streams to the websocket client.
+
+    Jobs receive an instance through their `progress` keyword argument and call it
+    once per completed step:
+        progress("datum", done=1, total=10)
+    Elapsed time and ETA are derived from the average time per completed step.
+    """
+
+    def __init__(self, UUID: str, job_status_dict, min_interval: float = 0.5) -> None:
+        self.UUID = UUID
+        self.job_status_dict = job_status_dict
+        self.min_interval = min_interval
+        self.started = monotonic()
+        self.seq = 0
+        self._last_sent = 0.0
+
+    def __call__(self, stage: str, done: int, total: int, force: bool = True, **detail) -> None:
+        """
+        :param stage: Name of the step that just completed (e.g. an extracted field).
+        :param done: Number of completed steps.
+        :param total: Total number of steps in the job.
+        :param force: When False, the update is dropped if the previous one was sent less than
+                      `min_interval` seconds ago. Used for high-frequency events such as stream chunks.
+        :param detail: Extra, JSON-serializable information passed on to the client.
+        """
+        now = monotonic()
+        if not force and now - self._last_sent < self.min_interval:
+            return
+
+        elapsed = now - self.started
+        eta = elapsed / done * (total - done) if done else None
+
+        self.seq += 1
+        self._last_sent = now
+        self.job_status_dict[self.UUID] = {
+            "status": "update",
+            "seq": self.seq,
+            "update": {
+                "ID": self.UUID,
+                "stage": stage,
+                "done": done,
+                "total": total,
+                "elapsed_s": round(elapsed, 2),
+                "eta_s": round(eta, 2) if eta is not None else None,
+                **detail,
+            },
+        }
+
+
+def _inject(function: callable, kwargs: dict, **available) -> dict:
+    """Adds worker-provided arguments (e.g. `progress`) for jobs whose signature accepts them."""
+    try:
+        params = signature(function).parameters
+    except (TypeError, ValueError):
+        return kwargs
+
+    for name, value in available.items():
+        if name in params and name not in kwargs:
+            kwargs[name] = value
+    return kwargs
+
+
+def job_key(function: callable, args: tuple, kwargs: dict, file_hashes: dict | None = None) -> str:
+    """
+    Identifies duplicate submissions: the job type plus a hash of its arguments,
+    where arguments that are paths to existing files are hashed by their content.
+
+    :param file_hashes: Already known sha256 hex digests of file arguments, by path.
+    """
+    file_hashes = file_hashes or {}
+    digest = hashlib.sha256()
+    for value in (*args, *sorted(kwargs.items())):
+        if isinstance(value, str) and value in file_hashes:
+            digest.update(bytes.fromhex(file_hashes[value]))
+        elif isinstance(value, str) and os.path.isfile(value):
+            with open(value, "rb") as f:
+                digest.update(hashlib.file_digest(f, "sha256").digest())
+        else:
+            digest.update(repr(value).encode("utf-8"))
+    return f"{function.__name__}:{digest.hexdigest()}"
+
+
+def _mark_inflight(inflight, lock, key: str | None, enqueued_at: float, stage: str) -> None:
+    if key is None or inflight is None:
+        return
+    with lock:
+        entry = inflight.get(key)
+        # A newer submission may have taken over the key, leave its entry alone
+        if entry is not None and entry["enqueued_at"] == enqueued_at:
+            inflight[key] = {**entry, "stage": stage}
+
+
+def _release_inflight(inflight, lock, key: str | None, enqueued_at: float, UUID: str) -> None:
+    """Removes a finished job from the coalescing registry and logs how many callers it served."""
+    if key is None or inflight is None:
+        return
+    with lock:
+        entry = inflight.get(key)
+        if entry is None or entry["enqueued_at"] != enqueued_at:
+            return
+        del inflight[key]
+    if entry["attached"]:
+        technical_log(
+            "saje-coalesce",
+            dataID=UUID,
+            function_call=key.split(":", 1)[0],
+            coalesced_requests=entry["attached"],
+        )
+
+
+def _next_job(saje_queue: Queue, low_queue: Queue | None):
+    """Takes the next job, preferring the normal queue: low-priority jobs only run when it is empty."""
+    if low_queue is None:
+        return saje_queue.get()
+    while True:
+        for lane in (saje_queue, low_queue):
+            try:
+                return lane.get_nowait()
+            except Empty:
+                pass
+        # Both empty: wait for normal jobs, checking the low-priority queue every half second
+        try:
+            return saje_queue.get(timeout=0.5)
+        except Empty:
+            continue
+
+
+def worker(saje_queue: Queue, job_status_dict, cancelled_dict=None, inflight_dict=None, inflight_lock=None,
+           low_queue=None, warm_up=None):
+    # Lets jobs queue follow-up jobs of their own
+    saje_client = SajeClient(saje_queue, cancelled_dict, job_status_dict, inflight_dict, inflight_lock, low_queue)
+    if warm_up is not None:
+        _warm_up(warm_up)
 
-def worker(saje_queue: Queue, job_status_dict):
     while True:
-        UUID, function, description, args, kwargs = saje_queue.get()
+        UUID, function, description, args, kwargs, options = _next_job(saje_queue, low_queue)
+        if options.get("deadline") is None and options.get("timeout"):
+            # Low-priority jobs may wait long for their turn, so their time only counts from the start
+            options["deadline"] = time() + options["timeout"]
+        token = CancelToken(UUID, cancelled_dict, options.get("cancel_generation", 0), options.get("deadline"))
+        key = options.get("key")
+        job_type = function.__name__
+        started = time()
+        metrics.observe("apr_saje_queue_wait_seconds", started - options["enqueued_at"], job=job_type)
+        # The job continues the trace of whatever submitted it
+        tracing.record_span("saje.queued", options.get("trace"), options["enqueued_at"],
+                            started - options["enqueued_at"], dataID=UUID, job=job_type)
+        job_span = tracing.Span(f"saje.{job_type}", options.get("trace"), dataID=UUID)
+
+        if token.is_set():
+            # Cancelled or expired while still waiting in the queue
+            print(f"[Worker] Skipping job: {UUID} -> {token.reason} before start")
+            job_status_dict[UUID] = _cancelled_status(token.reason)
+            metrics.inc("apr_saje_jobs_total", job=job_type, outcome=token.reason)
+            job_span.end(token.reason)
+            _release_inflight(inflight_dict, inflight_lock, key, options["enqueued_at"], UUID)
+            continue
+
+        _mark_inflight(inflight_dict, inflight_lock, key, options["enqueued_at"], "ongoing")
         job_status_dict[UUID] = {"status" : "ongoing"}
+        kwargs = _inject(function, kwargs,
+                         progress=ProgressReporter(UUID, job_status_dict),
+                         cancel_event=token,
+                         saje_client=saje_client)
+        outcome = "error"
+        profile = profiling.start("saje", job_type, UUID)
 
         try:
 
@@ -45,19 +290,193 @@ def worker(saje_queue: Queue, job_status_dict):
                     res = function(*args, **kwargs)
                     job_status_dict[UUID] = {"status" : "done", "res" : res}
 
+            # A job that completed keeps its result, also when its deadline or a cancel came in meanwhile:
+            # its effects (e.g. a stored report) exist by now
+            outcome = "ok"
             print(f"[Worker] Finished job: {UUID}") 
+
+        except JobCancelled as e:
+            job_status_dict[UUID] = _cancelled_status(e.reason)
+            outcome = e.reason
+            print(f"[Worker] Job {UUID} stopped: {e.reason}")
       
         except Exception as e:
             job_status_dict[UUID] = {"status" : "error"}
             print(f"[Worker] Error in job {UUID} -> function {function.__name__} -> description {description}: {e}")
 
+        finally:
+            metrics.observe("apr_saje_run_seconds", time() - started, job=job_type)
+            metrics.inc("apr_saje_jobs_total", job=job_type, outcome=outcome)
+            job_span.end(outcome)
+            if profile is not None:
+                profile.stop(outcome)
+            _release_inflight(inflight_dict, inflight_lock, key, options["enqueued_at"], UUID)
+
+
+def _warm_up(warm_up) -> None:
+    """
+    Runs the worker's warm-up hook before it takes jobs, so the first job doesn't pay for imports,
+    clients or a browser start. The hook returns the duration per step it completed.
+    """
+    started = time()
+    try:
+        steps = warm_up() or {}
+    except Exception as e:
+        print(f"[Worker] Warm-up failed, starting cold: {e}")
+        return
+    duration = time() - started
+    print(f"[Worker] Warmed up in {duration:.2f}s: {', '.join(steps) or 'nothing'}")
+    technical_log(
+        "saje-warm-up",
+        function_call=getattr(warm_up, "__name__", str(warm_up)),
+        performance_metric={
+            "duration_ms": round(duration * 1000, 2),
+            "steps_ms": {step: round(seconds * 1000, 2) for step, seconds in steps.items()},
+        },
+    )
+
+
+def _cancelled_status(reason: str) -> dict:
+    if reason == "timeout":
+        return {"status": "error", "error": "deadline exceeded"}
+    return {"status": "cancelled"}
+
 
 class SajeClient:
-    def __init__(self, queue: Queue) -> None:
+    def __init__(self, queue: Queue, cancelled=None, job_status=None, inflight=None, inflight_lock=None,
+                 low_queue=None, batches=None) -> None:
         self.queue = queue
+        self.cancelled = cancelled
+        self.job_status = job_status
+        self.inflight = inflight
+        self.inflight_lock = inflight_lock
+        self.low_queue = low_queue
+        self.batches = batches
     
-    def send(self, UUID: str, function: callable, description: str, *args, **kwargs) -> None:
+    def send(self, UUID: str, function: callable, description: str, *args,
+             timeout: float | None = None, key: str | None = None, low_priority: bool = False, **kwargs) -> str:
+        """
+        Queues `function(*args, **kwargs)` for the SAJE worker under the given UUID.
+        When an identical job (see `job_key`) is still in flight, nothing is queued and the
+        caller is attached to that job instead: the job status of UUID then points to it.
+
+        :param timeout: Seconds the job may take from submission until it is cancelled,
+                        defaults to the function's entry in JOB_TIMEOUTS.
+        :param key: Precomputed coalescing key (see `job_key`), e.g. when the content hash is already known.
+        :param low_priority: Queue the job behind all interactive jobs, e.g. for batch ingestion.
+                             Its timeout then counts from when it starts instead of from submission.
+        :return: The UUID of the job that will produce the result, which differs from the
+                 passed UUID when the submission was coalesced.
+        """
         print(f"[Worker] Received job: {UUID} -> function {function.__name__} -> {description}")
-        self.queue.put_nowait((UUID, function, description, args, kwargs))
+        timeout = timeout or JOB_TIMEOUTS.get(function.__name__, DEFAULT_JOB_TIMEOUT)
+        enqueued_at = time()
+        low_priority = low_priority and self.low_queue is not None
+        if low_priority:
+            options = {"enqueued_at": enqueued_at, "deadline": None, "timeout": timeout}
+        else:
+            options = {"enqueued_at": enqueued_at, "deadline": enqueued_at + timeout}
+        if self.cancelled is not None:
+            # Only cancels after this point stop the job, not earlier ones of the same UUID
+            options["cancel_generation"] = self.cancelled.get(UUID, 0)
+
+        coalesce_until = COALESCE_UNTIL.get(function.__name__)
+        if coalesce_until and self.inflight is not None and self.job_status is not None:
+            if key is None:
+                key = job_key(function, args, kwargs)
+            owner = self._attach(UUID, key, coalesce_until, enqueued_at)
+            if owner is not None:
+                return owner
+            options["key"] = key
+
+        trace = tracing.current()
+        if trace is not None:
+            options["trace"] = trace
+        queue = self.low_queue if low_priority else self.queue
+        queue.put_nowait((UUID, function, description, args, kwargs, options))
+        return UUID
+
+    def _attach(self, UUID: str, key: str, coalesce_until: str, enqueued_at: float) -> str | None:
+        """Attaches UUID to the in-flight job for key, or registers it as that job. Returns the owner if attached."""
+        with self.inflight_lock:
+            entry = self.inflight.get(key)
+            stages = ("queued",) if coalesce_until == "queued" else ("queued", "ongoing")
+            if entry is None or entry["stage"] not in stages:
+                self.inflight[key] = {"UUID": UUID, "stage": "queued", "attached": 0, "enqueued_at": enqueued_at}
+                return None
+            entry = {**entry, "attached": entry["attached"] + 1}
+            self.inflight[key] = entry
+
+        owner = entry["UUID"]
+        if owner != UUID:
+            self.job_status[UUID] = {"status": "coalesced", "UUID": owner}
+        print(f"[Worker] Coalesced job: {UUID} -> attached to {owner}")
+        technical_log(
+            "saje-coalesce",
+            dataID=UUID,
+            function_call=key.split(":", 1)[0],
+            coalesced_into=owner,
+            coalesced_requests=entry["attached"],
+        )
+        return owner
+
+    def cancel(self, UUID: str) -> None:
+        """Cancels every job submitted under UUID so far, whether it is queued or already running."""
+        if self.cancelled is None:
+            return
+        print(f"[Worker] Cancelling job: {UUID}")
+        # A counter rather than a timestamp, so a job submitted right after the cancel is never caught by it
+        self.cancelled[UUID] = self.cancelled.get(UUID, 0) + 1
+
+    def register_batch(self, batch_id: str, jobs: dict) -> None:
+        """
+        Groups jobs into a batch, whose combined progress is available through `batch_progress`.
+
+        :param jobs: The job UUIDs of the batch mapped to a display name, e.g. the uploaded filename.
+        """
+        self.batches[batch_id] = {"jobs": dict(jobs), "created_at": time(), "finished_at": None}
+
+    def batch_progress(self, batch_id: str) -> dict | None:
+        """
+        Counts the jobs of a batch per state and derives the throughput (reports per minute since
+        the batch was registered) and an ETA from it. Returns None for unknown batches.
+        """
+        batch = self.batches.get(batch_id)
+        if batch is None:
+            return None
+
+        counts = {"done": 0, "error": 0, "cancelled": 0, "running": 0, "queued": 0}
+        jobs = {}
+        for UUID, name in batch["jobs"].items():
+            status = self.job_status.get(UUID)
+            if status is not None and status.get("status") == "coalesced":
+                status = self.job_status.get(status["UUID"])
+            state = status.get("status") if status else None
+            category = FINISHED_STATUSES.get(state) or ("running" if state in RUNNING_STATUSES else "queued")
+            counts[category] += 1
+            jobs[UUID] = {"name": name, "state": category}
 
+        total = len(jobs)
+        finished = counts["done"] + counts["error"] + counts["cancelled"]
+        finished_at = batch["finished_at"]
+        if finished == total and finished_at is None:
+            finished_at = time()
+            self.batches[batch_id] = {**batch, "finished_at": finished_at}
+            technical_log(
+                "saje-batch",
+                dataID=batch_id,
+                performance_metric={**counts, "total": total, "duration_s": round(finished_at - batch["created_at"], 2)},
+            )
 
+        elapsed = (finished_at or time()) - batch["created_at"]
+        per_minute = finished / (elapsed / 60) if elapsed > 0 else 0.0
+        return {
+            "batch": batch_id,
+            "total": total,
+            **counts,
+            "finished": finished == total,
+            "elapsed_s": round(elapsed, 2),
+            "reports_per_minute": round(per_minute, 2),
+            "eta_s": round((total - finished) / per_minute * 60, 2) if per_minute and finished < total else None,
+            "jobs": jobs,
+        }
@@ -7,10 +7,18 @@ load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 CINTIQO_API_KEY = os.getenv("CINTIQO_API_KEY")
 APP_ACCES_KEY = os.getenv("APP_ACCES_KEY")
+# Grants the admin websocket actions (e.g. "profiling") besides normal access; unset means nobody is admin
+APR_ADMIN_KEY = os.getenv("APR_ADMIN_KEY")
+# Provider endpoints, overridden to point at local stubs (see benchmarks/fake_providers.py)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+QOPILOT_URI = os.getenv("QOPILOT_URI", "ws://127.0.0.1:8001/ws/QoPilot")
 
-DEBUG = os.getenv("DEBUG")
+# "1" switches on debug output and, by default, reloading of static assets (see assets.py)
+DEBUG = os.getenv("DEBUG", "0") == "1"
 
 API_DICT = {
     "openAI" : OPENAI_API_KEY,
     "cintiqo" : CINTIQO_API_KEY,
+    "openAI_base_url" : OPENAI_BASE_URL,
+    "qopilot_uri" : QOPILOT_URI,
 }
\ No newline at end of file
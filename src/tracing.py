@@ -0,0 +1,170 @@
+import argparse
+import contextvars
+import json
+import multiprocessing
+import os
+import threading
+from contextlib import contextmanager
+from time import perf_counter, time
+from uuid import uuid4
+from APRLogger import technical_log
+
+# Span of the code currently running. Copied into asyncio tasks and asyncio.to_thread calls,
+# and carried to the SAJE worker by SajeClient.send.
+_current = contextvars.ContextVar("apr_trace_span", default=None)
+
+# Attributes that are also logged as the standard top-level fields of the technical log
+_LOG_FIELDS = ("gebruikersID", "sessieID", "dataID")
+
+
+class Span:
+    """
+    A timed step of a transaction. The transaction (trace) is logged as `transactieID` and each span
+    as a "trace-span" record with its own `activiteitID` and that of its parent span.
+    """
+
+    def __init__(self, name: str, parent: dict | None = None, **attributes) -> None:
+        parent = parent if parent is not None else _current.get()
+        self.name = name
+        self.trace_id = parent["trace_id"] if parent else uuid4().hex
+        self.span_id = uuid4().hex[:16]
+        self.parent_id = parent["span_id"] if parent else None
+        self.attributes = attributes
+        self.start = time()
+        self._started = perf_counter()
+        self._token = _current.set(self.context)
+
+    @property
+    def context(self) -> dict:
+        """The part of the span that child spans need, also in other processes."""
+        return {"trace_id": self.trace_id, "span_id": self.span_id}
+
+    def end(self, status: str = "ok") -> None:
+        try:
+            _current.reset(self._token)
+        except ValueError:
+            pass  # Ended from another context, e.g. a generator finished by a different task
+        _log_span(self.name, self.trace_id, self.span_id, self.parent_id, self.start,
+                  perf_counter() - self._started, status, self.attributes)
+
+
+@contextmanager
+def span(name: str, parent: dict | None = None, **attributes):
+    """Runs the block as a span, a child of `parent` or else of the current span."""
+    current = Span(name, parent, **attributes)
+    status = "ok"
+    try:
+        yield current
+    except BaseException as e:
+        cancelled = type(e).__name__ in ("JobCancelled", "CancelledError", "GeneratorExit")
+        status = "cancelled" if cancelled else "error"
+        raise
+    finally:
+        current.end(status)
+
+
+def current() -> dict | None:
+    """The context of the current span, to pass along with work that continues elsewhere."""
+    return _current.get()
+
+
+def current_trace_id() -> str | None:
+    context = _current.get()
+    return context["trace_id"] if context else None
+
+
+def record_span(name: str, parent: dict | None, start: float, duration: float, status: str = "ok",
+                **attributes) -> None:
+    """Logs an interval that was measured afterwards, like a queue wait, as a child span of `parent`."""
+    trace_id = parent["trace_id"] if parent else uuid4().hex
+    _log_span(name, trace_id, uuid4().hex[:16], parent["span_id"] if parent else None, start, duration,
+              status, attributes)
+
+
+def _log_span(name: str, trace_id: str, span_id: str, parent_id: str | None, start: float, duration: float,
+              status: str, attributes: dict) -> None:
+    technical_log(
+        "trace-span",
+        transactieID=trace_id,
+        activiteitID=span_id,
+        parent_activiteitID=parent_id,
+        **{field: attributes[field] for field in _LOG_FIELDS if field in attributes},
+        span={
+            "name": name,
+            "start_us": int(start * 1_000_000),
+            "duration_us": int(duration * 1_000_000),
+            "status": status,
+            "pid": os.getpid(),
+            "process": multiprocessing.current_process().name,
+            "tid": threading.get_native_id(),
+            "attributes": {k: v for k, v in attributes.items() if k not in _LOG_FIELDS},
+        },
+    )
+
+
+# ---- Exporter ---------------------------------------------------------------
+
+
+def read_spans(log_directory: str = "./tmp/logs", trace_id: str | None = None) -> list[dict]:
+    """Reads the span records from the technical log and its rotated files, optionally of one trace."""
+    spans = []
+    for entry in sorted(os.listdir(log_directory)):
+        if not entry.startswith("technical.jsonl"):
+            continue
+        with open(os.path.join(log_directory, entry), "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if '"trace-span"' not in line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if trace_id and record.get("transactieID") != trace_id:
+                    continue
+                spans.append(record)
+    return spans
+
+
+def to_chrome_trace(spans: list[dict]) -> dict:
+    """
+    Converts span records to the Chrome trace event format, which chrome://tracing and
+    ui.perfetto.dev open directly: one complete ("X") event per span, grouped per process and thread.
+    """
+    events, processes = [], {}
+    for record in spans:
+        info = record["span"]
+        processes[info["pid"]] = info.get("process") or str(info["pid"])
+        events.append({
+            "name": info["name"],
+            "cat": record.get("transactieID", ""),
+            "ph": "X",
+            "ts": info["start_us"],
+            "dur": info["duration_us"],
+            "pid": info["pid"],
+            "tid": info["tid"],
+            "args": {
+                "transactieID": record.get("transactieID"),
+                "activiteitID": record.get("activiteitID"),
+                "parent_activiteitID": record.get("parent_activiteitID"),
+                "status": info.get("status"),
+                **info.get("attributes", {}),
+            },
+        })
+    events.sort(key=lambda event: event["ts"])
+    for pid, name in processes.items():
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": name}})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export trace spans from the technical log as Chrome/Perfetto JSON.")
+    parser.add_argument("--logs", default="./tmp/logs", help="Directory with technical.jsonl")
+    parser.add_argument("--trace", help="Only export this transactieID")
+    parser.add_argument("-o", "--output", default="./tmp/traces/trace.json")
+    options = parser.parse_args()
+
+    spans = read_spans(options.logs, options.trace)
+    os.makedirs(os.path.dirname(options.output) or ".", exist_ok=True)
+    with open(options.output, "w", encoding="utf-8") as f:
+        json.dump(to_chrome_trace(spans), f)
+    print(f"[Tracing] Wrote {len(spans)} spans to {options.output}")
@@ -0,0 +1,299 @@
+import json
+import os
+import re
+from bisect import bisect_right
+from ingestion import INCOMING_DIRECTORY
+
+TIMINGS_DIR = "data/timings"
+CHUNK_CHARS = 64 * 1024
+
+# Structural characters of JSON outside strings, and the end of a string
+_STRUCTURAL = re.compile(r'["{}\[\]:]')
+_STRING_END = re.compile(r'["\\]')
+_SEPARATORS = re.compile(r"[\s,]*")
+
+_decoder = json.JSONDecoder()
+
+
+class SegmentParser:
+    """
+    Incremental parser for speech-to-text JSON (see json.json). Feed it the document chunk by chunk;
+    it yields the elements of `output.segments` (or a top-level `segments`) as dicts, one at a time.
+    Only the segment being parsed is held in memory, and everything after the segments array
+    (e.g. "alternatives") is never parsed.
+    """
+
+    def __init__(self) -> None:
+        self.buffer = ""
+        self.pos = 0
+        self.stack = []  # Open containers before the segments array: [bracket, current key]
+        self.last_string = None
+        self.state = "seek"
+        self.retry_at = 0  # Buffer length needed before decoding an incomplete segment again
+
+    def feed(self, chunk: str):
+        self.buffer += chunk
+        if self.state == "seek":
+            self._seek()
+        if self.state == "segments":
+            yield from self._segments(final=not chunk)
+        self._trim()
+
+    def close(self) -> None:
+        """Raises ValueError when the document ended before the segments array was complete."""
+        if self.state != "done":
+            raise ValueError("No complete 'segments' array in transcription")
+
+    def _seek(self) -> None:
+        """Scans the document structure up to the opening bracket of the segments array."""
+        while True:
+            match = _STRUCTURAL.search(self.buffer, self.pos)
+            if match is None:
+                self.pos = len(self.buffer)
+                return
+            char = match.group()
+
+            if char == '"':
+                end = self._string_end(match.end())
+                if end is None:
+                    self.pos = match.start()
+                    return
+                self.last_string = self.buffer[match.end():end]
+                self.pos = end + 1
+                continue
+
+            self.pos = match.end()
+            if char == ":":
+                if self.stack and self.stack[-1][0] == "{":
+                    self.stack[-1][1] = self.last_string
+            elif char in "{[":
+                if char == "[" and self._at_segments():
+                    self.state = "segments"
+                    return
+                self.stack.append([char, None])
+            elif self.stack:
+                self.stack.pop()
+
+    def _string_end(self, start: int) -> int | None:
+        pos = start
+        while True:
+            match = _STRING_END.search(self.buffer, pos)
+            if match is None:
+                return None
+            if match.group() == '"':
+                return match.start()
+            pos = match.end() + 1  # Skip the escaped character
+
+    def _at_segments(self) -> bool:
+        path = [key for _, key in self.stack]
+        return all(bracket == "{" for bracket, _ in self.stack) and path in (["output", "segments"], ["segments"])
+
+    def _segments(self, final: bool):
+        while True:
+            self.pos = _SEPARATORS.match(self.buffer, self.pos).end()
+            if self.pos >= len(self.buffer):
+                return
+            if self.buffer[self.pos] == "]":
+                self.state = "done"
+                return
+            if len(self.buffer) < self.retry_at and not final:
+                return
+
+            try:
+                segment, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if final:
+                    raise ValueError("Truncated segment in transcription")
+                # Wait for twice the data before trying again, so huge segments aren't decoded over and over
+                self.retry_at = self.pos + 2 * (len(self.buffer) - self.pos)
+                return
+
+            self.pos = end
+            self.retry_at = 0
+            yield segment
+
+    def _trim(self) -> None:
+        keep = self.pos if self.state != "done" else len(self.buffer)
+        if keep:
+            self.buffer = self.buffer[keep:]
+            self.retry_at = max(self.retry_at - keep, 0)
+            self.pos = 0
+
+
+def iter_segments(f, chunk_chars: int = CHUNK_CHARS):
+    """Yields the segments of a transcription JSON file opened in text mode, reading it in chunks."""
+    parser = SegmentParser()
+    while True:
+        chunk = f.read(chunk_chars)
+        yield from parser.feed(chunk)
+        if not chunk or parser.state == "done":
+            break
+    parser.close()
+
+
+def speaker_label(speaker) -> str | None:
+    if speaker is None or speaker == "":
+        return None
+    if isinstance(speaker, str) and not speaker.isdigit():
+        return speaker.strip()
+    return f"Spreker {speaker}"
+
+
+def iter_turns(segments):
+    """
+    Merges consecutive segments of the same speaker into turns. Each turn is a dict with the
+    speaker, its start and end time and its words as `(text, start, end)` tuples; segments without
+    word timings count as a single word spanning the segment.
+    """
+    turn = None
+    for segment in segments:
+        speaker = segment.get("speaker")
+        words = [
+            (" ".join(word["text"].split()), word.get("startTimeSeconds"), word.get("endTimeSeconds"))
+            for word in segment.get("words") or []
+            if (word.get("text") or "").strip()
+        ]
+        if not words and (segment.get("text") or "").strip():
+            words = [(" ".join(segment["text"].split()), segment.get("startTimeSeconds"), segment.get("endTimeSeconds"))]
+        if not words:
+            continue
+
+        if turn is not None and turn["speaker"] == speaker:
+            turn["words"].extend(words)
+            turn["end"] = segment.get("endTimeSeconds", turn["end"])
+            continue
+
+        if turn is not None:
+            yield turn
+        turn = {
+            "speaker": speaker,
+            "start": segment.get("startTimeSeconds"),
+            "end": segment.get("endTimeSeconds"),
+            "words": words,
+        }
+    if turn is not None:
+        yield turn
+
+
+def write_transcript(segments, out) -> dict:
+    """
+    Writes the segments as a transcript with one "Spreker n: ..." line per turn, the format
+    GenerateReport and the passage index expect.
+
+    :param out: Text stream to write to.
+    :return: The timings: turns as `[speaker, start, end, offset]` and per word its character
+             offset in the transcript with its start and end time, in columns.
+    """
+    timings = {"turns": [], "word_offsets": [], "word_starts": [], "word_ends": []}
+    offset = 0
+    for turn in iter_turns(segments):
+        label = speaker_label(turn["speaker"])
+        timings["turns"].append([turn["speaker"], turn["start"], turn["end"], offset])
+        pieces = [f"{label}: " if label else ""]
+        position = offset + len(pieces[0])
+
+        for i, (text, start, end) in enumerate(turn["words"]):
+            if i:
+                pieces.append(" ")
+                position += 1
+            timings["word_offsets"].append(position)
+            timings["word_starts"].append(start)
+            timings["word_ends"].append(end)
+            pieces.append(text)
+            position += len(text)
+
+        pieces.append("\n")
+        out.write("".join(pieces))
+        offset = position + 1
+    return timings
+
+
+def is_transcription(path: str) -> bool:
+    """Whether an uploaded file is speech-to-text JSON rather than a plain text transcript."""
+    with open(path, "rb") as f:
+        head = f.read(64).lstrip(b"\xef\xbb\xbf \t\r\n")
+    return head.startswith(b"{")
+
+
+def timings_path(file_id: str) -> str:
+    return os.path.join(TIMINGS_DIR, f"{os.path.basename(file_id)}.json")
+
+
+def ingest_transcription(source: str, destination: str, file_id: str) -> dict:
+    """
+    Converts a speech-to-text JSON file into a plain transcript at `destination` (which may be the
+    source itself) and stores the timing offsets of the report under `file_id`.
+
+    :return: Counts of the conversion, for logging.
+    :raises ValueError: If the file contains no valid segments array.
+    """
+    # Written next to partial uploads, so the table never lists a half-converted transcript
+    os.makedirs(INCOMING_DIRECTORY, exist_ok=True)
+    tmp_path = os.path.join(INCOMING_DIRECTORY, f"{os.path.basename(destination)}.transcript")
+    segment_count = 0
+
+    def counted(segments):
+        nonlocal segment_count
+        for segment in segments:
+            segment_count += 1
+            yield segment
+
+    try:
+        with open(source, "r", encoding="utf-8-sig") as f, open(tmp_path, "w", encoding="utf-8") as out:
+            timings = write_transcript(counted(iter_segments(f)), out)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    os.makedirs(TIMINGS_DIR, exist_ok=True)
+    path = timings_path(file_id)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(timings, f, separators=(",", ":"))
+    os.replace(f"{path}.tmp", path)
+    os.replace(tmp_path, destination)
+
+    ends = [end for end in timings["word_ends"] if end is not None]
+    return {
+        "segments": segment_count,
+        "turns": len(timings["turns"]),
+        "words": len(timings["word_offsets"]),
+        "duration_s": max(ends) if ends else None,
+    }
+
+
+def load_timings(file_id: str) -> dict | None:
+    try:
+        with open(timings_path(file_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def lookup_time(file_id: str, offset: int) -> tuple[float, float] | None:
+    """
+    Start and end time in the recording of the word at a character offset of a report's transcript
+    (its `original_input`). Returns None for reports that weren't ingested from speech-to-text JSON.
+    """
+    timings = load_timings(file_id)
+    if not timings or not timings["word_offsets"]:
+        return None
+    index = max(bisect_right(timings["word_offsets"], offset) - 1, 0)
+    return timings["word_starts"][index], timings["word_ends"][index]
+
+
+def remove_timings(file_id: str) -> None:
+    try:
+        os.remove(timings_path(file_id))
+    except OSError:
+        pass
+
+
+def transcript_text(segments) -> str:
+    """The transcript of in-memory segments, e.g. a transcription already parsed from a websocket message."""
+    lines = []
+    for turn in iter_turns(segments):
+        label = speaker_label(turn["speaker"])
+        text = " ".join(word for word, _, _ in turn["words"])
+        lines.append(f"{label}: {text}" if label else text)
+    return "\n".join(lines)
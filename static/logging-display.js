@@ -1,3 +1,134 @@
+// ---- Log payloads --------------------------------------------------------------
+// Large logged values are kept in the server's payload store; the records hold a
+// reference {input_content_hash, dataSize_bytes} instead, fetched with "log-payload".
+const LOG_PAYLOAD_FIELDS = ["input", "raw_input", "updated_data", "prompt", "output", "results", "params"];
+const logPayloads = new Map(); // hash -> Promise of the value (null when unknown)
+const pendingLogPayloads = new Map(); // hash -> resolve of that Promise
+
+function isLogPayloadReference(value) {
+  return (
+    value != null &&
+    typeof value === "object" &&
+    typeof value.input_content_hash === "string" &&
+    Object.keys(value).length === 2 &&
+    "dataSize_bytes" in value
+  );
+}
+
+function fetchLogPayload(hash) {
+  if (!logPayloads.has(hash)) {
+    logPayloads.set(
+      hash,
+      new Promise((resolve) => {
+        pendingLogPayloads.set(hash, resolve);
+        ws.send(JSON.stringify({ action: "log-payload", hash }));
+      })
+    );
+  }
+  return logPayloads.get(hash);
+}
+
+// Called by the page's websocket handler with the "log-payload" responses
+function onLogPayload(payload) {
+  const resolve = pendingLogPayloads.get(payload?.hash);
+  if (!resolve) return;
+  pendingLogPayloads.delete(payload.hash);
+  if (payload.error) console.warn("Log payload", payload.hash, payload.error);
+  resolve(payload.error ? null : payload.data);
+}
+
+// Replaces the payload references of the entries by their values, in place;
+// unknown (pruned) payloads by a note with their hash
+async function resolveLogPayloads(entries) {
+  const pending = [];
+  for (const e of entries) {
+    for (const key of LOG_PAYLOAD_FIELDS) {
+      const value = e[key];
+      if (!isLogPayloadReference(value)) continue;
+      pending.push(
+        fetchLogPayload(value.input_content_hash).then((data) => {
+          e[key] = data ?? `[payload ${value.input_content_hash.slice(0, 12)}… not available]`;
+        })
+      );
+    }
+  }
+  await Promise.all(pending);
+}
+
+function hasLogPayloadReferences(entries) {
+  return entries.some((e) => LOG_PAYLOAD_FIELDS.some((key) => isLogPayloadReference(e[key])));
+}
+
+function showLogPayloadsLoading(infoContainer, entries) {
+  const references = new Set();
+  for (const e of entries) {
+    for (const key of LOG_PAYLOAD_FIELDS) {
+      if (isLogPayloadReference(e[key])) references.add(e[key].input_content_hash);
+    }
+  }
+  infoContainer.innerHTML = `
+    <div class="p-2">Loading ${references.size} logged value(s)…</div>`;
+}
+
+// ---- Metrics -------------------------------------------------------------------
+// Counters and latency percentiles of all server processes ("metrics" action),
+// shown above the technical logs; the same data as /metrics, summarized.
+function requestMetrics() {
+  const container = document.getElementById("logsMetrics");
+  if (container) container.innerHTML = `<div class="p-2">Loading metrics…</div>`;
+  ws.send(JSON.stringify({ action: "metrics" }));
+}
+
+// Called by the page's websocket handler with the "metrics" response
+function onMetrics(summary) {
+  const container = document.getElementById("logsMetrics");
+  if (!container) return; // The logging view was closed in the meantime
+
+  const escapeHTML = (s) =>
+    String(s ?? "")
+      .replace(/&/g, "&amp;")
+      .replace(/</g, "&lt;")
+      .replace(/>/g, "&gt;");
+  const labelText = (labels) =>
+    Object.entries(labels || {})
+      .map(([k, v]) => `${k}=${v}`)
+      .join(", ") || "—";
+  const seconds = (v) => (v == null ? "—" : `${(v * 1000).toFixed(1)} ms`);
+
+  const names = Object.keys(summary || {});
+  if (!names.length) {
+    container.innerHTML = `<div class="p-2">No metrics recorded yet.</div>`;
+    return;
+  }
+
+  const rows = [];
+  for (const name of names) {
+    for (const series of summary[name]) {
+      const value =
+        "value" in series
+          ? escapeHTML(series.value)
+          : `n=${series.count} • avg ${seconds(series.avg_s)} • p50 ${seconds(
+              series.p50_s
+            )} • p95 ${seconds(series.p95_s)}`;
+      rows.push(`
+        <tr>
+          <td style="padding:.25rem .4rem; font-family:monospace;">${escapeHTML(name)}</td>
+          <td style="padding:.25rem .4rem;">${escapeHTML(labelText(series.labels))}</td>
+          <td style="padding:.25rem .4rem;">${value}</td>
+        </tr>`);
+    }
+  }
+  container.innerHTML = `
+    <details>
+      <summary><strong>Metrics</strong> (${names.length})</summary>
+      <div style="max-height:240px; overflow:auto;">
+        <table style="width:100%; border-collapse:collapse; font-size:.9em;">
+          <tbody>${rows.join("")}</tbody>
+        </table>
+      </div>
+    </details>`;
+}
+
 function showTLogsModal(item, buttons) {
   ensureModalExists();
 
@@ -63,6 +194,13 @@ function showTLogsModal(item, buttons) {
     entries.push(raw);
   }
 
+  // Large values are fetched first; the modal is then rebuilt from the resolved entries
+  if (hasLogPayloadReferences(entries)) {
+    showLogPayloadsLoading(infoContainer, entries);
+    resolveLogPayloads(entries).then(() => showTLogsModal({ logs: entries }, buttons));
+    return;
+  }
+
   // ---- Build quick summary -----------------------------------------------------
   if (!entries.length) {
     infoContainer.innerHTML = `
@@ -314,13 +452,28 @@ function showTLogsModal(item, buttons) {
     detailsEls.forEach((d) => (d.open = rawToggle.checked));
   });
 
+  // ---- Metrics ----------------------------------------------------------------
+  const metricsHeader = document.createElement("div");
+  metricsHeader.style.cssText = "display:flex; gap:.5rem; align-items:flex-start; margin-bottom:.5rem;";
+  const metricsContainer = document.createElement("div");
+  metricsContainer.id = "logsMetrics";
+  metricsContainer.style.flex = "1";
+  const refreshMetrics = document.createElement("button");
+  refreshMetrics.type = "button";
+  refreshMetrics.className = "btn btn-sm btn-outline-secondary";
+  refreshMetrics.textContent = "Refresh metrics";
+  refreshMetrics.addEventListener("click", requestMetrics);
+  metricsHeader.append(metricsContainer, refreshMetrics);
+
   // ---- Compose modal content --------------------------------------------------
+  infoContainer.appendChild(metricsHeader);
   infoContainer.appendChild(summary);
   infoContainer.appendChild(controls);
   infoContainer.appendChild(table);
 
   // First paint
   apply();
+  requestMetrics();
 }
 
 function showALogsModal(item, buttons, opts = {}) {
@@ -425,6 +578,13 @@ function showALogsModal(item, buttons, opts = {}) {
     return;
   }
 
+  // Large values (transcripts, updated_data) are fetched first; the modal is then rebuilt from the resolved entries
+  if (hasLogPayloadReferences(entries)) {
+    showLogPayloadsLoading(infoContainer, entries);
+    resolveLogPayloads(entries).then(() => showALogsModal({ logs: entries }, buttons, opts));
+    return;
+  }
+
   // ---- Normalize ----
   const toDate = (d) => { try { return d ? new Date(d) : null; } catch { return null; } };
   const normalized = entries
@@ -8,6 +8,8 @@ function generateUUIDFallback() {
 const ws = new WebSocket("ws://145.90.76.152:8080/ws/" + (crypto.randomUUID ? crypto.randomUUID() : generateUUIDFallback()));
 const tbody = document.getElementById("pv-table-body");
 const retryInFlight = new Set();
+const jobProgress = new Map(); // filename -> latest "update" payload of its SAJE job
+const prefetchRequested = new Set(); // filenames whose editor data the server was asked to prefetch
 let noneSeen = false;
 let currentData = null;
 let logs = null;
@@ -50,7 +52,8 @@ function showUploadForm(filenameToRetry = null) {
     ${isRetry ? '' : `
     <div class="mb-3">
       <label for="popup_file_input" class="form-label">File</label>
-      <input type="file" id="popup_file_input" class="form-control">
+      <input type="file" id="popup_file_input" class="form-control" multiple>
+      <div class="form-text">Several files or a ZIP archive are processed as one batch.</div>
     </div>
     `}
     <div class="form-check mb-3">
@@ -120,11 +123,17 @@ function showUploadForm(filenameToRetry = null) {
       popup.remove();
     } else {
       const popupFileInput = popup.querySelector("#popup_file_input");
-      const file = popupFileInput.files[0];
+      const files = [...popupFileInput.files];
+      const file = files[0];
       if (!file) {
         alert("Please select a file.");
         return;
       }
+      if (isBatchUpload(files)) {
+        uploadBatch(files);
+        popup.remove();
+        return;
+      }
 
       const UUID = crypto.randomUUID ? crypto.randomUUID() : generateUUIDFallback();
       config.UUID = UUID;
@@ -139,6 +148,7 @@ function showUploadForm(filenameToRetry = null) {
       })
         .then(() => {
           sessionStorage.setItem("uuid", UUID);
+          ws.send(JSON.stringify({ action: "watch-job", ID: UUID }));
           ws.send(JSON.stringify({ action: "table-update" }));
           popup.remove();
         })
@@ -155,6 +165,87 @@ function showUploadForm(filenameToRetry = null) {
   });
 }
 
+// ==============
+// BATCH UPLOAD
+// ==============
+// Several files, or a ZIP archive of them, become one batch of low-priority
+// GenerateReport jobs (/upload-batch); its progress is streamed by "watch-batch".
+function isBatchUpload(files) {
+  return files.length > 1 || files[0].name.toLowerCase().endsWith(".zip");
+}
+
+function uploadBatch(files) {
+  const batchID = crypto.randomUUID ? crypto.randomUUID() : generateUUIDFallback();
+  const formData = new FormData();
+  files.forEach((file) => formData.append("files", file));
+  renderBatchProgress({ batch: batchID, uploading: files.length });
+
+  fetch(`/upload-batch/${batchID}`, {
+    method: "POST",
+    body: formData,
+  })
+    .then(async (response) => {
+      if (!response.ok) throw new Error(await response.text());
+      ws.send(JSON.stringify({ action: "watch-batch", batch: batchID }));
+      ws.send(JSON.stringify({ action: "table-update" }));
+    })
+    .catch((err) => {
+      console.error("Batch upload failed", err);
+      document.getElementById(`batch-${batchID}`)?.remove();
+      showPopup("Batch upload failed. See console.", "#dc3545");
+    });
+}
+
+function renderBatchProgress(progress) {
+  let panel = document.getElementById(`batch-${progress.batch}`);
+  if (!panel) {
+    panel = document.createElement("div");
+    panel.id = `batch-${progress.batch}`;
+    Object.assign(panel.style, {
+      position: "fixed",
+      bottom: "20px",
+      left: "20px",
+      backgroundColor: "white",
+      border: "1px solid #ccc",
+      borderRadius: "8px",
+      boxShadow: "0 2px 10px rgba(0,0,0,0.2)",
+      padding: "12px 16px",
+      minWidth: "280px",
+      zIndex: "2000",
+    });
+    document.body.appendChild(panel);
+  }
+
+  if (progress.uploading) {
+    panel.innerHTML = `<strong>Batch</strong><div>Uploading ${progress.uploading} file(s)…</div>`;
+    return;
+  }
+
+  const finished = progress.done + progress.error + progress.cancelled;
+  const percent = progress.total ? Math.round((finished / progress.total) * 100) : 100;
+  const eta = progress.eta_s != null ? ` • ETA ${Math.ceil(progress.eta_s / 60)} min` : "";
+  panel.innerHTML = `
+    <strong>Batch</strong> ${finished}/${progress.total} reports${progress.finished ? " • finished" : ""}
+    <div class="progress my-2" style="height:8px;">
+      <div class="progress-bar${progress.error ? " bg-warning" : ""}" style="width:${percent}%"></div>
+    </div>
+    <small>
+      ${progress.done} done • ${progress.running} running • ${progress.queued} queued
+      ${progress.error ? ` • ${progress.error} failed` : ""}${progress.cancelled ? ` • ${progress.cancelled} cancelled` : ""}
+      • ${progress.reports_per_minute}/min${eta}
+    </small>
+  `;
+
+  if (progress.finished) {
+    const closeBtn = document.createElement("button");
+    closeBtn.type = "button";
+    closeBtn.className = "btn btn-sm btn-secondary mt-2 d-block";
+    closeBtn.textContent = "Close";
+    closeBtn.addEventListener("click", () => panel.remove());
+    panel.appendChild(closeBtn);
+  }
+}
+
 // ==============
 // INDIVIDUAL FILE RETRYING
 // ==============
@@ -215,11 +306,14 @@ function renderTable(data) {
 
         tdAction.appendChild(viewBtn);
         tdAction.appendChild(deleteBtn);
+        // Hovering or tabbing to a report usually precedes opening it
+        tr.addEventListener("pointerenter", () => requestPrefetch(item.filename));
+        tr.addEventListener("focusin", () => requestPrefetch(item.filename));
         break;
 
       case "working":
         tdAction.appendChild(createSpinner());
-        tdAction.appendChild(createStatusText(item.status));
+        tdAction.appendChild(createStatusText(formatProgress(item.filename) || item.status));
         tdAction.appendChild(createCancelButton(item, tdAction));
         break;
 
@@ -638,6 +732,13 @@ function generateAndDownloadPdf() {
     }
 }
 
+// Asks the server to compute what the editor loads first, so it opens without waiting for the LLM
+function requestPrefetch(filename) {
+  if (prefetchRequested.has(filename) || ws.readyState !== WebSocket.OPEN) return;
+  prefetchRequested.add(filename);
+  ws.send(JSON.stringify({ action: "prefetch", filename: filename, kinds: ["thoughts"] }));
+}
+
 /// ==============
 /// Button functionality
 /// =============
@@ -747,6 +848,13 @@ function createSpinner() {
   return spinner;
 }
 
+function formatProgress(filename) {
+  const update = jobProgress.get(filename);
+  if (!update) return null;
+  const eta = update.eta_s != null ? `, ~${Math.ceil(update.eta_s)}s left` : "";
+  return `working (${update.done}/${update.total}${eta})`;
+}
+
 function createStatusText(status) {
   const statusText = document.createElement("span");
   statusText.className = "ms-2";
@@ -863,6 +971,40 @@ ws.addEventListener("message", ({ data: raw }) => {
       console.log(data.data);
       break;
 
+    case "log-payload":
+      // A large logged value the log views asked for (logging-display.js)
+      onLogPayload(data.data);
+      break;
+
+    case "metrics":
+      // Counters and latencies of all processes, for the logging view (logging-display.js)
+      onMetrics(data.data);
+      break;
+
+    case "update": {
+      // Progress of a running job, keep it across table re-renders
+      jobProgress.set(data.data.ID, data.data);
+      const tr = document.querySelector(`tr[data-filename="${data.data.ID}"]`);
+      const statusText = tr?.querySelector(".ms-2");
+      if (statusText) statusText.textContent = formatProgress(data.data.ID);
+      break;
+    }
+
+    case "done":
+    case "cancelled":
+      ws.send(JSON.stringify({ action: "table-update" }));
+      break;
+
+    case "batch-update":
+      renderBatchProgress(data.data);
+      ws.send(JSON.stringify({ action: "table-update" }));
+      break;
+
+    case "batch-done":
+      renderBatchProgress(data.data);
+      showPopup(`Batch finished: ${data.data.done}/${data.data.total} reports`);
+      break;
+
     case "report":
       setTimeout(() => {
         downloadPDF(data.data);